@@ -0,0 +1,356 @@
+'''
+CirrusCI API interaction from asyncio event loop
+
+Requires aiohttp. Retry semantics and queries are the same as in the blocking
+API client, so one event loop can drive many builds and log streams without
+spawning a thread per operation
+'''
+
+
+import asyncio
+import codecs
+import logging
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from time import monotonic as time
+from types import SimpleNamespace
+
+from . import metrics
+from .api import (
+    CirrusAPI,
+    CirrusHTTPError,
+    long_delay_required,
+    minify_query,
+    operation_name,
+    persisted_query_payload,
+    persisted_query_not_found,
+    persisted_query_not_supported,
+    persisted_query_rejected,
+)
+from .queries import (
+    CREATE_BUILD,
+    GET_BUILD_LOG,
+    GET_REPO,
+    LOG_CHUNK_SIZE,
+    LOG_SPOOL_SIZE,
+    BuildWaiter,
+    CirrusQueryError,
+    LogChunk,
+    status_queries,
+    _read_spool,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class AsyncCirrusAPI:
+    '''Interact with Cirrus via GraphQL API (asyncio version)'''
+
+    DEFAULT_URL = CirrusAPI.DEFAULT_URL
+    USER_AGENT = CirrusAPI.USER_AGENT
+    RETRY_ATTEMPTS = CirrusAPI.RETRY_ATTEMPTS
+    RETRY_DELAY = CirrusAPI.RETRY_DELAY
+    RETRY_LONG_DELAY = CirrusAPI.RETRY_LONG_DELAY
+    CONNECT_TIMEOUT = CirrusAPI.CONNECT_TIMEOUT
+    READ_TIMEOUT = CirrusAPI.READ_TIMEOUT
+    POOL_SIZE = CirrusAPI.POOL_SIZE
+
+    def __init__(self, token=None, url=None, pool_size=None, persisted_queries=False):
+        if url is None:
+            url = self.DEFAULT_URL
+        if pool_size is None:
+            pool_size = self.POOL_SIZE
+        self._url = url
+        self._pool_size = pool_size
+        self.persisted_queries = persisted_queries
+        self._headers = {
+            'Accept': 'application/json',
+            'User-Agent': self.USER_AGENT,
+        }
+        if token:
+            self._headers['Authorization'] = 'Bearer {}'.format(token)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *a, **ka):
+        await self.close()
+
+    async def close(self):
+        '''Release network resources'''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def _requests(self):
+        if self._session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError('aiohttp is required for AsyncCirrusAPI: pip install cirrus-run[async]')
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=aiohttp.TCPConnector(limit=self._pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.CONNECT_TIMEOUT, sock_read=self.READ_TIMEOUT),
+            )
+        return self._session
+
+    async def __call__(self, query, params=None, retries=None, delay=None):
+        if retries is None:
+            retries = self.RETRY_ATTEMPTS
+        if delay is None:
+            delay = self.RETRY_DELAY
+
+        payload = dict(query=minify_query(query), variables=params or {})
+        log.debug('Calling API with parameters: {}, query: {}'.format(payload['variables'], payload['query']))
+
+        operation = operation_name(payload['query'])
+        error_count = 0
+        long_wait_happened = False
+        while True:
+            metrics.count('graphql_requests_total', operation=operation)
+            try:
+                with metrics.timer('graphql_request_seconds', operation=operation):
+                    if self.persisted_queries:
+                        answer = await self._post_persisted(payload)
+                    else:
+                        answer = await self._post(json=payload)
+                return self._parse_api_response(answer)
+            except Exception as exc:
+                metrics.count('graphql_errors_total', operation=operation)
+                error_count += 1
+                if error_count > retries:
+                    raise exc
+                metrics.count('api_retries_total', operation=operation)
+                if not long_wait_happened and long_delay_required(exc):
+                    long_wait_happened = True
+                    log.debug('API server asked for longer retry delay: {}, retrying'.format(exc))
+                    metrics.count('api_long_delays_total', operation=operation)
+                    metrics.count('api_retry_sleep_seconds_total', self.RETRY_LONG_DELAY)
+                    await asyncio.sleep(self.RETRY_LONG_DELAY)
+                else:
+                    log.debug('Error when calling API: {}, retrying'.format(exc))
+                    metrics.count('api_retry_sleep_seconds_total', delay)
+                    await asyncio.sleep(delay)
+
+    _parse_api_response = CirrusAPI._parse_api_response
+    log_url = CirrusAPI.log_url
+
+    async def _post_persisted(self, payload):
+        '''Send query hash first, full query text only if server asks for it (see CirrusAPI)'''
+        short = persisted_query_payload(payload['query'], payload['variables'])
+        try:
+            answer = await self._post(json=short)
+        except CirrusHTTPError as exc:
+            if not persisted_query_rejected(exc):
+                raise
+            answer = None
+        if answer is not None and persisted_query_not_found(answer):
+            return await self._post(json=dict(short, query=payload['query']))
+        if answer is None or persisted_query_not_supported(answer):
+            log.debug('Persisted queries are not supported by API server, disabling them')
+            self.persisted_queries = False
+            answer = await self._post(json=payload)
+        return answer
+
+    async def _post(self, **ka):
+        async with self._requests.post(self._url, **ka) as response:
+            if response.status != 200:
+                raise CirrusHTTPError(SimpleNamespace(
+                    status_code=response.status,
+                    text=await response.text(),
+                    url=str(response.url),
+                ))
+            return await response.json()
+
+    def get(self, *a, **ka):
+        '''Perform GET request using API session (use as async context manager)'''
+        metrics.count('log_requests_total')
+        return self._requests.get(*a, **ka)
+
+
+async def get_repo(api: AsyncCirrusAPI, owner: str, repo: str) -> str:
+    '''Get internal ID for GitHub repo'''
+    params = dict(owner=owner, repo=repo)
+    reply = await api(GET_REPO, params)
+    if reply['ownerRepository']:
+        return reply['ownerRepository']['id']
+    raise CirrusQueryError('repo not found: {}/{}'.format(owner, repo))
+
+
+async def create_build(api: AsyncCirrusAPI,
+                       repo_id: str,
+                       repo_branch: str = 'master',
+                       config: str = '') -> str:
+    '''
+    Trigger new build on Cirrus CI
+
+    Return build ID
+    '''
+    mutation_id = 'cirrus-run job {}'.format(int(time()))
+    answer = await api(
+        query=CREATE_BUILD,
+        params=dict(
+            repo=repo_id,
+            branch=repo_branch,
+            mutation_id=mutation_id,
+            config=config),
+    )
+    return answer['createBuild']['build']['id']
+
+
+async def wait_build(api, build_id: str, delay=3, abort=60*60, callback=None, policy=None):
+    '''
+    Wait until build finishes
+
+    Optional callback (regular function or coroutine function) is invoked
+    without arguments after each status check
+    '''
+    async for _, error in wait_builds(api, [build_id], delay, abort, callback, policy):
+        if error is not None:
+            raise error
+    return True
+
+
+async def wait_builds(api, build_ids, delay=3, abort=60*60, callback=None, policy=None):
+    '''
+    Wait until several builds finish, checking all of them on each iteration
+
+    Yield (build_id, error) tuples as builds finish, see queries.wait_builds()
+    '''
+    waiter = BuildWaiter(build_ids, delay, policy)
+    time_start = time()
+    while waiter.pending:
+        if time() >= time_start + abort:
+            for finished in waiter.timeout():
+                yield finished
+            return
+        statuses = await build_statuses(api, waiter.pending)
+        if callback is not None:
+            result = callback()
+            if asyncio.iscoroutine(result):
+                await result
+        for finished in waiter.update(statuses):
+            yield finished
+        if waiter.pending:
+            delay = waiter.next_delay(time() - time_start)
+            metrics.count('wait_sleep_seconds_total', delay)
+            await asyncio.sleep(delay)
+
+
+async def build_statuses(api, build_ids, batch_size=50):
+    '''Return a mapping of build ID to its current status'''
+    statuses = {}
+    for query, params in status_queries(build_ids, batch_size):
+        response = await api(query, params)
+        for alias, build_id in params.items():
+            statuses[build_id] = response[alias]['status']
+    return statuses
+
+
+async def build_log(api, build_id, concurrency=1):
+    '''
+    Yield build log in chunks of text (LogChunk instances)
+
+    Up to `concurrency` command logs are downloaded in parallel,
+    chunks are always yielded in task/command order
+    '''
+    params = dict(build=build_id)
+    response = await api(GET_BUILD_LOG, params)
+
+    urls = []
+    for task in response['build']['tasks']:
+        for command in task['commands']:
+            urls.append(api.log_url(task['id'], command['name']))
+    spools = None
+    if concurrency > 1:
+        spools = _prefetch(lambda url: _spool_log(api, url), urls, concurrency,
+                           discard=lambda spool: spool.close())
+    urls = iter(urls)
+
+    try:
+        for task in response['build']['tasks']:
+            yield LogChunk('\n## Task: {task[name]}\n'.format(**locals()), task, markup=True)
+            for command in task['commands']:
+                header = '\n## Task instruction: {command[name]}\n'.format(**locals())
+                yield LogChunk(header, task, command, markup=True)
+                if spools is not None:
+                    for text in _read_spool(await spools.__anext__()):
+                        yield LogChunk(text, task, command)
+                else:
+                    async for text in stream_log(api, next(urls)):
+                        yield LogChunk(text, task, command)
+                yield LogChunk('\n', task, command, markup=True)
+    finally:
+        if spools is not None:
+            await spools.aclose()  # consumer may stop early, spooled logs are discarded
+
+
+def _count_log_bytes(response, received, size):
+    '''Count bytes received from the network (before decompression) if aiohttp reports them'''
+    position = getattr(response.content, 'total_raw_bytes', None)
+    if position is None:
+        position = received + size
+    if position > received:
+        metrics.count('log_bytes_total', position - received)
+    return max(position, received)
+
+
+async def stream_log(api, url):
+    '''Yield text chunks of a single command log as they are downloaded'''
+    async with api.get(url) as response:
+        if response.status != 200:
+            yield 'Unable to fetch url: {}'.format(url)
+            return
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        received = 0
+        async for data in response.content.iter_chunked(LOG_CHUNK_SIZE):
+            received = _count_log_bytes(response, received, len(data))
+            text = decoder.decode(data)
+            if text:
+                yield text
+        _count_log_bytes(response, received, 0)
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+
+async def _spool_log(api, url):
+    '''Download a single command log into temporary storage'''
+    spool = SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE, mode='w+', encoding='utf-8')
+    try:
+        async for chunk in stream_log(api, url):
+            spool.write(chunk)
+    except BaseException:  # including cancellation
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def _prefetch(function, items, concurrency, discard=None):
+    '''
+    Await up to `concurrency` coroutines ahead of the consumer, yield results in input order
+
+    If the consumer stops early, pending coroutines are cancelled and the
+    results that were not consumed are passed to discard()
+    '''
+    pending = deque()
+    try:
+        for item in items:
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+            pending.append(asyncio.ensure_future(function(item)))
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        if discard is not None:
+            for result in results:
+                if not isinstance(result, BaseException):
+                    discard(result)
@@ -3,12 +3,14 @@ CirrusCI API interaction
 '''
 
 
+import hashlib
 import logging
+import re
+from functools import lru_cache
 from time import sleep
-from pprint import pformat
-from textwrap import dedent
+from urllib.parse import urljoin, quote
 
-import requests
+from . import metrics
 
 
 log = logging.getLogger(__name__)
@@ -16,6 +18,7 @@ log = logging.getLogger(__name__)
 
 class CirrusAPIError(Exception):
     def __init__(self, errors):
+        from pprint import pformat
         message = 'API returned {num} error(s):\n{errors}'.format(
             num=len(errors),
             errors=pformat(errors, indent=2)
@@ -37,6 +40,83 @@ class CirrusHTTPError(Exception):
         return '<{cls} [{code}]>'.format(cls=self.__class__.__name__, code=self.code)
 
 
+def long_delay_required(exc):
+    '''Check if the error means that API server needs more time to recover'''
+    return (
+        (isinstance(exc, CirrusHTTPError) and 'try again in 30 seconds' in exc.response.text)
+        or
+        (isinstance(exc, CirrusAPIError) and 'Internal Server Error(s) while executing query' in str(exc))
+    )
+
+
+GRAPHQL_TOKENS = re.compile(r'(?P<string>"(?:\\.|[^"\\])*")|(?P<space>(?:[\s,]|#[^\n]*)+)')
+GRAPHQL_PUNCTUATION = set('{}()[]:=!$@|&')
+
+
+@lru_cache(maxsize=None)
+def minify_query(query):
+    '''Remove insignificant whitespace and comments from GraphQL query'''
+    result = []
+    position = 0
+    for match in GRAPHQL_TOKENS.finditer(query):
+        result.append(query[position:match.start()])
+        position = match.end()
+        if match.lastgroup == 'string':
+            result.append(match.group())
+        elif match.lastgroup == 'space':
+            before = query[match.start() - 1] if match.start() else '{'
+            after = query[match.end()] if match.end() < len(query) else '}'
+            if before not in GRAPHQL_PUNCTUATION and after not in GRAPHQL_PUNCTUATION:
+                result.append(' ')
+    result.append(query[position:])
+    return ''.join(result).strip()
+
+
+@lru_cache(maxsize=None)
+def operation_name(query):
+    '''Name of GraphQL operation, used as metrics label'''
+    match = re.match(r'\s*(?:query|mutation)\s+(\w+)', query)
+    return match.group(1) if match else 'anonymous'
+
+
+@lru_cache(maxsize=None)
+def query_hash(query):
+    '''Persisted query identifier (Automatic Persisted Queries protocol)'''
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def persisted_query_payload(query, variables):
+    '''Request body that refers to query by hash only'''
+    extensions = dict(persistedQuery=dict(version=1, sha256Hash=query_hash(query)))
+    return dict(variables=variables, extensions=extensions)
+
+
+def persisted_query_not_found(answer):
+    '''Check if server supports persisted queries but needs the full query text'''
+    errors = answer.get('errors') or []
+    return not answer.get('data') and any('PersistedQueryNotFound' in str(error) for error in errors)
+
+
+def persisted_query_not_supported(answer):
+    '''Check if server has explicitly refused to work with persisted queries'''
+    errors = answer.get('errors') or []
+    return not answer.get('data') and any('PersistedQueryNotSupported' in str(error) for error in errors)
+
+
+def persisted_query_rejected(exc):
+    '''Check if HTTP error in reply to hash-only request means that persisted queries are not supported'''
+    return 400 <= exc.code < 500 and exc.code != 429
+
+
+def wire_size(response):
+    '''Number of response body bytes received from the network (before decompression)'''
+    content = response.content  # body is read completely before counting
+    try:
+        return int(response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        return len(content)
+
+
 class CirrusAPI:
     '''Interact with Cirrus via GraphQL API'''
 
@@ -45,22 +125,49 @@ class CirrusAPI:
     RETRY_ATTEMPTS = 3
     RETRY_DELAY = 2  # seconds
     RETRY_LONG_DELAY = 30
+    CONNECT_TIMEOUT = 10  # seconds
+    READ_TIMEOUT = 60
+    CONNECT_RETRIES = 3
+    POOL_SIZE = 10
 
-    def __init__(self, token=None, url=None):
+    def __init__(self, token=None, url=None, pool_size=None, persisted_queries=False):
         if url is None:
             url = self.DEFAULT_URL
+        if pool_size is None:
+            pool_size = self.POOL_SIZE
         self._url = url
+        self.timeout = (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        self.persisted_queries = persisted_queries
+
+        # HTTP stack takes longer to import than the rest of cirrus-run,
+        # it is not loaded until the first client is created
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.request import ACCEPT_ENCODING
+        from urllib3.util.retry import Retry
 
         session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=pool_size,
+            max_retries=Retry(  # only failed connections are safe to retry for any request
+                total=self.CONNECT_RETRIES,
+                connect=self.CONNECT_RETRIES,
+                read=0,
+                status=0,
+                backoff_factor=0.5,
+            ),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
         session.headers.update({
             'Accept': 'application/json',
+            'Accept-Encoding': ACCEPT_ENCODING,  # includes brotli if available
             'User-Agent': self.USER_AGENT,
         })
         if token:
             session.headers.update({
                 'Authorization': 'Bearer {}'.format(token),
             })
-        session.timeout = 5
         self._requests = session
 
     def __call__(self, query, params=None, retries=None, delay=None):
@@ -69,30 +176,36 @@ class CirrusAPI:
         if delay is None:
             delay = self.RETRY_DELAY
 
-        payload = dict(query=dedent(query), variables=params or {})
+        payload = dict(query=minify_query(query), variables=params or {})
         log.debug('Calling API with parameters: {}, query: {}'.format(payload['variables'], payload['query']))
 
+        operation = operation_name(payload['query'])
         error_count = 0
         long_wait_happened = False
         while True:
+            metrics.count('graphql_requests_total', operation=operation)
             try:
-                answer = self._post(json=payload)
+                with metrics.timer('graphql_request_seconds', operation=operation):
+                    if self.persisted_queries:
+                        answer = self._post_persisted(payload)
+                    else:
+                        answer = self._post(json=payload)
                 return self._parse_api_response(answer)
             except Exception as exc:
+                metrics.count('graphql_errors_total', operation=operation)
                 error_count += 1
                 if error_count > retries:
                     raise exc
-                elif not long_wait_happened \
-                and (
-                  (isinstance(exc, CirrusHTTPError) and 'try again in 30 seconds' in exc.response.text)
-                  or
-                  (isinstance(exc, CirrusAPIError) and 'Internal Server Error(s) while executing query' in str(exc))
-                ):
+                metrics.count('api_retries_total', operation=operation)
+                if not long_wait_happened and long_delay_required(exc):
                     long_wait_happened = True
                     log.debug('API server asked for longer retry delay: {}, retrying'.format(exc))
+                    metrics.count('api_long_delays_total', operation=operation)
+                    metrics.count('api_retry_sleep_seconds_total', self.RETRY_LONG_DELAY)
                     sleep(self.RETRY_LONG_DELAY)
                 else:
                     log.debug('Error when calling API: {}, retrying'.format(exc))
+                    metrics.count('api_retry_sleep_seconds_total', delay)
                     sleep(delay)
 
     def _parse_api_response(self, data):
@@ -100,12 +213,47 @@ class CirrusAPI:
             raise CirrusAPIError(data['errors'])
         return data['data']
 
+    def _post_persisted(self, payload):
+        '''
+        Send query hash first, full query text only if server asks for it
+
+        If the server explicitly refuses persisted queries (or replies to
+        hash-only request with a client error) they are disabled and the plain
+        payload is sent instead. Other errors are returned as is
+        '''
+        short = persisted_query_payload(payload['query'], payload['variables'])
+        try:
+            answer = self._post(json=short)
+        except CirrusHTTPError as exc:
+            if not persisted_query_rejected(exc):
+                raise
+            answer = None
+        if answer is not None and persisted_query_not_found(answer):
+            return self._post(json=dict(short, query=payload['query']))
+        if answer is None or persisted_query_not_supported(answer):
+            log.debug('Persisted queries are not supported by API server, disabling them')
+            self.persisted_queries = False
+            answer = self._post(json=payload)
+        return answer
+
     def _post(self, **ka):
+        ka.setdefault('timeout', self.timeout)
         response = self._requests.post(self._url, **ka)
+        metrics.count('graphql_response_bytes_total', wire_size(response))
         if response.status_code != 200:
             raise CirrusHTTPError(response)
         return response.json()
 
+    def log_url(self, task_id, command):
+        '''Calculate URL for downloading the log of a single task command'''
+        return urljoin(self._url, '/v1/task/{task}/logs/{command}.log'.format(
+            task=quote(str(task_id)),
+            command=quote(command),
+        ))
+
     def get(self, *a, **ka):
         '''Perform GET request using API session'''
-        return self._requests.get(*a, **ka)
+        ka.setdefault('timeout', self.timeout)
+        metrics.count('log_requests_total')
+        with metrics.timer('log_request_seconds'):
+            return self._requests.get(*a, **ka)
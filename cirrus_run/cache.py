@@ -0,0 +1,154 @@
+'''
+Persistent local state: cached lookups and progress of running builds
+'''
+
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from time import time
+
+
+log = logging.getLogger(__name__)
+
+
+def write_json(path, data):
+    '''Replace file contents atomically'''
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class FileCache:
+    '''
+    Key-value storage in local directory, values expire after TTL (seconds)
+
+    Each key is stored in a separate JSON file which is replaced atomically,
+    so the cache may be shared by several processes running in parallel.
+    Any I/O error is treated as a cache miss
+    '''
+
+    def __init__(self, directory, ttl=7*24*60*60):
+        self.directory = directory
+        self.ttl = ttl
+
+    @classmethod
+    def default_directory(cls):
+        '''Platform specific location for cache files'''
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'cirrus-run')
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, '{}.json'.format(digest))
+
+    def get(self, key, ttl=None):
+        '''Return cached value or None'''
+        if ttl is None:
+            ttl = self.ttl
+        try:
+            with open(self._path(key)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('key') != key or record.get('timestamp', 0) + ttl < time():
+            return None
+        log.debug('Cache hit: %s', key)
+        return record.get('value')
+
+    def set(self, key, value):
+        '''Save value to cache'''
+        record = dict(key=key, value=value, timestamp=time())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_json(self._path(key), record)
+        except OSError as exc:
+            log.debug('Unable to write to cache: %s', exc)
+
+    def delete(self, key):
+        '''Remove value from cache'''
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class BuildIndex:
+    '''Remember which builds were created for which inputs'''
+
+    PENDING = 'pending'
+    SUCCESSFUL = 'successful'
+
+    def __init__(self, cache, ttl=60*60):
+        self.cache = cache
+        self.ttl = ttl
+
+    @staticmethod
+    def fingerprint(*inputs):
+        '''Content hash of build inputs'''
+        digest = hashlib.sha256()
+        for value in inputs:
+            value = str(value).encode()
+            digest.update(str(len(value)).encode() + b':' + value)
+        return digest.hexdigest()
+
+    def lookup(self, fingerprint):
+        '''Return dict with build_id and status of a matching build, or None'''
+        return self.cache.get(['build', fingerprint], ttl=self.ttl)
+
+    def record(self, fingerprint, build_id, status):
+        '''Save build for given inputs'''
+        self.cache.set(['build', fingerprint], dict(build_id=build_id, status=status))
+
+    def update(self, fingerprint, build_id, successful):
+        '''Save final build result, failed builds are not reused'''
+        if successful:
+            self.record(fingerprint, build_id, self.SUCCESSFUL)
+        else:
+            self.cache.delete(['build', fingerprint])
+
+
+class ResumeFile:
+    '''
+    Progress of running builds saved to a local file
+
+    Allows restarted process to continue waiting for the same builds and to
+    skip the part of build log that has already been printed
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.builds = json.load(f).get('builds', {})
+        except (OSError, ValueError, AttributeError):
+            self.builds = {}
+
+    def get(self, name):
+        '''Return dict with build_id and log offsets, or None'''
+        return self.builds.get(name)
+
+    def update(self, name, build_id, offsets=()):
+        '''Record build progress (call save() to persist it)'''
+        self.builds[name] = dict(build_id=build_id, offsets=list(offsets))
+
+    def save(self):
+        try:
+            write_json(self.path, dict(builds=self.builds))
+        except OSError as exc:
+            log.warning('Unable to save progress to %s: %s', self.path, exc)
+
+    def remove(self):
+        '''Forget saved progress'''
+        self.builds = {}
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
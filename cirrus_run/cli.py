@@ -6,19 +6,54 @@ Command line interface for cirrus-run
 import argparse
 import logging
 import os
+import re
 import sys
 import traceback
-from pprint import pformat
-
-from jinja2 import Template
+from functools import lru_cache
+from time import monotonic as time
 
 from . import CirrusAPI
+from . import metrics
+from .api import CirrusAPIError
+from .cache import BuildIndex, FileCache, ResumeFile
+from .logfiles import failure_excerpts, safe_filename, save_task_logs, tail_lines
+from .markers import MarkerScanner
+from .output import OUTPUT_FORMATS, TextOutput
+from .polling import AdaptivePolling
 from .throbber import ProgressBar
-from .queries import build_log, get_repo, create_build, wait_build, CirrusBuildError
+from .transform import minify_config
+from .validation import ConfigIssue, validate_config
+from .star import evaluate_config
+from .queries import (
+    build_log,
+    build_log_tasks,
+    build_tasks,
+    create_build,
+    get_tasks,
+    prefetch,
+    recent_build_duration,
+    rerun_tasks,
+    task_log,
+    wait_tasks,
+    watch_builds,
+    BuildFinished,
+    CirrusBuildError,
+    LogTail,
+    RepoLookup,
+    TaskEvent,
+    TaskStatusTracker,
+)
 
 log = logging.getLogger(__name__)
 
 
+CONFIG_EXTENSIONS = {'yml', 'yaml', 'j2', 'jinja', 'jinja2', 'star'}
+CONFIG_REFERENCES = re.compile(
+    r'''{%-?\s*(?:include|import|from|extends)\s+["']([^"']+)["']'''  # Jinja2 partials
+    r'''|\bload\(\s*["']([^"']+)["']'''  # Starlark modules
+)
+
+
 ENVIRONMENT = {
     'github': 'CIRRUS_GITHUB_REPO',
     'branch': 'CIRRUS_GITHUB_BRANCH',
@@ -27,90 +62,604 @@ ENVIRONMENT = {
     'timeout': 'CIRRUS_TIMEOUT',
     'show_log': 'CIRRUS_SHOW_BUILD_LOG',
     'flaky_markers': 'CIRRUS_FLAKY_MARKERS_FILE',
+    'flaky_retries': 'CIRRUS_FLAKY_RETRIES',
+    'log_concurrency': 'CIRRUS_LOG_CONCURRENCY',
+    'follow': 'CIRRUS_FOLLOW_BUILD_LOG',
+    'adaptive_polling': 'CIRRUS_ADAPTIVE_POLLING',
+    'polling_history': 'CIRRUS_POLLING_HISTORY',
+    'fail_fast': 'CIRRUS_FAIL_FAST',
+    'cancel_on_failure': 'CIRRUS_CANCEL_ON_FAILURE',
+    'repo_id': 'CIRRUS_REPO_ID',
+    'cache_dir': 'CIRRUS_CACHE_DIR',
+    'dedup': 'CIRRUS_DEDUP',
+    'dedup_ttl': 'CIRRUS_DEDUP_TTL',
+    'resume_file': 'CIRRUS_RESUME_FILE',
+    'persisted_queries': 'CIRRUS_PERSISTED_QUERIES',
+    'metrics_file': 'CIRRUS_METRICS_FILE',
+    'metrics_format': 'CIRRUS_METRICS_FORMAT',
+    'format': 'CIRRUS_OUTPUT_FORMAT',
+    'log_dir': 'CIRRUS_LOG_DIR',
+    'log_tail_lines': 'CIRRUS_LOG_TAIL_LINES',
+    'validate_only': 'CIRRUS_VALIDATE_ONLY',
+    'skip_validation': 'CIRRUS_SKIP_VALIDATION',
+    'minify_config': 'CIRRUS_MINIFY_CONFIG',
 }
 
 
 def main(*a, **ka):
     args = parse_args(*a, **ka)
     configure_logging(args.verbose)
-    log.debug('Parsed command line arguments:\n{}'.format(pformat(vars(args), indent=2)))
-    run(args)
+    if log.isEnabledFor(logging.DEBUG):
+        from pprint import pformat
+        log.debug('Parsed command line arguments:\n{}'.format(pformat(vars(args), indent=2)))
+    if not args.metrics_file:
+        return run(args)
+    registry = metrics.enable()
+    try:
+        with registry.timer('run_seconds'):
+            run(args)
+    finally:
+        metrics.disable()
+        try:
+            registry.save(args.metrics_file, args.metrics_format)
+        except OSError as exc:
+            log.error('Unable to save metrics to {}: {}'.format(args.metrics_file, exc))
+
+
+def run(args):
+    multiple = len(args.config) > 1
+    output = OUTPUT_FORMATS[args.format]()
+    jobs = [Job(path, multiple, output) for path in args.config]
 
+    resume = None
+    if args.resume_file:
+        resume = ResumeFile(args.resume_file)
+        for job in jobs:
+            saved = resume.get(job.config_path)
+            if saved:
+                job.attach, job.offsets = saved['build_id'], saved['offsets']
+    if args.attach:
+        jobs[0].attach = args.attach
 
-def run(args, retry_index=0):
-    config = read_config(args.config)
-    api = CirrusAPI(args.token)
-    repo_id = get_repo(api, args.owner, args.repo)
-    build_id = create_build(api, repo_id, args.branch, config)
-    build_url = 'https://cirrus-ci.com/build/{}'.format(build_id)
+    if args.validate_only or not args.skip_validation:
+        valid = validate(jobs, args)
+        if args.validate_only or not valid:
+            sys.exit(0 if valid else 2)
 
-    print('Build created: {}'.format(build_url))
-    with ProgressBar('' if args.verbose else '.'):
+    api = CirrusAPI(args.token,
+                    pool_size=max(args.log_concurrency, len(args.config)),
+                    persisted_queries=args.persisted_queries)
+    repo = RepoLookup(api, args.owner, args.repo, cache=open_cache(), repo_id=args.repo_id)
+    execute(api, repo, jobs, args, resume)
+    for retry_index in range(args.flaky_retries):
+        flaky = [job for job in jobs if job.flaky]
+        if not flaky:
+            break
+        rebuild = retry_tasks(api, flaky, args)
+        for job in rebuild:
+            job.output.flaky(job, 'rebuild')
+            job.reset()
+        if rebuild:
+            execute(api, repo, rebuild, args, resume)
+    if resume is not None:
+        resume.remove()
+    sys.exit(max(job.rc for job in jobs))
+
+
+def validate(jobs, args):
+    '''
+    Check configs of all jobs before any build is submitted, return True if there are no errors
+
+    Issues are reported if there are errors or if only validation was requested,
+    warnings are otherwise logged at info level
+    '''
+    valid = True
+    for job in jobs:
+        if job.attach:
+            continue
         try:
-            wait_build(api, build_id, abort=args.timeout*60)
-            rc, status, message = 0, 'successful', ''
-        except CirrusBuildError:
-            rc, status, message = 1, 'failed', ''
+            job.config = read_config(job.config_path)
         except Exception as exc:
-            rc, status, message = 2, 'error', '{exception}: {text}'.format(
-                                        exception=exc.__class__.__name__,
-                                        text=str(exc))
-
-    flaky = False
-    is_flaky = None
-    if args.show_build_log == 'always' \
-    or (args.show_build_log == 'failure' and rc != 0):
-        print('Build {}, see log below:'.format(status, build_url))
+            job.output.config_issues(job, [ConfigIssue(1, 1, '{}: {}'.format(exc.__class__.__name__, exc))])
+            valid = False
+            continue
+        issues = validate_config(job.config)
+        errors = [issue for issue in issues if issue.severity == 'error']
+        if errors or args.validate_only:
+            job.output.config_issues(job, issues)
+        else:
+            for issue in issues:
+                log.info('{}:{}'.format(job.config_path, issue))
+        valid = valid and not errors
+    return valid
+
+
+def execute(api, repo, jobs, args, resume=None):
+    '''
+    Create builds for all jobs, wait for them to finish and show build logs
+
+    If resume file is provided, build IDs and printed log offsets are saved to
+    it. Build log is then printed incrementally, skipping already printed parts
+    '''
+    index = None
+    if args.dedup:
+        cache = open_cache()
+        if cache is None:
+            log.warning('Build deduplication requires persistent cache, ignoring --dedup')
+        else:
+            index = BuildIndex(cache, ttl=args.dedup_ttl*60)
+
+    def create(job):
+        '''Submit build for a job, return (build ID, previous status) or (None, exception)'''
         try:
-            for chunk in build_log(api, build_id):
-                print(chunk)
-                if rc != 0 and args.flaky_markers and not flaky:
-                    if is_flaky is None:
-                        is_flaky = flaky_checker(args.flaky_markers)
-                    flaky = is_flaky(chunk)
+            return submit(job)
         except Exception as exc:
-            error = traceback.format_exc()
-            log.error(error)
-
-    print('Build {}: {}'.format(status, build_url))
-    if message:
-        print('  {}'.format(message))
-    if flaky and not retry_index:
-        print('Flaky build detected: "{}", retrying...'.format(flaky))
-        run(args, retry_index=retry_index+1)
-    else:
-        sys.exit(rc)
-
-
-def flaky_checker(markers_file):
-    '''Create a function that checks build output for flaky markers'''
-    markers = []
-    with open(markers_file) as f:
-        for line in f.read().splitlines():
-            if line.strip() and not line.startswith('#'):
-                markers.append(line)
-    log.debug('Loaded flaky build markers: %s', markers)
-    def is_flaky(build_output):
-        '''Check build output for presence of flaky markers'''
-        for marker in markers:
-            if marker in build_output:
-                log.debug("Flaky build detected. Marker found in build output: '%s'", marker)
-                return marker
+            log.debug(traceback.format_exc())
+            return None, exc
+
+    def submit(job):
+        if job.attach:
+            return job.attach, BuildIndex.PENDING
+        config = job.config if job.config is not None else read_config(job.config_path)
+        if args.minify_config:
+            config = compact_config(config)
+        if index is not None:
+            job.fingerprint = index.fingerprint(api._url, repo.id, args.branch, config)
+            previous = index.lookup(job.fingerprint)
+            if previous:
+                return previous['build_id'], previous['status']
+        repo_id = repo.id
+        try:
+            build_id = create_build(api, repo_id, args.branch, config)
+        except CirrusAPIError:
+            if not repo.invalidate(repo_id):
+                raise
+            log.warning('Cached repo ID was rejected by API, resolving it again')
+            build_id = create_build(api, repo.id, args.branch, config)
+        if index is not None:
+            index.record(job.fingerprint, build_id, BuildIndex.PENDING)
+        return build_id, None
+
+    builds = prefetch(create, jobs, concurrency=len(jobs))
+    for job, (build_id, previous) in zip(jobs, builds):
+        if isinstance(previous, Exception):  # other builds are still waited for
+            job.finish(previous)
+            continue
+        job.start(build_id, args)
+        if previous == BuildIndex.SUCCESSFUL:
+            job.finish()
+            job.output.build(job, 'reused')
+        elif previous == BuildIndex.PENDING:
+            job.output.build(job, 'attached')
         else:
-            return False
-    return is_flaky
+            job.output.build(job, 'created')
+    running = [job for job in jobs if job.rc is None]
+
+    def checkpoint():
+        if resume is None:
+            return
+        for job in jobs:
+            if job.build_id is None:
+                continue
+            resume.update(job.config_path, job.build_id, job.tail.state() if job.tail else job.offsets)
+        resume.save()
+    checkpoint()
+
+    follow_log = None
+    if args.follow:
+        for job in running:
+            job.tail = LogTail(api, job.build_id, offsets=job.offsets)
+        def follow_log():
+            for job in running:
+                if job.rc is None:
+                    job.follow(checkpoint)
+            checkpoint()
+
+    policy = None
+    if args.adaptive_polling:
+        expected = None
+        if args.polling_history and (args.follow or args.fail_fast):
+            log.info('Duration of recent builds is ignored with --follow or --fail-fast')
+        elif args.polling_history:
+            try:
+                expected = recent_build_duration(api, repo.id, args.branch)
+            except Exception as exc:
+                log.warning('Unable to estimate build duration: {}'.format(exc))
+        policy = AdaptivePolling(expected_duration=expected)
+
+    def report(job):
+        '''Show or save the log of finished build and print its result'''
+        reported.add(job)
+        if job.build_id is None:
+            job.output.result(job)
+            return
+        if args.log_dir and not job.tail:
+            try:
+                with metrics.timer('build_log_seconds'):
+                    job.save_logs(api, build_log_tasks(api, job.build_id), args)
+            except Exception as exc:
+                error = traceback.format_exc()
+                log.error(error)
+        elif not job.tail and (
+            args.show_build_log == 'always'
+            or (args.show_build_log == 'failure' and job.rc != 0)
+        ):
+            job.output.log_start(job)
+            if resume is not None:
+                job.tail = LogTail(api, job.build_id, offsets=job.offsets)
+                job.follow(checkpoint)
+                checkpoint()
+            else:
+                try:
+                    with metrics.timer('build_log_seconds'):
+                        job.show_log(build_log(api, job.build_id, concurrency=args.log_concurrency))
+                except Exception as exc:
+                    error = traceback.format_exc()
+                    log.error(error)
+        if job.rc == 0:
+            job.flaky = False
+
+        job.output.result(job)
+
+    reported = set()
+    waiting = {job.build_id: job for job in running}
+    with ProgressBar('' if args.verbose or args.follow or args.format != 'text' else '.') as progress:
+        try:
+            for event in watch_builds(api, list(waiting),
+                                      abort=args.timeout*60,
+                                      callback=follow_log,
+                                      policy=policy,
+                                      tasks=args.fail_fast or args.format != 'text',
+                                      fail_fast=args.fail_fast,
+                                      cancel=args.cancel_on_failure):
+                if isinstance(event, TaskEvent):
+                    log.info('Task {} ({}){}: {}'.format(event.name, event.task_id,
+                                                         waiting[event.build_id].label, event.status))
+                if not isinstance(event, BuildFinished):
+                    job = waiting[event.build_id]
+                    job.output.status(job, event)
+                    continue
+                job = waiting.pop(event.build_id)
+                job.finish(event.error)
+                if index is not None:
+                    index.update(job.fingerprint, job.build_id, job.rc == 0)
+                if job.tail:
+                    job.follow(checkpoint)
+                    checkpoint()
+                    job.output.log_end(job)
+                with progress.pause():
+                    report(job)  # other builds may still be running
+        except Exception as exc:
+            for job in waiting.values():
+                job.finish(exc)
+
+    for job in jobs:
+        if job not in reported:
+            report(job)
+
+
+def retry_tasks(api, jobs, args):
+    '''
+    Re-run failed tasks of flaky builds, wait for them and show their logs
+
+    Tasks that have passed are not executed again. Tasks that were still
+    running when the build was reported as failed (see --fail-fast) are waited
+    for along with re-executed ones. Return the jobs that have to be retried
+    by creating a new build instead (when failed tasks are unknown or Cirrus
+    API refuses to re-run them)
+    '''
+    rebuild = []
+    waiting = {}
+    for job in jobs:
+        unfinished = []
+        try:
+            if job.failed_tasks is None:
+                tasks = build_tasks(api, job.build_id)
+                job.failed_tasks = [task['id'] for task in tasks if task['status'] in TaskStatusTracker.FAILED]
+                unfinished = [task['id'] for task in tasks if task['status'] in TaskStatusTracker.RUNNING]
+            failed = job.failed_tasks
+            if not failed:
+                rebuild.append(job)
+                continue
+            if not set(failed) <= set(job.flaky_tasks):
+                job.output.flaky(job, 'none')
+                job.flaky = False
+                continue
+            job.output.flaky(job, 'rerun', failed)
+            task_ids = rerun_tasks(api, failed)
+        except Exception as exc:
+            log.warning('Unable to re-run flaky tasks: {}'.format(exc))
+            rebuild.append(job)
+            continue
+        task_ids = task_ids + unfinished
+        job.restart(task_ids)
+        waiting.update((task_id, job) for task_id in task_ids)
+
+    follow_log = None
+    if args.follow:
+        for job in set(waiting.values()):
+            job.tail = job.tail or LogTail(api, job.build_id, offsets=job.offsets)
+        def follow_log():
+            for job in set(waiting.values()):
+                job.follow()
+
+    results = {}
+    with ProgressBar('' if args.verbose or args.follow or args.format != 'text' else '.'):
+        try:
+            for task_id, error in wait_tasks(api, list(waiting),
+                                              abort=args.timeout*60,
+                                              callback=follow_log):
+                job = waiting.pop(task_id)
+                results[task_id] = error
+                if job.tail and job not in waiting.values():
+                    job.follow()
+                    job.output.log_end(job)
+        except Exception as exc:
+            for task_id in waiting:
+                results[task_id] = exc
+
+    for job in jobs:
+        if job.rerun_tasks is None:
+            continue
+        job.finish_tasks(results)
+        if args.log_dir and not job.tail:
+            try:
+                job.save_logs(api, get_tasks(api, job.rerun_tasks), args)
+            except Exception as exc:
+                error = traceback.format_exc()
+                log.error(error)
+        elif not job.tail and (
+            args.show_build_log == 'always'
+            or (args.show_build_log == 'failure' and job.rc != 0)
+        ):
+            job.output.log_start(job, 'Tasks')
+            try:
+                job.show_log(task_log(api, get_tasks(api, job.rerun_tasks), concurrency=args.log_concurrency))
+            except Exception as exc:
+                error = traceback.format_exc()
+                log.error(error)
+        if job.rc == 0:
+            job.flaky = False
+
+        job.output.result(job)
+    return rebuild
+
+
+class Job:
+    '''Single build executed by cirrus-run'''
+
+    CHECKPOINT_SIZE = 1024 * 1024  # characters of followed log between progress saves
+
+    def __init__(self, config_path, multiple=False, output=None):
+        if output is None:
+            output = TextOutput()
+        self.output = output
+        self.config_path = config_path
+        self.config = None
+        self.label = ' ({})'.format(config_path) if multiple else ''
+        self.prefix = '[{}] '.format(config_path) if multiple else ''
+        self.reset()
+
+    def reset(self):
+        '''Forget the results of previous build'''
+        self.build_id = None
+        self.started = None
+        self.attach = None
+        self.offsets = []
+        self.fingerprint = None
+        self.rc, self.status, self.message = None, None, ''
+        self.markers = None
+        self.failed_tasks = None
+        self.rerun_tasks = None
+        self.tail = None
+        self.add_prefix = None
+        self.forget_markers()
+
+    def forget_markers(self):
+        self.flaky = False
+        self.flaky_tasks = {}
+        self.scanners = {}
+
+    def start(self, build_id, args):
+        '''Attach job to newly created build'''
+        self.build_id = build_id
+        self.started = time()
+        self.add_prefix = line_prefixer(self.prefix)
+        if args.flaky_markers:
+            self.markers = flaky_markers(args.flaky_markers)
+
+    def restart(self, task_ids):
+        '''Wait for re-executed (and still running) tasks within the same build'''
+        self.rerun_tasks = list(task_ids)
+        self.rc, self.status, self.message = None, None, ''
+        self.forget_markers()
+
+    @property
+    def url(self):
+        if self.build_id is None:
+            return None
+        return 'https://cirrus-ci.com/build/{}'.format(self.build_id)
+
+    @property
+    def duration(self):
+        '''Seconds since the build was created or attached to'''
+        return time() - self.started if self.started is not None else None
+
+    def finish(self, error=None):
+        '''Record build result'''
+        if error is None:
+            self.rc, self.status, self.message = 0, 'successful', ''
+        elif isinstance(error, CirrusBuildError):
+            self.rc, self.status, self.message = 1, 'failed', ''
+        else:
+            self.rc, self.status, self.message = 2, 'error', '{exception}: {text}'.format(
+                                                    exception=error.__class__.__name__,
+                                                    text=str(error))
+
+    def finish_tasks(self, results):
+        '''Record result of re-executed tasks (a mapping of task ID to error)'''
+        errors = [results.get(task_id) for task_id in self.rerun_tasks]
+        self.failed_tasks = [task_id for task_id, error in zip(self.rerun_tasks, errors)
+                             if isinstance(error, CirrusBuildError)]
+        errors = [error for error in errors if error is not None]
+        errors.sort(key=lambda error: isinstance(error, CirrusBuildError))
+        self.finish(errors[0] if errors else None)
+
+    def show_log(self, chunks, flush=False):
+        '''Print build log and check output of each task for flaky markers'''
+        for chunk in chunks:
+            self.output.log(self, chunk, flush)
+            if self.markers is not None:
+                self.check_flaky(chunk)
+
+    def save_logs(self, api, tasks, args):
+        '''Save task logs to files, show summary and the end of failed command logs'''
+        directory = os.path.join(args.log_dir, safe_filename(str(self.build_id)))
+        callback = self.check_flaky if self.markers is not None else None
+        log_files = save_task_logs(api, tasks, directory, args.log_concurrency, callback)
+        self.output.log_files(self, directory, log_files)
+        if args.show_build_log != 'never':
+            for log_file in failure_excerpts(log_files):
+                self.output.log_excerpt(self, log_file, tail_lines(log_file.path, args.log_tail_lines))
+
+    def check_flaky(self, chunk):
+        '''Check a chunk of build log for flaky markers (safe to call for different commands in parallel)'''
+        task_id = getattr(chunk, 'task_id', None)
+        if task_id in self.flaky_tasks:
+            return
+        key = (task_id, getattr(chunk, 'command', None))
+        scanner = self.scanners.get(key)
+        if scanner is None:
+            scanner = self.scanners[key] = self.markers.copy()
+        marker = scanner.feed(chunk)
+        if marker is not None:
+            log.debug("Flaky task detected (%s). Marker found in build output: '%s'", task_id, marker)
+            self.flaky_tasks[task_id] = marker
+            self.flaky = self.flaky or marker
+
+    def follow(self, checkpoint=None):
+        '''
+        Print build log output that has appeared since previous call
+
+        Optional checkpoint callback saves progress: it is called after the
+        output of each command and after every CHECKPOINT_SIZE characters
+        '''
+        chunks = self.tail.poll()
+        if checkpoint is not None:
+            chunks = checkpoints(chunks, checkpoint, self.CHECKPOINT_SIZE)
+        try:
+            self.show_log(chunks, flush=True)
+        except Exception as exc:
+            log.error('Unable to follow build log: {}'.format(exc))
+
+
+def checkpoints(chunks, callback, size):
+    '''Pass log chunks through, call back when command changes or after every `size` characters'''
+    current = None
+    pending = 0
+    for chunk in chunks:
+        if not chunk.markup:
+            key = (chunk.task_id, chunk.command)
+            if pending and (key != current or pending >= size):
+                callback()
+                pending = 0
+            current = key
+        yield chunk  # resumes after the chunk was printed
+        if not chunk.markup:
+            pending += len(chunk)
+    if pending:
+        callback()
+
+
+def line_prefixer(prefix):
+    '''Create a function that prepends prefix to every line of text split into chunks'''
+    line_start = True
+    def add_prefix(chunk):
+        nonlocal line_start
+        if not prefix or not chunk:
+            return chunk
+        text = chunk.replace('\n', '\n' + prefix)
+        if line_start:
+            text = prefix + text
+        line_start = chunk.endswith('\n')
+        if line_start:
+            text = text[:-len(prefix)]
+        return text
+    return add_prefix
+
+
+def cache_directory():
+    '''Location of persistent cache, None if caching is disabled by setting it to empty value'''
+    return os.getenv(ENVIRONMENT['cache_dir'], FileCache.default_directory()) or None
+
+
+def open_cache():
+    '''Persistent cache for API lookups'''
+    directory = cache_directory()
+    if directory:
+        return FileCache(directory)
+
+
+@lru_cache(maxsize=None)
+def flaky_markers(markers_file):
+    '''Load flaky build markers once per process, see Job.check_flaky()'''
+    return MarkerScanner.from_file(markers_file)
 
 
 def read_config(path):
-    '''Load YAML config from file or Jinja2 template'''
-    with open(path) as config_file:
-        raw = config_file.read()
+    '''Load YAML config from file, Jinja2 template or Starlark script'''
     ext = os.path.splitext(path)[1].lower().lstrip('.')
-    if ext in {'j2', 'jinja', 'jinja2'}:
-        template = Template(raw)
+    if ext == 'star':
+        return evaluate_config(path, cache=open_cache())
+    elif ext in {'j2', 'jinja', 'jinja2'}:
+        path = os.path.abspath(path)
+        bytecode_dir = cache_directory()
+        if bytecode_dir:
+            bytecode_dir = os.path.join(bytecode_dir, 'jinja2')
+        environment = template_environment(os.path.dirname(path), bytecode_dir)
+        template = environment.get_template(os.path.basename(path))
         return template.render(os.environ)
     else:
-        return raw
+        with open(path) as config_file:
+            return config_file.read()
+
+
+@lru_cache(maxsize=None)
+def template_environment(directory, bytecode_dir=None):
+    '''
+    Jinja2 environment for templates from the given directory
+
+    Templates may include or import other templates relative to that
+    directory. Compiled templates are reused within the process and
+    (if bytecode_dir is provided) between processes
+    '''
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader  # only templates need Jinja2
+
+    bytecode_cache = None
+    if bytecode_dir:
+        try:
+            os.makedirs(bytecode_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+        except OSError as exc:
+            log.debug('Unable to use template bytecode cache: {}'.format(exc))
+    return Environment(
+        loader=FileSystemLoader(directory),
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def compact_config(config):
+    '''Minify config before submission, keep it as is if that is not possible'''
+    try:
+        compact = minify_config(config)
+    except Exception as exc:
+        log.warning('Unable to minify config, submitting it unchanged: {}'.format(exc))
+        return config
+    before, after = len(config.encode('utf-8')), len(compact.encode('utf-8'))
+    log.info('Config size: {} bytes, minified: {} bytes ({:.0%})'.format(before, after, after / max(before, 1)))
+    metrics.count('config_bytes_total', before, stage='rendered')
+    metrics.count('config_bytes_total', after, stage='minified')
+    return compact
 
 
 def fallback_config_path():
@@ -118,6 +667,7 @@ def fallback_config_path():
     paths = [
         '.cirrus.yml',
         '.cirrus.yml.j2',
+        '.cirrus.star',
     ]
     for path in paths:
         if os.path.isfile(path):
@@ -126,6 +676,34 @@ def fallback_config_path():
         return paths[0]
 
 
+def config_directory(path):
+    '''
+    List top-level configuration files in directory
+
+    Jinja2 partials and Starlark modules that are referenced by other files in
+    the same directory are skipped, so are Starlark scripts without main()
+    '''
+    configs = {}
+    for filename in sorted(os.listdir(path)):
+        ext = os.path.splitext(filename)[1].lower().lstrip('.')
+        filepath = os.path.join(path, filename)
+        if ext in CONFIG_EXTENSIONS and os.path.isfile(filepath):
+            try:
+                with open(filepath) as config_file:
+                    configs[filepath] = config_file.read()
+            except (OSError, UnicodeDecodeError):
+                configs[filepath] = ''
+    referenced = set()
+    for text in configs.values():
+        for match in CONFIG_REFERENCES.finditer(text):
+            referenced.add(os.path.normpath(os.path.join(path, match.group(1) or match.group(2))))
+    return [
+        filepath for filepath, text in configs.items()
+        if os.path.normpath(filepath) not in referenced
+        and not (filepath.lower().endswith('.star') and 'def main(' not in text)
+    ]
+
+
 def parse_args(*a, **ka):
     parser = argparse.ArgumentParser(
         description=(
@@ -136,13 +714,20 @@ def parse_args(*a, **ka):
     parser.add_argument(
         'config',
         metavar='CONFIG',
-        default=os.getenv(ENVIRONMENT['config'], fallback_config_path()),
-        nargs='?',
+        default=[os.getenv(ENVIRONMENT['config'], fallback_config_path())],
+        nargs='*',
         help=(
             'Path to YAML configuration file or Jinja2 template for such file. '
-            'Filenames ending with .j2 or .jinja2 are assumed to provide the templates. '
-            'All environment variables are available inside these templates. '
-            'Default value: ${} or .cirrus.yml or .cirrus.yml.j2'
+            'Filenames ending with .j2 or .jinja2 are assumed to provide the templates, '
+            '.star files are Starlark scripts that are evaluated locally. '
+            'All environment variables are available inside these templates, '
+            'other templates may be included or imported relative to template location. '
+            'Multiple paths may be provided to execute several builds at once, '
+            'directories are expanded to all configuration files they contain '
+            '(except for templates and modules included or loaded by other files). '
+            'Only local modules and the "env" of the builtin "cirrus" module are '
+            'available to Starlark scripts. '
+            'Default value: ${} or .cirrus.yml or .cirrus.yml.j2 or .cirrus.star'
         ).format(ENVIRONMENT['config']),
     )
     parser.add_argument(
@@ -177,6 +762,17 @@ def parse_args(*a, **ka):
             'Default value: ${} or master'
         ).format(ENVIRONMENT['branch']),
     )
+    parser.add_argument(
+        '--repo-id',
+        default=os.getenv(ENVIRONMENT['repo_id']),
+        metavar='ID',
+        help=(
+            'Internal Cirrus CI ID of the repo that will own the build. '
+            'Skips resolving the ID from --github value. '
+            'Resolved IDs are otherwise cached in ${} (if set to empty value caching is disabled). '
+            'Default value: ${}'
+        ).format(ENVIRONMENT['cache_dir'], ENVIRONMENT['repo_id']),
+    )
     parser.add_argument(
         '--owner',
         default='',
@@ -220,25 +816,266 @@ def parse_args(*a, **ka):
         metavar='FILE',
         help=(
             'Path to file that contains flaky build markers, one marker per line. '
-            'If any marker is found in Cirrus CI output for a failed build, '
-            'the build is retried once more. Default: ${}'
+            'Markers prefixed with "re:" are treated as regular expressions. '
+            'If markers are found in Cirrus CI output of all failed tasks, '
+            'these tasks are re-run within the same build (or the whole build '
+            'is retried if that is not possible). Default: ${}'
         ).format(ENVIRONMENT['flaky_markers']),
     )
+    parser.add_argument(
+        '--flaky-retries',
+        default=os.getenv(ENVIRONMENT['flaky_retries'], 1),
+        type=int,
+        metavar='N',
+        help=(
+            'Maximum number of times to retry flaky tasks. '
+            'Default value: ${} or 1'
+        ).format(ENVIRONMENT['flaky_retries']),
+    )
+    parser.add_argument(
+        '--log-concurrency',
+        default=os.getenv(ENVIRONMENT['log_concurrency'], 1),
+        type=int,
+        metavar='N',
+        help=(
+            'Number of command logs to download in parallel when printing build log. '
+            'Output order is not affected. Default value: ${} or 1'
+        ).format(ENVIRONMENT['log_concurrency']),
+    )
+    parser.add_argument(
+        '--log-dir',
+        default=os.getenv(ENVIRONMENT['log_dir']),
+        metavar='DIR',
+        help=(
+            'Save the log of each task command to a separate file in this directory '
+            'instead of printing it. Only a summary and the last lines of failed '
+            'command logs are printed. Default: ${}'
+        ).format(ENVIRONMENT['log_dir']),
+    )
+    parser.add_argument(
+        '--log-tail-lines',
+        default=os.getenv(ENVIRONMENT['log_tail_lines'], 20),
+        type=int,
+        metavar='N',
+        help=(
+            'Number of lines to show from the end of each failed command log '
+            'when --log-dir is used. Default value: ${} or 20'
+        ).format(ENVIRONMENT['log_tail_lines']),
+    )
+    parser.add_argument(
+        '--follow',
+        default=bool(os.getenv(ENVIRONMENT['follow'])),
+        action='store_true',
+        help=(
+            'Print build log incrementally while the build is running '
+            'instead of downloading it after the build has finished. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['follow']),
+    )
+    parser.add_argument(
+        '--adaptive-polling',
+        default=bool(os.getenv(ENVIRONMENT['adaptive_polling'])),
+        action='store_true',
+        help=(
+            'Check build status less often while it does not change. '
+            'Recommended when running many builds concurrently to avoid API rate limits. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['adaptive_polling']),
+    )
+    parser.add_argument(
+        '--polling-history',
+        default=bool(os.getenv(ENVIRONMENT['polling_history'])),
+        action='store_true',
+        help=(
+            'With --adaptive-polling, check build status even less often (up to once '
+            'in 5 minutes) until most of the median duration of recent builds on the '
+            'same branch has passed. Only useful when the branch is not shared with '
+            'unrelated builds, ignored with --follow and --fail-fast. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['polling_history']),
+    )
+    parser.add_argument(
+        '--fail-fast',
+        default=bool(os.getenv(ENVIRONMENT['fail_fast'])),
+        action='store_true',
+        help=(
+            'Check the status of individual tasks and report build failure as soon '
+            'as any task fails, without waiting for the rest of the build. '
+            'Not suitable for builds with tasks that are allowed to fail. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['fail_fast']),
+    )
+    parser.add_argument(
+        '--cancel-on-failure',
+        default=bool(os.getenv(ENVIRONMENT['cancel_on_failure'])),
+        action='store_true',
+        help=(
+            'Abort remaining tasks of a failed build (implies --fail-fast). '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['cancel_on_failure']),
+    )
+    parser.add_argument(
+        '--dedup',
+        default=bool(os.getenv(ENVIRONMENT['dedup'])),
+        action='store_true',
+        help=(
+            'Do not create a new build if an identical one (same rendered config, '
+            'repo and branch) was created recently: attach to it if it is still '
+            'running or reuse its result if it was successful. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['dedup']),
+    )
+    parser.add_argument(
+        '--no-dedup',
+        dest='dedup',
+        action='store_false',
+        help='Always create a new build, even if deduplication is enabled via environment',
+    )
+    parser.add_argument(
+        '--dedup-ttl',
+        default=os.getenv(ENVIRONMENT['dedup_ttl'], 60),
+        type=int,
+        metavar='MINUTES',
+        help=(
+            'How long (in minutes) the builds are remembered for deduplication. '
+            'Default value: ${} or 60'
+        ).format(ENVIRONMENT['dedup_ttl']),
+    )
+    parser.add_argument(
+        '--attach',
+        metavar='BUILD_ID',
+        help=(
+            'Wait for an existing build instead of creating a new one. '
+            'Only a single CONFIG may be provided'
+        ),
+    )
+    parser.add_argument(
+        '--resume-file',
+        default=os.getenv(ENVIRONMENT['resume_file']),
+        metavar='FILE',
+        help=(
+            'Save IDs of created builds and the amount of printed build log to this file. '
+            'If cirrus-run is restarted with the same file it continues '
+            'waiting for the same builds and prints only the remaining part of the log. '
+            'The file is removed after all builds finish. Default: ${}'
+        ).format(ENVIRONMENT['resume_file']),
+    )
+    parser.add_argument(
+        '--persisted-queries',
+        default=bool(os.getenv(ENVIRONMENT['persisted_queries'])),
+        action='store_true',
+        help=(
+            'Send GraphQL query hashes instead of full query text when API server '
+            'supports it (Automatic Persisted Queries). Falls back to regular '
+            'queries otherwise. Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['persisted_queries']),
+    )
+    parser.add_argument(
+        '--format',
+        default=os.getenv(ENVIRONMENT['format'], 'text'),
+        choices=set(OUTPUT_FORMATS),
+        type=str.lower,
+        help=(
+            'Output format: human readable text or JSON lines (one JSON object '
+            'per event: build created, status change, log chunk, result). '
+            'Default value: ${} or "text"'
+        ).format(ENVIRONMENT['format']),
+    )
+    parser.add_argument(
+        '--metrics-file',
+        default=os.getenv(ENVIRONMENT['metrics_file']),
+        metavar='FILE',
+        help=(
+            'Save API usage metrics (request counts and latencies by operation, '
+            'retries, bytes downloaded, time spent waiting) to this file on exit. '
+            'Default: ${}'
+        ).format(ENVIRONMENT['metrics_file']),
+    )
+    parser.add_argument(
+        '--metrics-format',
+        default=os.getenv(ENVIRONMENT['metrics_format'], 'json'),
+        choices={'json', 'prometheus'},
+        type=str.lower,
+        help=(
+            'Format of metrics file. Default value: ${} or "json"'
+        ).format(ENVIRONMENT['metrics_format']),
+    )
+    parser.add_argument(
+        '--minify-config',
+        default=bool(os.getenv(ENVIRONMENT['minify_config'])),
+        action='store_true',
+        help=(
+            'Submit config without comments and indentation, with repeated blocks '
+            'replaced by YAML aliases. Parsed config is not changed. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['minify_config']),
+    )
+    parser.add_argument(
+        '--validate-only',
+        default=bool(os.getenv(ENVIRONMENT['validate_only'])),
+        action='store_true',
+        help=(
+            'Check configuration files against the schema of Cirrus CI tasks and exit '
+            'without submitting any builds. API token and repo are not required. '
+            'Line numbers of Jinja2 templates refer to the rendered config. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['validate_only']),
+    )
+    parser.add_argument(
+        '--skip-validation',
+        default=bool(os.getenv(ENVIRONMENT['skip_validation'])),
+        action='store_true',
+        help=(
+            'Submit configuration to Cirrus CI without checking it locally first. '
+            'Default: enabled if ${} is not empty'
+        ).format(ENVIRONMENT['skip_validation']),
+    )
     args = parser.parse_args(*a, **ka)
 
-    if not args.token:
+    if not args.token and not args.validate_only:
         parser.error('API token is not defined')
 
-    if not args.github:
+    if not args.github and not args.repo_id and not args.validate_only:
         parser.error('GitHub repo is not defined')
 
-    repo_parts = args.github.split('/')
-    if len(repo_parts) != 2 or not all(repo_parts):
-        parser.error('invalid repo identifier: {}'.format(args.github))
-    args.owner, args.repo = repo_parts
+    if args.github:
+        repo_parts = args.github.split('/')
+        if len(repo_parts) != 2 or not all(repo_parts):
+            parser.error('invalid repo identifier: {}'.format(args.github))
+        args.owner, args.repo = repo_parts
+
+    configs = []
+    for path in args.config:
+        if os.path.isdir(path):
+            configs.extend(config_directory(path))
+        elif os.path.isfile(path) or args.attach:
+            configs.append(path)
+        else:
+            parser.error('config file not found: {}'.format(path))
+    if not configs:
+        parser.error('no config files found: {}'.format(' '.join(args.config)))
+    args.config = configs
+
+    if args.attach and len(args.config) > 1:
+        parser.error('--attach may be used with a single config only')
 
-    if not os.path.isfile(args.config):
-        parser.error('config file not found: {}'.format(args.config))
+    if args.log_dir and args.follow:
+        parser.error('--log-dir can not be used together with --follow')
+
+    if args.log_concurrency < 1:
+        parser.error('log concurrency must be a positive integer: {}'.format(args.log_concurrency))
+
+    if args.cancel_on_failure:
+        args.fail_fast = True
+
+    if args.flaky_retries < 0:
+        parser.error('number of flaky retries must not be negative: {}'.format(args.flaky_retries))
+
+    if args.flaky_markers:
+        try:
+            flaky_markers(args.flaky_markers)  # loaded once per process, see Job.start()
+        except (OSError, ValueError) as exc:
+            parser.error('unable to load flaky markers: {}'.format(exc))
 
     if args.flaky_markers and args.show_build_log == 'never':
         args.show_build_log = 'failure'
@@ -0,0 +1,99 @@
+'''
+Save build logs to local files instead of printing them
+'''
+
+
+import os
+import re
+
+from .queries import prefetch, stream_log, LogChunk, TaskStatusTracker
+
+
+FAILED_COMMANDS = {'FAILURE', 'ABORTED'}
+
+
+def save_task_logs(api, tasks, directory, concurrency=1, callback=None):
+    '''
+    Download the log of each task command into a separate file
+
+    Files are written while being downloaded, up to `concurrency` at once.
+    Optional callback receives every LogChunk (possibly from several threads,
+    but all chunks of a single command come from the same thread).
+    Return a list of LogFile objects in task/command order
+    '''
+    files = []
+    for task in tasks:
+        task_dir = os.path.join(directory, safe_filename('{}-{}'.format(task['name'], task['id'])))
+        for command in task['commands']:
+            path = os.path.join(task_dir, safe_filename(command['name']) + '.log')
+            files.append(LogFile(task, command, path))
+
+    def save(log_file):
+        os.makedirs(os.path.dirname(log_file.path), exist_ok=True)
+        url = api.log_url(log_file.task['id'], log_file.command['name'])
+        with open(log_file.path, 'w', encoding='utf-8') as f:
+            for text in stream_log(api, url):
+                f.write(text)
+                if callback is not None:
+                    callback(LogChunk(text, log_file.task, log_file.command))
+        return log_file
+
+    return list(prefetch(save, files, concurrency))
+
+
+class LogFile:
+    '''Log of a single task command saved to local file'''
+
+    def __init__(self, task, command, path):
+        self.task = task
+        self.command = command
+        self.path = path
+
+    @property
+    def failed(self):
+        '''True if the command (or its task, when command status is unknown) has failed'''
+        status = self.command.get('status')
+        if status:
+            return status in FAILED_COMMANDS
+        return self.task.get('status') in TaskStatusTracker.FAILED
+
+
+def failure_excerpts(log_files):
+    '''
+    Choose the log files to show for failed tasks
+
+    These are the failed commands or, if the failure can not be attributed
+    to a particular command, the last non-empty log of the failed task
+    '''
+    by_task = {}
+    for log_file in log_files:
+        by_task.setdefault(log_file.task['id'], []).append(log_file)
+    excerpts = []
+    for task_files in by_task.values():
+        if task_files[0].task.get('status') not in TaskStatusTracker.FAILED:
+            continue
+        failed = [log_file for log_file in task_files if log_file.failed]
+        if not failed:
+            failed = [log_file for log_file in task_files if os.path.getsize(log_file.path)][-1:]
+        excerpts.extend(failed)
+    return excerpts
+
+
+def tail_lines(path, count, block_size=8192):
+    '''Return last lines of text file, reading only as much as needed from its end'''
+    if count <= 0:
+        return []
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return data.decode('utf-8', errors='replace').splitlines()[-count:]
+
+
+def safe_filename(name):
+    '''Replace characters that are not safe to use in file names'''
+    return re.sub(r'[^\w.+-]+', '_', name).strip('._') or '_'
@@ -0,0 +1,123 @@
+'''
+Search streaming build output for flaky build markers
+'''
+
+
+import logging
+import re
+from copy import copy
+
+
+log = logging.getLogger(__name__)
+
+
+class MarkerScanner:
+    '''
+    Find any of the given markers in text that arrives in chunks
+
+    Plain text markers are combined into a single trie-shaped regular expression,
+    so the cost of scanning does not grow with the number of markers. Markers
+    prefixed with "re:" are treated as regular expressions and are compiled
+    separately (ValueError is raised for invalid ones). Tail of each chunk
+    is kept around to detect markers that straddle chunk boundaries.
+    '''
+
+    REGEX_PREFIX = 're:'
+    REGEX_OVERLAP = 4096  # characters
+
+    def __init__(self, markers):
+        self.literals = set()
+        self.regexes = []
+        for marker in markers:
+            if marker.startswith(self.REGEX_PREFIX):
+                self.regexes.append(compile_marker(marker))
+            elif marker:
+                self.literals.add(marker)
+        self.pattern = re.compile(trie_pattern(self.literals)) if self.literals else None
+
+        if self.regexes:
+            self.overlap = self.REGEX_OVERLAP
+        elif self.literals:
+            self.overlap = max(len(marker) for marker in self.literals) - 1
+        else:
+            self.overlap = 0
+        self.tail = ''
+
+    @classmethod
+    def from_file(cls, path):
+        '''Load markers from file: one marker per line, lines starting with # are ignored'''
+        markers = []
+        with open(path) as f:
+            for line in f.read().splitlines():
+                if line.strip() and not line.startswith('#'):
+                    markers.append(line)
+        log.debug('Loaded %s flaky build markers from %s', len(markers), path)
+        return cls(markers)
+
+    def feed(self, text):
+        '''
+        Scan next chunk of text
+
+        Return the marker that was found (for regular expressions - the marker
+        definition), or None
+        '''
+        if self.pattern is None and not self.regexes:
+            return None
+        buffer = self.tail + text
+        self.tail = buffer[-self.overlap:] if self.overlap else ''
+        if self.pattern is not None:
+            match = self.pattern.search(buffer)
+            if match:
+                return match.group()
+        for regex in self.regexes:
+            if regex.search(buffer):
+                return self.REGEX_PREFIX + regex.pattern
+        return None
+
+    def reset(self):
+        '''Forget any text seen before'''
+        self.tail = ''
+
+    def copy(self):
+        '''Create scanner for another stream of text, compiled markers are shared'''
+        scanner = copy(self)
+        scanner.reset()
+        return scanner
+
+
+def compile_marker(marker):
+    '''Compile "re:" marker, raise ValueError with marker definition if it is invalid'''
+    try:
+        return re.compile(marker[len(MarkerScanner.REGEX_PREFIX):])
+    except re.error as exc:
+        raise ValueError('invalid flaky marker {!r}: {}'.format(marker, exc))
+
+
+def trie_pattern(words):
+    '''Build regular expression that matches any of the words, with common prefixes merged'''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return _trie_regex(trie)
+
+
+def _trie_regex(node):
+    prefix = []
+    while len(node) == 1 and '' not in node:  # collapse linear chains without recursion
+        char, node = next(iter(node.items()))
+        prefix.append(re.escape(char))
+    terminal = '' in node
+    branches = [
+        re.escape(char) + _trie_regex(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ''.join(prefix)
+    pattern = '(?:{})'.format('|'.join(branches))
+    if terminal:
+        pattern += '?'
+    return ''.join(prefix) + pattern
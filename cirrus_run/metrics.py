@@ -0,0 +1,152 @@
+'''
+Instrumentation of API usage: counters and latency histograms
+
+Metrics are collected only after enable() has been called, otherwise every
+instrumentation call is a cheap no-op
+'''
+
+
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic as time
+
+
+PREFIX = 'cirrus_run_'
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+
+
+class Registry:
+    '''Storage for collected metrics, safe to use from several threads'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+    def count(self, name, value=1, **labels):
+        '''Increase counter'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        '''Record a single observation (usually seconds) in histogram'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = dict(count=0, sum=0, buckets=[0] * (len(self.buckets) + 1))
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['buckets'][bisect_left(self.buckets, value)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Measure execution time of the code block'''
+        time_start = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - time_start, **labels)
+
+    def summary(self):
+        '''Return all metrics as JSON serializable dict'''
+        with self.lock:
+            counters = [
+                dict(name=name, labels=dict(labels), value=value)
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            histograms = [
+                dict(name=name, labels=dict(labels), count=value['count'], sum=value['sum'],
+                     buckets=dict(zip([str(le) for le in self.buckets] + ['+Inf'], _cumulative(value['buckets']))))
+                for (name, labels), value in sorted(self.histograms.items())
+            ]
+        return dict(counters=counters, histograms=histograms)
+
+    def prometheus(self):
+        '''Return all metrics in Prometheus text exposition format'''
+        summary = self.summary()
+        lines = []
+        seen = set()
+        for counter in summary['counters']:
+            name = PREFIX + counter['name']
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, _labels(counter['labels']), counter['value']))
+        for histogram in summary['histograms']:
+            name = PREFIX + histogram['name']
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            for le, value in histogram['buckets'].items():
+                lines.append('{}_bucket{} {}'.format(name, _labels(dict(histogram['labels'], le=le)), value))
+            lines.append('{}_sum{} {}'.format(name, _labels(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, _labels(histogram['labels']), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path, format='json'):
+        '''Write metrics to file'''
+        with open(path, 'w') as f:
+            if format == 'prometheus':
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2)
+
+
+def _cumulative(values):
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels.items()
+    ))
+
+
+_registry = None
+
+
+def enable(registry=None):
+    '''Start collecting metrics, return the registry that receives them'''
+    global _registry
+    _registry = registry if registry is not None else Registry()
+    return _registry
+
+
+def disable():
+    '''Stop collecting metrics'''
+    global _registry
+    _registry = None
+
+
+def count(name, value=1, **labels):
+    if _registry is not None:
+        _registry.count(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if _registry is not None:
+        _registry.observe(name, value, **labels)
+
+
+@contextmanager
+def _not_measured():
+    yield
+
+
+def timer(name, **labels):
+    if _registry is not None:
+        return _registry.timer(name, **labels)
+    return _not_measured()
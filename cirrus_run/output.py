@@ -0,0 +1,147 @@
+'''
+Presentation of cirrus-run progress: human readable text or JSON lines
+'''
+
+
+import json
+import sys
+from datetime import datetime, timezone
+
+
+class TextOutput:
+    '''Human readable output'''
+
+    def build(self, job, action):
+        '''Build was created (or reused, or attached to)'''
+        print('Build {}: {}{}'.format(action, job.url, job.label))
+
+    def status(self, job, event):
+        '''Build or task status has changed (see queries.watch_builds)'''
+
+    def config_issues(self, job, issues):
+        '''Problems found in config by local validation (see validation.validate_config)'''
+        for issue in issues:
+            print('{}:{}'.format(job.config_path, issue))
+        if any(issue.severity == 'error' for issue in issues):
+            print('Config is invalid, build not submitted: {}'.format(job.config_path))
+        else:
+            print('Config is valid: {}'.format(job.config_path))
+
+    def log_start(self, job, subject='Build'):
+        print('{} {}{}, see log below:'.format(subject, job.status, job.label))
+
+    def log(self, job, chunk, flush=False):
+        print(job.add_prefix(chunk), end='', flush=flush)
+
+    def log_end(self, job):
+        '''Log that was being followed has ended'''
+        print()
+
+    def log_files(self, job, directory, log_files):
+        '''Build log was saved to files (see logfiles.save_task_logs)'''
+        print('Build {}{}, log saved to {}'.format(job.status, job.label, directory))
+        seen = set()
+        for log_file in log_files:
+            task = log_file.task
+            if task['id'] not in seen:
+                seen.add(task['id'])
+                print('  {}: {}'.format(task['name'], task.get('status', 'UNKNOWN')))
+
+    def log_excerpt(self, job, log_file, lines):
+        '''Last lines of the log of a failed command'''
+        print('\n## Task: {}, last {} lines of {}:'.format(log_file.task['name'], len(lines), log_file.path))
+        for line in lines:
+            print(job.add_prefix(line + '\n'), end='')
+
+    def flaky(self, job, action, tasks=()):
+        '''Flaky failure was detected, action is "rebuild", "rerun" or "none"'''
+        if action == 'rebuild':
+            print('Flaky build detected{}: "{}", retrying...'.format(job.label, job.flaky))
+        elif action == 'rerun':
+            print('Flaky build detected{}: "{}", re-running {} failed task(s)...'.format(
+                  job.label, job.flaky, len(tasks)))
+        else:
+            print('Flaky build detected{}: "{}", but other tasks have failed too, not retrying'.format(
+                  job.label, job.flaky))
+
+    def result(self, job):
+        print('Build {}: {}{}'.format(job.status, job.url or 'not created', job.label))
+        if job.message:
+            print('  {}'.format(job.message))
+
+
+class JsonOutput:
+    '''
+    One JSON object per line, written as soon as the event happens
+
+    Every record has "event", "time", "config" and "build_id" fields
+    '''
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, job, event, **fields):
+        record = dict(
+            event=event,
+            time=datetime.now(timezone.utc).isoformat(),
+            config=job.config_path,
+            build_id=job.build_id,
+        )
+        record.update(fields)
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+        stream.flush()
+
+    def build(self, job, action):
+        self.write(job, 'build', action=action, url=job.url)
+
+    def status(self, job, event):
+        task_id = getattr(event, 'task_id', None)
+        if task_id is None:
+            self.write(job, 'status', status=event.status, previous=event.previous)
+        else:
+            self.write(job, 'task_status', task_id=task_id, task=event.name,
+                       status=event.status, previous=event.previous)
+
+    def config_issues(self, job, issues):
+        self.write(job, 'config_issues', valid=not any(issue.severity == 'error' for issue in issues),
+                   issues=[dict(line=issue.line, column=issue.column, severity=issue.severity,
+                                message=issue.message) for issue in issues])
+
+    def log_start(self, job, subject='Build'):
+        pass
+
+    def log(self, job, chunk, flush=False):
+        if getattr(chunk, 'markup', False):
+            return
+        self.write(job, 'log', task_id=getattr(chunk, 'task_id', None), task=getattr(chunk, 'task_name', None),
+                   command=getattr(chunk, 'command', None), text=str(chunk))
+
+    def log_end(self, job):
+        pass
+
+    def log_files(self, job, directory, log_files):
+        files = [
+            dict(task_id=log_file.task['id'], task=log_file.task['name'], status=log_file.task.get('status'),
+                 command=log_file.command['name'], command_status=log_file.command.get('status'),
+                 path=log_file.path)
+            for log_file in log_files
+        ]
+        self.write(job, 'log_files', directory=directory, files=files)
+
+    def log_excerpt(self, job, log_file, lines):
+        self.write(job, 'log_excerpt', task_id=log_file.task['id'], task=log_file.task['name'],
+                   command=log_file.command['name'], path=log_file.path, lines=lines)
+
+    def flaky(self, job, action, tasks=()):
+        self.write(job, 'flaky', marker=job.flaky, action=action, tasks=list(tasks))
+
+    def result(self, job):
+        self.write(job, 'result', url=job.url, status=job.status, rc=job.rc, message=job.message,
+                   duration=job.duration)
+
+
+OUTPUT_FORMATS = {
+    'text': TextOutput,
+    'jsonl': JsonOutput,
+}
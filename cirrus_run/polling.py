@@ -0,0 +1,59 @@
+'''
+Policies that decide how often to check build status
+'''
+
+
+import random
+
+
+class PollingPolicy:
+    '''Check build status at fixed intervals'''
+
+    def __init__(self, delay=3):
+        self.delay = delay
+
+    def next_delay(self, status, changed, elapsed):
+        '''
+        Return number of seconds to sleep before next status check
+
+        status: last observed build status
+        changed: whether the status differs from the previous observation
+        elapsed: seconds since waiting has started
+        '''
+        return self.delay
+
+
+class AdaptivePolling(PollingPolicy):
+    '''
+    Back off exponentially while build status stays the same
+
+    Delay is reset to initial value whenever status changes. Random jitter
+    prevents many clients from polling the API in lockstep. If expected build
+    duration is known (e.g. from previous builds) status checks are made less
+    often until most of that time has passed, each sleep is limited to
+    max_expected_delay
+    '''
+
+    EXPECTED_FRACTION = 0.8
+
+    def __init__(self, delay=3, factor=1.5, max_delay=60, jitter=0.2,
+                 expected_duration=None, max_expected_delay=5*60, seed=None):
+        super().__init__(delay)
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.expected_duration = expected_duration
+        self.max_expected_delay = max_expected_delay
+        self.current = delay
+        self.random = random.Random(seed)
+
+    def next_delay(self, status, changed, elapsed):
+        if changed:
+            self.current = self.delay
+        else:
+            self.current = min(self.current * self.factor, self.max_delay)
+        delay = self.current * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        if self.expected_duration and status == 'EXECUTING':
+            expected_wait = self.expected_duration * self.EXPECTED_FRACTION - elapsed
+            delay = max(delay, min(expected_wait, self.max_expected_delay))
+        return delay
@@ -6,15 +6,124 @@ https://github.com/cirruslabs/cirrus-ci-web/blob/97d6ac7dbddb42aaa9736c4caab79cf
 '''
 
 
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from tempfile import SpooledTemporaryFile
+from threading import Lock
 from time import monotonic as time, sleep
+import codecs
 import logging
 
 from . import CirrusAPI
+from . import metrics
+from .polling import PollingPolicy
 
 
 log = logging.getLogger(__name__)
 
 
+LOG_CHUNK_SIZE = 64 * 1024  # bytes
+LOG_SPOOL_SIZE = 1024 * 1024  # bytes kept in memory per prefetched log
+
+
+GET_REPO = '''
+    query GetRepo($owner: String!, $repo: String!) {
+        ownerRepository(platform: "github", owner: $owner, name: $repo) {
+            id
+            name
+        }
+    }
+'''
+
+
+CREATE_BUILD = '''
+    mutation ScheduleCustomBuild($config: String!,
+                                 $repo: ID!,
+                                 $branch: String!,
+                                 $mutation_id: String!) {
+        createBuild(
+            input: {
+                repositoryId: $repo,
+                branch: $branch,
+                clientMutationId: $mutation_id,
+                configOverride: $config
+            }
+        ) {
+            build {
+                id
+                status
+            }
+        }
+    }
+'''
+
+
+GET_BUILD_LOG = '''
+    query GetBuildLog($build: ID!) {
+        build(id: $build) {
+            tasks {
+                id
+                name
+                commands {
+                    name
+                }
+            }
+        }
+    }
+'''
+
+
+GET_BUILD_LOG_STATUS = '''
+    query GetBuildLogStatus($build: ID!) {
+        build(id: $build) {
+            tasks {
+                id
+                name
+                status
+                commands {
+                    name
+                    status
+                }
+            }
+        }
+    }
+'''
+
+
+GET_BUILD_TASKS = '''
+    query GetBuildTasks($build: ID!) {
+        build(id: $build) {
+            tasks {
+                id
+                name
+                status
+            }
+        }
+    }
+'''
+
+
+ABORT_TASKS = '''
+    mutation AbortTasks($tasks: [ID!]!, $mutation_id: String!) {
+        batchAbort(input: {taskIds: $tasks, clientMutationId: $mutation_id}) {
+            clientMutationId
+        }
+    }
+'''
+
+
+RERUN_TASKS = '''
+    mutation RerunTasks($tasks: [ID!]!, $mutation_id: String!) {
+        batchReRun(input: {taskIds: $tasks, clientMutationId: $mutation_id}) {
+            newTasks {
+                id
+            }
+        }
+    }
+'''
+
+
 class CirrusQueryError(ValueError):
     '''Raised when query executes successfully but returns invalid data'''
 
@@ -29,21 +138,61 @@ class CirrusTimeoutError(RuntimeError):
 
 def get_repo(api: CirrusAPI, owner: str, repo: str) -> str:
     '''Get internal ID for GitHub repo'''
-    query = '''
-        query GetRepo($owner: String!, $repo: String!) {
-            ownerRepository(platform: "github", owner: $owner, name: $repo) {
-                id
-                name
-            }
-        }
-    '''
     params = dict(owner=owner, repo=repo)
-    reply = api(query, params)
+    reply = api(GET_REPO, params)
     if reply['ownerRepository']:
         return reply['ownerRepository']['id']
     raise CirrusQueryError('repo not found: {}/{}'.format(owner, repo))
 
 
+class RepoLookup:
+    '''
+    Resolve internal ID for GitHub repo once per process
+
+    Resolved IDs are saved to persistent cache (optional). If cached ID turns
+    out to be wrong, invalidate() drops it so that it will be resolved again
+    '''
+
+    def __init__(self, api: CirrusAPI, owner: str, repo: str, cache=None, repo_id=None):
+        self.api = api
+        self.owner = owner
+        self.repo = repo
+        self.cache = cache
+        self.key = ['repo', 'github', owner, repo, api._url]
+        self._id = repo_id
+        self._from_cache = False
+        self._lock = Lock()
+
+    @property
+    def id(self):
+        with self._lock:
+            if self._id is None and self.cache is not None:
+                self._id = self.cache.get(self.key)
+                self._from_cache = self._id is not None
+            if self._id is None:
+                self._id = get_repo(self.api, self.owner, self.repo)
+                if self.cache is not None:
+                    self.cache.set(self.key, self._id)
+            return self._id
+
+    def invalidate(self, repo_id):
+        '''
+        Forget repo ID if it was loaded from cache
+
+        Return True if the next lookup may produce a different value
+        '''
+        with self._lock:
+            if self._id != repo_id:
+                return True  # already invalidated by another thread
+            if not self._from_cache:
+                return False
+            log.debug('Invalidating cached repo ID: {}'.format(repo_id))
+            self.cache.delete(self.key)
+            self._id = None
+            self._from_cache = False
+            return True
+
+
 def create_build(api: CirrusAPI,
                  repo_id: str,
                  repo_branch: str = 'master',
@@ -53,29 +202,9 @@ def create_build(api: CirrusAPI,
 
     Return build ID
     '''
-    query = '''
-        mutation ScheduleCustomBuild($config: String!,
-                                     $repo: ID!,
-                                     $branch: String!,
-                                     $mutation_id: String!) {
-            createBuild(
-                input: {
-                    repositoryId: $repo,
-                    branch: $branch,
-                    clientMutationId: $mutation_id,
-                    configOverride: $config
-                }
-            ) {
-                build {
-                    id
-                    status
-                }
-            }
-        }
-    '''
     mutation_id = 'cirrus-run job {}'.format(int(time()))
     answer = api(
-        query=query,
+        query=CREATE_BUILD,
         params=dict(
             repo=repo_id,
             branch=repo_branch,
@@ -85,67 +214,642 @@ def create_build(api: CirrusAPI,
     return answer['createBuild']['build']['id']
 
 
-def wait_build(api, build_id: str, delay=3, abort=60*60):
-    '''Wait until build finishes'''
-    ERROR_CONFIRM_TIMES = 3
+def build_tasks(api, build_id: str):
+    '''Return a list of build tasks (dicts with id, name and status)'''
+    response = api(GET_BUILD_TASKS, dict(build=build_id))
+    return response['build']['tasks']
 
-    query = '''
-        query GetBuild($build: ID!) {
-            build(id: $build) {
-                status
-            }
-        }
+
+def build_log_tasks(api, build_id: str):
+    '''Return a list of build tasks (dicts with id, name, status and commands with their statuses)'''
+    response = api(GET_BUILD_LOG_STATUS, dict(build=build_id))
+    return response['build']['tasks']
+
+
+def get_tasks(api, task_ids, batch_size=50):
+    '''Return a list of tasks (dicts with id, name, status and commands) in the same order as IDs'''
+    tasks = {}
+    field = 'task(id: ${alias}) {{ id name status commands {{ name status }} }}'
+    for query, params in aliased_queries('GetTasksLog', field, task_ids, batch_size):
+        response = api(query, params)
+        for alias, task_id in params.items():
+            tasks[task_id] = response[alias]
+    return [tasks[task_id] for task_id in task_ids]
+
+
+def rerun_tasks(api, task_ids):
     '''
-    params = dict(build=build_id)
+    Execute specified tasks once again within the same build
+
+    Return IDs of newly created tasks
+    '''
+    mutation_id = 'cirrus-run rerun {}'.format(int(time()))
+    answer = api(RERUN_TASKS, dict(tasks=list(task_ids), mutation_id=mutation_id))
+    return [task['id'] for task in answer['batchReRun']['newTasks']]
 
-    errors_confirmed = 0
+
+def abort_tasks(api, task_ids):
+    '''Cancel execution of specified tasks'''
+    mutation_id = 'cirrus-run abort {}'.format(int(time()))
+    api(ABORT_TASKS, dict(tasks=list(task_ids), mutation_id=mutation_id))
+
+
+def wait_build(api, build_id: str, delay=3, abort=60*60, callback=None, policy=None):
+    '''
+    Wait until build finishes
+
+    Polling interval is chosen by policy object (fixed delay by default).
+    Optional callback is invoked without arguments after each status check
+    '''
+    for event in watch_build(api, build_id, delay, abort, callback, policy, tasks=False):
+        if isinstance(event, BuildFinished) and event.error is not None:
+            raise event.error
+    return True
+
+
+def wait_builds(api, build_ids, delay=3, abort=60*60, callback=None, policy=None,
+                fail_fast=False, cancel=False, on_task=None):
+    '''
+    Wait until several builds finish, checking all of them on each iteration
+
+    Yield (build_id, error) tuples as builds finish. Error is None for
+    successful builds, otherwise it is an exception instance describing the
+    failure (CirrusBuildError, CirrusTimeoutError, etc)
+
+    Optional on_task callback receives TaskEvent for every observed task status
+    change, see watch_builds() for other arguments
+    '''
+    tasks = fail_fast or on_task is not None
+    for event in watch_builds(api, build_ids, delay, abort, callback, policy, tasks, fail_fast, cancel):
+        if isinstance(event, BuildFinished):
+            yield event.build_id, event.error
+        elif isinstance(event, TaskEvent) and on_task is not None:
+            on_task(event)
+
+
+def watch_build(api, build_id: str, delay=3, abort=60*60, callback=None, policy=None, tasks=True):
+    '''
+    Yield status transition events of a single build, see watch_builds()
+
+    Last event is always BuildFinished
+    '''
+    yield from watch_builds(api, [build_id], delay, abort, callback, policy, tasks)
+
+
+def watch_builds(api, build_ids, delay=3, abort=60*60, callback=None, policy=None,
+                 tasks=True, fail_fast=False, cancel=False):
+    '''
+    Yield status transition events until all builds finish
+
+    Events are BuildEvent (build status has changed), TaskEvent (task status
+    has changed, only if tasks are being watched) and BuildFinished (carries
+    the same error as wait_builds() would report). Repeated observations of
+    the same status do not produce events.
+
+    If fail_fast is set, build is considered failed as soon as any of its tasks
+    fails (without waiting for other tasks and without repeated confirmation);
+    with cancel the tasks that are still running are aborted then
+    '''
+    events = []
+    builds = {}
+    watcher = TaskWatcher(fail_fast, on_task=events.append) if tasks or fail_fast else None
+    waiter = BuildWaiter(build_ids, delay, policy, tracker=FailFastTracker if fail_fast else None)
+
+    def statuses(ids):
+        if watcher is None:
+            observed = build_statuses(api, ids)
+        else:
+            observed = watcher.update(build_task_statuses(api, ids))
+            if watcher.changed:
+                waiter.notify_change()  # task transitions reset polling backoff
+        for build_id, status in observed.items():
+            previous = builds.get(build_id)
+            if status != previous:
+                builds[build_id] = status
+                events.append(BuildEvent(build_id, status, previous, _now()))
+        return observed
+
+    def report(finished):
+        yield from events
+        events.clear()
+        for build_id, error in finished:
+            running = watcher.running.pop(build_id, None) if watcher else None
+            if cancel and running and isinstance(error, CirrusBuildError):
+                log.info('Aborting remaining tasks of build {}: {}'.format(build_id, running))
+                try:
+                    abort_tasks(api, running)
+                except Exception as exc:
+                    log.warning('Unable to abort tasks of build {}: {}'.format(build_id, exc))
+            yield BuildFinished(build_id, builds.get(build_id), _now(), error)
+
+    yield from _wait(waiter, statuses, abort, callback, report)
+
+
+def wait_tasks(api, task_ids, delay=3, abort=60*60, callback=None, policy=None):
+    '''
+    Wait until several tasks finish
+
+    Yield (task_id, error) tuples as tasks finish, see wait_builds()
+    '''
+    waiter = BuildWaiter(task_ids, delay, policy, tracker=TaskStatusTracker)
+    yield from _wait(waiter, lambda ids: task_statuses(api, ids), abort, callback)
+
+
+def _wait(waiter, statuses, abort, callback, report=iter):
     time_start = time()
-    while time() < time_start + abort:
-        response = api(query, params)
-        status = response['build']['status']
-        log.info('build {}: {}'.format(build_id, status))
-        if status in {'COMPLETED'}:
-            return True
-        if status in {'CREATED', 'TRIGGERED', 'EXECUTING'}:
-            errors_confirmed = 0
+    while waiter.pending:
+        if time() >= time_start + abort:
+            yield from report(waiter.timeout())
+            return
+        observed = statuses(waiter.pending)
+        if callback is not None:
+            callback()
+        yield from report(waiter.update(observed))
+        if waiter.pending:
+            delay = waiter.next_delay(time() - time_start)
+            metrics.count('wait_sleep_seconds_total', delay)
             sleep(delay)
-            continue
-        if status in {'NEEDS_APPROVAL', 'FAILED', 'ABORTED', 'ERRORED'}:
-            errors_confirmed += 1
-            if errors_confirmed < ERROR_CONFIRM_TIMES:
-                sleep(2 * delay / (ERROR_CONFIRM_TIMES - 1))
-                continue
-            else:
-                raise CirrusBuildError('build {} was terminated: {}'.format(build_id, status))
-        raise ValueError('build {} returned unknown status: {}'.format(build_id, status))
-    raise CirrusTimeoutError('build {} timed out'.format(build_id))
 
 
-def build_log(api, build_id):
-    '''Yield build log in chunks of text'''
+class BuildWaiter:
+    '''Track the state of several builds (or tasks) that are being waited on'''
+
+    def __init__(self, build_ids, delay=3, policy=None, tracker=None):
+        if policy is None:
+            policy = PollingPolicy(delay)
+        if tracker is None:
+            tracker = BuildStatusTracker
+        self.policy = policy
+        self.tracker = tracker
+        self.trackers = {build_id: tracker(build_id) for build_id in build_ids}
+        self.changed = False
+        self.notified = False
+
+    @property
+    def pending(self):
+        '''IDs of builds that have not finished yet'''
+        return list(self.trackers)
+
+    def update(self, statuses):
+        '''Record observed statuses, return (build_id, error) for finished builds'''
+        finished = []
+        self.changed, self.notified = self.notified, False
+        for build_id, status in statuses.items():
+            tracker = self.trackers[build_id]
+            try:
+                done, error = tracker.update(status), None
+            except (CirrusBuildError, ValueError) as exc:
+                done, error = True, exc
+            self.changed = self.changed or tracker.changed
+            if done:
+                del self.trackers[build_id]
+                finished.append((build_id, error))
+        return finished
+
+    def notify_change(self):
+        '''Something within the builds (e.g. a task) has changed, next update counts as a change'''
+        self.notified = True
+
+    def timeout(self):
+        '''Give up on all pending builds'''
+        finished = [
+            (build_id, CirrusTimeoutError('{} {} timed out'.format(self.tracker.KIND, build_id)))
+            for build_id in self.trackers
+        ]
+        self.trackers.clear()
+        return finished
+
+    def next_delay(self, elapsed):
+        '''Seconds to wait before next status check'''
+        trackers = self.trackers.values()
+        if any(tracker.errors_confirmed for tracker in trackers):
+            return 2 * self.policy.delay / (self.tracker.ERROR_CONFIRM_TIMES - 1)
+        running = [tracker.status for tracker in trackers]
+        status = 'EXECUTING' if 'EXECUTING' in running else running[0]
+        return self.policy.next_delay(status, self.changed, elapsed)
+
+
+class BuildStatusTracker:
+    '''
+    Interpret consecutive status observations of a single build
+
+    Failure statuses are reported only after being observed several times in a
+    row, because API is known to report them erroneously for preempted
+    instances that are later restarted
+    '''
+
+    KIND = 'build'
+    ERROR_CONFIRM_TIMES = 3
+    SUCCESSFUL = {'COMPLETED'}
+    RUNNING = {'CREATED', 'TRIGGERED', 'EXECUTING'}
+    FAILED = {'NEEDS_APPROVAL', 'FAILED', 'ABORTED', 'ERRORED'}
+
+    def __init__(self, build_id):
+        self.build_id = build_id
+        self.status = None
+        self.changed = False
+        self.errors_confirmed = 0
+
+    def update(self, status):
+        '''
+        Record next status observation
+
+        Return True if build has completed successfully, False if it needs to
+        be checked again. Raise CirrusBuildError when failure is confirmed
+        '''
+        log.info('{} {}: {}'.format(self.KIND, self.build_id, status))
+        self.changed, self.status = status != self.status, status
+        if status in self.SUCCESSFUL:
+            return True
+        if status in self.RUNNING:
+            self.errors_confirmed = 0
+            return False
+        if status in self.FAILED:
+            self.errors_confirmed += 1
+            if self.errors_confirmed < self.ERROR_CONFIRM_TIMES:
+                return False
+            raise CirrusBuildError('{} {} was terminated: {}'.format(self.KIND, self.build_id, status))
+        raise ValueError('{} {} returned unknown status: {}'.format(self.KIND, self.build_id, status))
+
+
+class FailFastTracker(BuildStatusTracker):
+    '''Report build failure on first observation, see TaskWatcher'''
+
+    ERROR_CONFIRM_TIMES = 1
+
+
+class TaskStatusTracker(BuildStatusTracker):
+    '''Interpret consecutive status observations of a single task'''
+
+    KIND = 'task'
+    ERROR_CONFIRM_TIMES = 1
+    SUCCESSFUL = {'COMPLETED', 'SKIPPED'}
+    RUNNING = {'CREATED', 'TRIGGERED', 'SCHEDULED', 'EXECUTING', 'PAUSED'}
+    FAILED = {'FAILED', 'ABORTED'}
+
+
+BuildEvent = namedtuple('BuildEvent', 'build_id status previous timestamp')
+BuildFinished = namedtuple('BuildFinished', 'build_id status timestamp error')
+TaskEvent = namedtuple('TaskEvent', 'build_id task_id name status previous timestamp')
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class TaskWatcher:
+    '''
+    Derive build statuses from statuses of individual tasks
+
+    Every task status change is reported to on_task callback as TaskEvent
+    (previous status is None for tasks that were not seen before). In fail-fast
+    mode a build with any failed task is reported as FAILED right away
+    '''
+
+    def __init__(self, fail_fast=False, on_task=None):
+        self.fail_fast = fail_fast
+        self.on_task = on_task
+        self.tasks = {}
+        self.running = {}
+        self.changed = False
+
+    def update(self, builds):
+        '''
+        Process build_task_statuses() output, return a mapping of build ID to its status
+
+        Sets `changed` attribute if any task status differs from the previous observation
+        '''
+        statuses = {}
+        self.changed = False
+        for build_id, build in builds.items():
+            status = build['status']
+            running = []
+            for task in build['tasks']:
+                previous = self.tasks.get(task['id'])
+                self.tasks[task['id']] = task['status']
+                if task['status'] != previous:
+                    self.changed = True
+                if task['status'] != previous and self.on_task is not None:
+                    self.on_task(TaskEvent(build_id, task['id'], task['name'], task['status'], previous, _now()))
+                if task['status'] in TaskStatusTracker.RUNNING:
+                    running.append(task['id'])
+                elif self.fail_fast and task['status'] in TaskStatusTracker.FAILED \
+                        and status not in BuildStatusTracker.FAILED:
+                    log.info('Task {} ({}) has failed: {}'.format(task['id'], task['name'], task['status']))
+                    status = 'FAILED'
+            self.running[build_id] = running
+            statuses[build_id] = status
+        return statuses
+
+
+def build_task_statuses(api, build_ids, batch_size=50):
+    '''Return a mapping of build ID to a dict with build status and its tasks (id, name, status)'''
+    builds = {}
+    field = 'build(id: ${alias}) {{ status tasks {{ id name status }} }}'
+    for query, params in aliased_queries('GetBuildsTasks', field, build_ids, batch_size):
+        response = api(query, params)
+        for alias, build_id in params.items():
+            builds[build_id] = response[alias]
+    return builds
+
+
+def build_statuses(api, build_ids, batch_size=50):
+    '''
+    Return a mapping of build ID to its current status
+
+    Lookups for several builds are merged into a single GraphQL query
+    (using field aliases), up to batch_size builds per request
+    '''
+    return _statuses(api, build_ids, batch_size, 'build')
+
+
+def task_statuses(api, task_ids, batch_size=50):
+    '''Return a mapping of task ID to its current status'''
+    return _statuses(api, task_ids, batch_size, 'task')
+
+
+def _statuses(api, ids, batch_size, field):
+    statuses = {}
+    for query, params in status_queries(ids, batch_size, field):
+        response = api(query, params)
+        for alias, object_id in params.items():
+            statuses[object_id] = response[alias]['status']
+    return statuses
+
+
+def status_queries(ids, batch_size=50, field='build'):
+    '''Yield (query, params) for batched status lookup of builds or tasks'''
+    return aliased_queries(
+        'Get{}s'.format(field.capitalize()),
+        '{field}(id: ${{alias}}) {{{{ status }}}}'.format(field=field),
+        ids,
+        batch_size,
+    )
+
+
+def aliased_queries(name, field, ids, batch_size=50):
+    '''
+    Yield (query, params) that request the same field for many IDs at once
+
+    Field template may refer to {alias} which is also the name of query
+    variable holding the ID
+    '''
+    ids = list(ids)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        aliases = ['b{}'.format(index) for index in range(len(batch))]
+        query = 'query {name}({variables}) {{\n{fields}\n}}'.format(
+            name=name,
+            variables=', '.join('${}: ID!'.format(alias) for alias in aliases),
+            fields='\n'.join(
+                '    {alias}: {field}'.format(alias=alias, field=field.format(alias=alias))
+                for alias in aliases
+            ),
+        )
+        yield query, dict(zip(aliases, batch))
+
+
+def recent_build_duration(api, repo_id: str, repo_branch: str = 'master', count=10):
+    '''
+    Estimate build duration from recent successful builds on the same branch
+
+    Return median wall clock duration in seconds or None if there is no history
+    '''
     query = '''
-        query GetBuildLog($build: ID!) {
-            build(id: $build) {
-                tasks {
-                    id
-                    name
-                    commands {
-                        name
+        query GetRecentBuilds($repo: ID!, $branch: String!, $count: Int!) {
+            repository(id: $repo) {
+                builds(last: $count, branch: $branch) {
+                    edges {
+                        node {
+                            status
+                            clockDurationInSeconds
+                        }
                     }
                 }
             }
         }
     '''
-    params = dict(build=build_id)
-    url_template = 'https://api.cirrus-ci.com/v1/task/{task[id]}/logs/{command[name]}.log'
+    params = dict(repo=repo_id, branch=repo_branch, count=count)
     response = api(query, params)
-    for task in response['build']['tasks']:
-        yield '\n## Task: {task[name]}'.format(**locals())
+    if not response['repository']:
+        return None
+    durations = sorted(
+        edge['node']['clockDurationInSeconds']
+        for edge in response['repository']['builds']['edges']
+        if edge['node']['status'] == 'COMPLETED'
+        and edge['node']['clockDurationInSeconds']
+    )
+    if not durations:
+        return None
+    return durations[len(durations) // 2]
+
+
+def build_log(api, build_id, concurrency=1):
+    '''
+    Yield build log in chunks of text
+
+    Command logs are streamed without loading them into memory as a whole.
+    Up to `concurrency` logs are downloaded in parallel (prefetched logs are
+    spooled to temporary files), chunks are always yielded in task/command order
+    '''
+    params = dict(build=build_id)
+    response = api(GET_BUILD_LOG, params)
+    yield from task_log(api, response['build']['tasks'], concurrency)
+
+
+def task_log(api, tasks, concurrency=1):
+    '''
+    Yield log of the given tasks in chunks of text (LogChunk instances)
+
+    Each task is a dict with id, name and commands, see build_log()
+    '''
+    urls = []
+    for task in tasks:
+        for command in task['commands']:
+            urls.append(api.log_url(task['id'], command['name']))
+    if concurrency > 1:
+        fetch = lambda url: _spool_log(api, url)
+    else:
+        fetch = lambda url: stream_log(api, url)
+    logs = prefetch(fetch, urls, concurrency)
+
+    for task in tasks:
+        yield LogChunk('\n## Task: {task[name]}\n'.format(**locals()), task, markup=True)
         for command in task['commands']:
-            yield '\n## Task instruction: {command[name]}'.format(**locals())
-            url = url_template.format(**locals())
-            log = api.get(url)
-            if log.status_code == 200:
-                yield log.text
+            yield LogChunk('\n## Task instruction: {command[name]}\n'.format(**locals()), task, command, markup=True)
+            for text in next(logs):
+                yield LogChunk(text, task, command)
+            yield LogChunk('\n', task, command, markup=True)
+
+
+class LogChunk(str):
+    '''
+    Piece of build log text that remembers which task and command it came from
+
+    Markup chunks (headers and separators) are added by cirrus-run and are not
+    a part of the original log
+    '''
+
+    def __new__(cls, text, task=None, command=None, markup=False):
+        chunk = super().__new__(cls, text)
+        chunk.task_id = task['id'] if task else None
+        chunk.task_name = task['name'] if task else None
+        chunk.command = command['name'] if command else None
+        chunk.markup = markup
+        return chunk
+
+
+def stream_log(api, url):
+    '''Yield text chunks of a single command log as they are downloaded'''
+    with api.get(url, stream=True) as response:
+        if response.status_code != 200:
+            yield 'Unable to fetch url: {}'.format(url)
+            return
+        decoder = _log_decoder(response)
+        for data in _log_content(response):
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+
+def _log_content(response):
+    '''Iterate over decompressed log content, count bytes received from the network'''
+    received = 0
+    for data in response.iter_content(LOG_CHUNK_SIZE):
+        received = _count_log_bytes(response, received, len(data))
+        yield data
+    _count_log_bytes(response, received, 0)
+
+
+def _count_log_bytes(response, received, size):
+    try:
+        position = int(response.raw.tell())  # compressed bytes read so far
+    except (AttributeError, TypeError, ValueError):
+        position = received + size
+    if position > received:
+        metrics.count('log_bytes_total', position - received)
+    return max(position, received)
+
+
+def _log_decoder(response):
+    '''Incremental decoder for log text (UTF-8 unless server says otherwise)'''
+    encoding = 'utf-8'
+    if 'charset' in response.headers.get('Content-Type', ''):
+        encoding = response.encoding
+    return codecs.getincrementaldecoder(encoding)(errors='replace')
+
+
+def _spool_log(api, url):
+    '''Download a single command log into temporary storage'''
+    spool = SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE, mode='w+', encoding='utf-8')
+    for chunk in stream_log(api, url):
+        spool.write(chunk)
+    spool.seek(0)
+    return _read_spool(spool)
+
+
+def _read_spool(spool):
+    '''Yield text chunks from temporary storage, then discard it'''
+    with spool:
+        while True:
+            chunk = spool.read(LOG_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def prefetch(function, items, concurrency=1):
+    '''
+    Lazy equivalent of map() which evaluates up to `concurrency` items ahead
+    of the consumer in a thread pool. Results are yielded in input order
+    '''
+    if concurrency <= 1:
+        yield from map(function, items)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) > concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class LogTail:
+    '''
+    Follow the log of a running build
+
+    Each call to poll() yields only the output that has appeared since the
+    previous call. Byte offsets are tracked per command and only the new bytes
+    are requested from the server (via HTTP Range header)
+    '''
+
+    STARTED = {'EXECUTING', 'SUCCESS', 'FAILURE', 'ABORTED'}
+    FINISHED = STARTED - {'EXECUTING'}
+
+    query = GET_BUILD_LOG_STATUS
+
+    def __init__(self, api, build_id, offsets=None):
+        self.api = api
+        self.build_id = build_id
+        self.offsets = {}
+        for task_id, command, offset in offsets or ():
+            self.offsets[(task_id, command)] = offset
+        self.decoders = {}
+        self.finished = set()
+        self.current = None
+
+    def state(self):
+        '''Serializable list of byte offsets: [task_id, command, offset]'''
+        return [[task_id, command, offset] for (task_id, command), offset in self.offsets.items()]
+
+    def poll(self):
+        '''Yield chunks of text that were added to build log since last poll'''
+        response = self.api(self.query, dict(build=self.build_id))
+        for task in response['build']['tasks']:
+            for command in task['commands']:
+                key = (task['id'], command['name'])
+                if key in self.finished or command['status'] not in self.STARTED:
+                    continue
+                for chunk in self._fetch(key):
+                    if self.current != key:
+                        self.current = key
+                        yield LogChunk('\n## Task: {task[name]}\n'.format(**locals()), task, markup=True)
+                        yield LogChunk('\n## Task instruction: {command[name]}\n'.format(**locals()), task, command,
+                                       markup=True)
+                    yield LogChunk(chunk, task, command)
+                if command['status'] in self.FINISHED:
+                    self.finished.add(key)
+
+    def _fetch(self, key):
+        '''Yield new text chunks for a single command'''
+        offset = self.offsets.get(key, 0)
+        url = self.api.log_url(*key)
+        headers = {'Accept-Encoding': 'identity'}  # offsets must count raw bytes
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        with self.api.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 206:
+                skip = 0
+            elif response.status_code == 200:
+                skip = offset  # server ignored Range header
             else:
-                yield 'Unable to fetch url: {}'.format(url)
+                log.debug('no new log output at {}: HTTP {}'.format(url, response.status_code))
+                return
+            if key not in self.decoders:
+                self.decoders[key] = _log_decoder(response)
+            decoder = self.decoders[key]
+            for data in _log_content(response):
+                if skip:
+                    if skip >= len(data):
+                        skip -= len(data)
+                        continue
+                    data, skip = data[skip:], 0
+                text = decoder.decode(data)
+                if text:
+                    yield text
+                self.offsets[key] = self.offsets.get(key, 0) + len(data)  # only after text was consumed
@@ -0,0 +1,132 @@
+'''
+Local evaluation of Starlark configs (.cirrus.star)
+
+Requires starlark-pyo3. The main() function of the script is called and its
+result is converted to YAML the same way Cirrus CI does it: a list of tasks,
+a mapping of top-level keys or a ready YAML string. Evaluation results are
+cached by content hashes of the script and of all modules it loads.
+
+Modules are loaded from local files relative to the script. Of the builtin
+"cirrus" module only `env` (local environment variables) is provided
+'''
+
+
+import hashlib
+import json
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+CIRRUS_MODULE = 'cirrus'
+
+
+class StarlarkConfigError(Exception):
+    '''Starlark config could not be evaluated'''
+
+
+def evaluate_config(path, cache=None):
+    '''Return YAML config produced by Starlark script, reuse cached output when inputs did not change'''
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        source = f.read()
+    key = ['starlark', path, _digest(source)]
+    if cache is not None:
+        cached = cache.get(key)
+        if cached and _unchanged(cached['modules']):
+            return cached['config']
+    config, modules = evaluate(path, source.decode('utf-8'))
+    if cache is not None:
+        cache.set(key, dict(config=config, modules=modules))
+    return config
+
+
+def evaluate(path, source):
+    '''Evaluate script, return (YAML config, {loaded module path: content hash})'''
+    try:
+        import starlark
+    except ImportError:
+        raise ImportError('starlark-pyo3 is required for Starlark configs: pip install cirrus-run[starlark]')
+
+    globals_ = starlark.Globals.standard()
+    directory = os.path.dirname(path)
+    modules = {}
+    frozen = {}
+
+    def load(name):
+        if name == CIRRUS_MODULE:
+            return cirrus_module()
+        module_path = os.path.normpath(os.path.join(directory, name))
+        if module_path in frozen:
+            return frozen[module_path]
+        try:
+            with open(module_path, 'rb') as f:
+                module_source = f.read()
+        except OSError as exc:
+            raise StarlarkConfigError('only local modules and "cirrus" are supported, unable to load {}: {}'.format(
+                                      name, exc))
+        modules[module_path] = _digest(module_source)
+        module = starlark.Module()
+        starlark.eval(module, starlark.parse(name, module_source.decode('utf-8')), globals_, loader)
+        frozen[module_path] = module.freeze()
+        return frozen[module_path]
+
+    def cirrus_module():
+        if CIRRUS_MODULE not in frozen:
+            module = starlark.Module()
+            module['env'] = dict(os.environ)
+            modules[CIRRUS_MODULE] = _env_digest()
+            frozen[CIRRUS_MODULE] = module.freeze()
+        return frozen[CIRRUS_MODULE]
+
+    loader = starlark.FileLoader(load)
+    module = starlark.Module()
+    try:
+        starlark.eval(module, starlark.parse(path, source), globals_, loader)
+        try:
+            result = starlark.eval(module, starlark.parse('<main>', 'main()'), globals_)
+        except starlark.StarlarkError as exc:
+            if 'Missing parameter' not in str(exc):
+                raise
+            result = starlark.eval(module, starlark.parse('<main>', 'main(None)'), globals_)  # main(ctx)
+    except starlark.StarlarkError as exc:
+        raise StarlarkConfigError(str(exc))
+    log.debug('Evaluated Starlark config %s, loaded modules: %s', path, sorted(modules))
+    return to_yaml(result), modules
+
+
+def to_yaml(value):
+    '''Convert the value returned by main() to YAML text'''
+    import yaml
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return ''.join(yaml.safe_dump({'task': task}, sort_keys=False, allow_unicode=True) for task in value)
+    if isinstance(value, dict):
+        return yaml.safe_dump(value, sort_keys=False, allow_unicode=True)
+    raise StarlarkConfigError('main() must return a list of tasks, a dict or a YAML string, got: {!r}'.format(value))
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _env_digest():
+    return _digest(json.dumps(dict(os.environ), sort_keys=True).encode())
+
+
+def _unchanged(modules):
+    for module_path, digest in modules.items():
+        if module_path == CIRRUS_MODULE:
+            if _env_digest() != digest:
+                return False
+            continue
+        try:
+            with open(module_path, 'rb') as f:
+                if _digest(f.read()) != digest:
+                    return False
+        except OSError:
+            return False
+    return True
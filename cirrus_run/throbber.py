@@ -3,7 +3,8 @@ Show progress in terminal
 '''
 
 
-from threading import Thread
+from contextlib import contextmanager
+from threading import Lock, Thread
 from time import sleep
 
 
@@ -16,10 +17,13 @@ class ProgressBar:
         self.break_line = break_line
         self.exit = False
         self.thread = Thread(target=self.show)
+        self.lock = Lock()
+        self.line_open = False
 
     def __enter__(self):
         if self.char:
             self.thread.start()
+        return self
 
     def __exit__(self, *a, **ka):
         self.exit = True
@@ -44,5 +48,16 @@ class ProgressBar:
                 sleep(self.step)
 
     def tick(self, end=''):
-        print(self.char, end=end, flush=True)
+        with self.lock:
+            print(self.char, end=end, flush=True)
+            self.line_open = not end
+
+    @contextmanager
+    def pause(self):
+        '''Stop showing progress while other output is printed'''
+        with self.lock:
+            if self.line_open:
+                print(flush=True)
+                self.line_open = False
+            yield
 
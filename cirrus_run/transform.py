@@ -0,0 +1,85 @@
+'''
+Reduce the size of rendered config before it is submitted to Cirrus CI
+
+Config is re-serialized from YAML node tree: comments and indentation are
+dropped, collections are written in compact flow style and repeated blocks
+are replaced with YAML aliases. Node tree (including duplicate keys that
+Cirrus CI uses for matrices and repeated tasks) is kept intact
+'''
+
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+MIN_ALIAS_SIZE = 32  # characters, shorter repeated blocks are not worth an anchor
+
+
+def minify_config(text):
+    '''Return compact YAML that parses into the same node tree as text'''
+    import yaml  # only needed when minification is enabled
+    loader = _pick(yaml, 'CSafeLoader', 'SafeLoader')(text)
+    try:
+        root = loader.get_single_node()
+    finally:
+        loader.dispose()
+    if root is None:
+        return text
+    deduplicate(root, yaml.nodes)
+    return yaml.serialize(
+        root,
+        Dumper=_pick(yaml, 'CSafeDumper', 'SafeDumper'),
+        width=2**30,
+        allow_unicode=True,
+    )
+
+
+def deduplicate(root, nodes):
+    '''
+    Make equal subtrees share a single node object
+
+    YAML serializer writes a node that occurs more than once as an anchor
+    followed by aliases. Mapping keys are never aliased
+    '''
+    canonical = {}
+    cache = {}  # id(node) -> (structural key, size)
+
+    def visit(node):
+        seen = cache.get(id(node))
+        if seen is not None:
+            return node, seen[0], seen[1]
+        if isinstance(node, nodes.ScalarNode):
+            key = ('scalar', node.tag, node.value)
+            size = len(node.value)
+        elif isinstance(node, nodes.SequenceNode):
+            node.flow_style = True
+            items = [visit(item) for item in node.value]
+            node.value = [item for item, _, _ in items]
+            key = ('sequence', node.tag, tuple(item_key for _, item_key, _ in items))
+            size = 2 + sum(item_size + 1 for _, _, item_size in items)
+        else:
+            node.flow_style = True
+            pairs = []
+            for key_node, value_node in node.value:
+                _, key_key, key_size = visit(key_node)
+                value_node, value_key, value_size = visit(value_node)
+                pairs.append((key_node, value_node, key_key, value_key, key_size + value_size + 2))
+            node.value = [(key_node, value_node) for key_node, value_node, _, _, _ in pairs]
+            key = ('mapping', node.tag, tuple((key_key, value_key) for _, _, key_key, value_key, _ in pairs))
+            size = 2 + sum(pair[-1] for pair in pairs)
+        if size >= MIN_ALIAS_SIZE:
+            node = canonical.setdefault(key, node)
+        cache[id(node)] = (key, size)
+        return node, key, size
+
+    visit(root)
+    return root
+
+
+def _pick(module, *names):
+    for name in names:
+        value = getattr(module, name, None)
+        if value is not None:
+            return value
@@ -0,0 +1,327 @@
+'''
+Offline validation of Cirrus CI configuration
+
+Rendered YAML is checked against a bundled schema of Cirrus task definitions
+before the build is submitted, so that mistakes are reported locally (with
+line numbers) instead of after a round trip to Cirrus CI
+'''
+
+
+import re
+from functools import lru_cache
+
+
+INSTANCES = (
+    'aks_container|arm_container|azure_container_instance|compute_engine_instance|'
+    'container|ec2_instance|eks_container|freebsd_instance|gce_instance|gke_container|'
+    'macos_instance|persistent_worker|windows_container'
+)
+CONTAINERS = 'aks_container|arm_container|container|eks_container|gke_container|windows_container'
+INSTRUCTIONS = r'\w*script|\w+_cache|\w+_artifacts|\w+_file'
+TASK_OPTIONS = (
+    'name|alias|only_if|skip|allow_failures|auto_cancellation|use_compute_credits|'
+    'stateful|experimental|execution_lock|skip_notifications|timeout_in|trigger_type'
+)
+
+# Mapping node type -> ((key pattern, value node type), ...)
+# Node types without an entry here are checked by Validator methods only
+SCHEMA = {
+    'config': (
+        ('env|environment', 'env'),
+        (CONTAINERS, 'container'),
+        (INSTANCES, 'instance'),
+        (r'(?:\w+_)?(?:task|docker_builder)', 'task'),
+        (r'(?:\w+_)?pipe', 'pipe'),
+        ('timeout_in', 'duration'),
+        ('only_if|skip|auto_cancellation|use_compute_credits|'
+         'gcp_credentials|aws_credentials|azure_credentials', 'scalar'),
+    ),
+    'task': (
+        ('timeout_in', 'duration'),
+        ('trigger_type', 'trigger_type'),
+        (TASK_OPTIONS, 'scalar'),
+        ('depends_on|required_pr_labels', 'scalars'),
+        ('env|environment', 'env'),
+        ('matrix', 'matrix'),
+        (CONTAINERS, 'container'),
+        (INSTANCES, 'instance'),
+        ('on_success|on_failure|always', 'instructions'),
+        (r'\w*script', 'scalars'),
+        (r'\w+_cache', 'cache'),
+        (r'\w+_artifacts', 'artifacts'),
+        (r'\w+_file', 'file'),
+    ),
+    'pipe': (
+        ('timeout_in', 'duration'),
+        ('trigger_type', 'trigger_type'),
+        (TASK_OPTIONS, 'scalar'),
+        ('depends_on|required_pr_labels', 'scalars'),
+        ('env|environment', 'env'),
+        ('matrix', 'matrix'),
+        ('resources', 'mapping'),
+        ('steps', 'steps'),
+    ),
+    'step': (
+        ('image', 'scalar'),
+        ('env|environment', 'env'),
+        ('on_success|on_failure|always', 'instructions'),
+        (r'\w*script', 'scalars'),
+        (r'\w+_cache', 'cache'),
+        (r'\w+_artifacts', 'artifacts'),
+        (r'\w+_file', 'file'),
+    ),
+    'instructions': (
+        (r'\w*script', 'scalars'),
+        (r'\w+_cache', 'cache'),
+        (r'\w+_artifacts', 'artifacts'),
+        (r'\w+_file', 'file'),
+    ),
+    'cache': (
+        ('folder|fingerprint_key|reupload_on_changes', 'scalar'),
+        ('folders', 'scalars'),
+        ('fingerprint_script|populate_script', 'scalars'),
+    ),
+    'artifacts': (
+        ('path|type|format', 'scalar'),
+        ('paths', 'scalars'),
+    ),
+    'file': (
+        ('path|variable_name|from_contents', 'scalar'),
+    ),
+}
+
+# Mapping node types that must be mappings for Cirrus CI to parse the config at
+# all. Problems with these are errors, other schema checks may be incomplete and
+# are reported as warnings
+STRUCTURE = {'config', 'task', 'pipe'}
+
+# Node type -> groups of keys, at least one key of each group is required
+REQUIRED = {
+    'container': (('image', 'dockerfile'),),
+    'pipe': (('steps',),),
+    'step': (('image',),),
+    'cache': (('folder', 'folders'),),
+    'artifacts': (('path', 'paths'),),
+    'file': (('path',), ('variable_name', 'from_contents')),
+}
+
+ENUMS = {
+    'trigger_type': {'automatic', 'manual'},
+}
+
+DURATION = re.compile(r'\d+[smh]?$')
+
+
+class ConfigIssue:
+    '''Problem found in Cirrus CI configuration'''
+
+    def __init__(self, line, column, message, severity='error'):
+        self.line = line
+        self.column = column
+        self.message = message
+        self.severity = severity
+
+    def __str__(self):
+        return '{}:{}: {}: {}'.format(self.line, self.column, self.severity, self.message)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self)
+
+
+def validate_config(text):
+    '''Check rendered YAML config, return a list of ConfigIssue objects sorted by line number'''
+    import yaml  # only needed when validation is enabled
+    try:
+        loader = yaml.CSafeLoader(text)
+    except AttributeError:  # PyYAML without libyaml
+        loader = yaml.SafeLoader(text)
+    try:
+        root = loader.get_single_node()
+    except yaml.MarkedYAMLError as exc:
+        mark = exc.problem_mark or exc.context_mark
+        message = ' '.join(part for part in (exc.context, exc.problem) if part)
+        return [ConfigIssue(mark.line + 1 if mark else 1, mark.column + 1 if mark else 1,
+                            'invalid YAML: {}'.format(message))]
+    except yaml.YAMLError as exc:
+        return [ConfigIssue(1, 1, 'invalid YAML: {}'.format(exc))]
+    finally:
+        loader.dispose()
+    validator = Validator(loader, yaml.nodes)
+    validator.validate(root)
+    return sorted(validator.issues, key=lambda issue: (issue.line, issue.column))
+
+
+@lru_cache(maxsize=None)
+def compiled_schema():
+    '''Compile key patterns from SCHEMA once per process'''
+    return {
+        node_type: [(re.compile('(?:{})$'.format(pattern)), value_type) for pattern, value_type in rules]
+        for node_type, rules in SCHEMA.items()
+    }
+
+
+class Validator:
+    '''Walk YAML node tree and collect ConfigIssue objects'''
+
+    def __init__(self, loader, nodes):
+        self.loader = loader
+        self.nodes = nodes
+        self.schema = compiled_schema()
+        self.issues = []
+        self.task_names = set()
+        self.dependencies = []
+        self.dynamic_names = False
+
+    def issue(self, node, message, severity='warning'):
+        mark = node.start_mark
+        self.issues.append(ConfigIssue(mark.line + 1, mark.column + 1, message, severity))
+
+    def validate(self, root):
+        if root is None:
+            self.issues.append(ConfigIssue(1, 1, 'config is empty'))
+            return
+        if not self.mapping(root, 'config'):
+            return
+        tasks = [(key, value) for key, value in root.value if self.rule('config', key) in {'task', 'pipe'}]
+        if not tasks:
+            self.issue(root, 'no tasks defined', 'error')
+        for key, value in tasks:
+            self.collect_names(key.value, value)
+        if not self.dynamic_names:
+            for name, node in self.dependencies:
+                if name not in self.task_names:
+                    self.issue(node, 'dependency on unknown task: {}'.format(name))
+
+    def rule(self, node_type, key):
+        if not isinstance(key, self.nodes.ScalarNode):
+            return None
+        for pattern, value_type in self.schema[node_type]:
+            if pattern.match(str(key.value)):
+                return value_type
+        return None
+
+    def check(self, node, node_type, path):
+        '''Dispatch value check by its node type'''
+        if node_type in {'scalar', 'duration', 'trigger_type'}:
+            if not isinstance(node, self.nodes.ScalarNode):
+                self.issue(node, '{} must be a single value'.format(path))
+            elif node_type == 'duration' and not DURATION.match(node.value):
+                self.issue(node, '{} must be a duration like 30m or 2h: {}'.format(path, node.value))
+            elif node_type in ENUMS and node.value not in ENUMS[node_type]:
+                self.issue(node, '{} must be one of {}: {}'.format(
+                           path, ', '.join(sorted(ENUMS[node_type])), node.value))
+        elif node_type == 'scalars':
+            items = node.value if isinstance(node, self.nodes.SequenceNode) else [node]
+            for item in items:
+                if not isinstance(item, self.nodes.ScalarNode):
+                    self.issue(item, '{} must be a string or a list of strings'.format(path))
+        elif node_type == 'env':
+            if self.mapping(node, None, path):
+                for key, value in node.value:
+                    if key.value == 'matrix':
+                        self.matrix(value, 'env', '{}.matrix'.format(path))
+                    elif not isinstance(value, self.nodes.ScalarNode):
+                        self.issue(value, 'environment variable {} must be a single value'.format(key.value))
+        elif node_type == 'steps':
+            if not isinstance(node, self.nodes.SequenceNode):
+                self.issue(node, '{} must be a list'.format(path))
+            else:
+                for index, step in enumerate(node.value):
+                    self.mapping(step, 'step', '{}[{}]'.format(path, index))
+        elif node_type == 'task':
+            if self.mapping(node, 'task', path):
+                self.task_instructions(node, path)
+        else:
+            self.mapping(node, node_type, path)
+
+    def mapping(self, node, node_type, path='config', partial=False):
+        '''Check mapping node against SCHEMA, return True if node is a mapping'''
+        if not isinstance(node, self.nodes.MappingNode):
+            self.issue(node, '{} must be a mapping'.format(path), 'error' if node_type in STRUCTURE else 'warning')
+            return False
+        self.loader.flatten_mapping(node)
+        keys = set()
+        for key, value in node.value:
+            if node_type not in self.schema:  # free-form mapping
+                keys.add(getattr(key, 'value', None))
+                continue
+            if not isinstance(key, self.nodes.ScalarNode):
+                self.issue(key, 'keys in {} must be strings'.format(path))
+                continue
+            keys.add(key.value)
+            child = key.value if node_type == 'config' else '{}.{}'.format(path, key.value)
+            if key.value == 'matrix' and node_type != 'config':
+                self.matrix(value, node_type, child)
+                continue
+            value_type = self.rule(node_type, key)
+            if value_type is None:
+                self.issue(key, 'unknown key in {}: {}'.format(path, key.value))
+                continue
+            self.check(value, value_type, child)
+        if not partial and 'matrix' not in keys:
+            for group in REQUIRED.get(node_type, ()):
+                if not keys.intersection(group):
+                    self.issue(node, '{} requires {}'.format(path, ' or '.join(group)))
+        return True
+
+    def matrix(self, node, node_type, path):
+        '''Matrix is a list of mappings (or a mapping) of the parent node type'''
+        if isinstance(node, self.nodes.SequenceNode):
+            entries = node.value
+        elif isinstance(node, self.nodes.MappingNode):
+            entries = [node]
+        else:
+            self.issue(node, '{} must be a list of mappings'.format(path))
+            return
+        if not entries:
+            self.issue(node, '{} is empty'.format(path))
+        for index, entry in enumerate(entries):
+            if node_type in self.schema:
+                self.mapping(entry, node_type, '{}[{}]'.format(path, index), partial=True)
+            else:
+                self.check(entry, node_type, '{}[{}]'.format(path, index))
+
+    def task_instructions(self, node, path):
+        '''Task must have something to execute, either directly or in its matrix'''
+        pattern = re.compile('(?:{}|on_success|on_failure|always)$'.format(INSTRUCTIONS))
+        candidates = [node]
+        for key, value in node.value:
+            if key.value == 'matrix':
+                candidates.extend(value.value if isinstance(value, self.nodes.SequenceNode) else [value])
+        for candidate in candidates:
+            if not isinstance(candidate, self.nodes.MappingNode):
+                continue
+            if any(pattern.match(str(key.value)) for key, _ in candidate.value):
+                return
+        self.issue(node, '{} has no scripts or other instructions to execute'.format(path))
+
+    def collect_names(self, key, node):
+        '''Remember task names (and aliases) and dependencies for cross-reference check'''
+        if not isinstance(node, self.nodes.MappingNode):
+            return
+        prefix = re.match(r'(\w+)_(?:task|docker_builder|pipe)$', key)
+        default = prefix.group(1) if prefix else 'main'
+        names, aliases = [], []
+        for mapping in self._with_matrix(node):
+            for item_key, value in mapping.value:
+                if item_key.value == 'name' and isinstance(value, self.nodes.ScalarNode):
+                    names.append(value.value)
+                elif item_key.value == 'alias' and isinstance(value, self.nodes.ScalarNode):
+                    aliases.append(value.value)
+                elif item_key.value == 'depends_on':
+                    items = value.value if isinstance(value, self.nodes.SequenceNode) else [value]
+                    for item in items:
+                        if isinstance(item, self.nodes.ScalarNode):
+                            self.dependencies.append((item.value, item))
+        for name in (names or [default]) + aliases:
+            if '$' in name or '{' in name:
+                self.dynamic_names = True
+            self.task_names.add(name)
+
+    def _with_matrix(self, node):
+        yield node
+        for key, value in node.value:
+            if key.value == 'matrix':
+                for entry in (value.value if isinstance(value, self.nodes.SequenceNode) else [value]):
+                    if isinstance(entry, self.nodes.MappingNode):
+                        yield entry
@@ -1,21 +1,19 @@
 '''
 Helper script for issue #8: https://github.com/sio/cirrus-run/issues/8
 
-Monitor API query results for the status of specified build.
+Monitor status transitions of specified build and its tasks.
 
 Execute `make debug/build_status DEBUG_BUILD_ID=5735044040884224`
 from repo top-level directory (replace the number with your build ID)
 '''
 
-import json
 import os
 import sys
-from datetime import datetime
-from time import sleep
 
 
 from cirrus_run import CirrusAPI
 from cirrus_run.cli import ENVIRONMENT
+from cirrus_run.queries import watch_build, BuildEvent, BuildFinished, TaskEvent
 
 
 def main():
@@ -23,30 +21,15 @@ def main():
     api = CirrusAPI(token)
     build_id = sys.argv[1]
 
-    query = '''
-        query GetBuild($build: ID!) {
-            build(id: $build) {
-                id
-                durationInSeconds
-                clockDurationInSeconds
-                status
-                buildCreatedTimestamp
-                changeTimestamp
-            }
-        }
-    '''
     print('https://cirrus-ci.com/build/{}'.format(build_id))
-    while True:
-        response = api(query, params=dict(build=build_id))
-        now = datetime.utcnow()
-        print(f'{now:%Y-%m-%d %H:%M:%S+00:00 (UTC)}')
-        print(json.dumps(response, indent=2, ensure_ascii=False))
-        try:
-            if response['build']['status'] not in {'CREATED', 'TRIGGERED', 'EXECUTING'}:
-                break
-        except (TypeError, KeyError) as exc:
-            pass
-        sleep(2)
+    for event in watch_build(api, build_id, delay=2):
+        timestamp = f'{event.timestamp:%Y-%m-%d %H:%M:%S+00:00 (UTC)}'
+        if isinstance(event, BuildEvent):
+            print(f'{timestamp} build: {event.previous} -> {event.status}')
+        elif isinstance(event, TaskEvent):
+            print(f'{timestamp} task {event.name} ({event.task_id}): {event.previous} -> {event.status}')
+        elif isinstance(event, BuildFinished):
+            print(f'{timestamp} finished: {event.status}, error: {event.error}')
 
 
 if __name__ == '__main__':
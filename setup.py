@@ -29,9 +29,13 @@ setup(
     include_package_data=True,
     install_requires=[
         'Jinja2',
+        'PyYAML',
         'requests',
     ],
-    extras_require={ },
+    extras_require={
+        'async': ['aiohttp'],
+        'starlark': ['starlark-pyo3'],
+    },
     python_requires='>=3.4',
     zip_safe=True,
     keywords=[
@@ -0,0 +1,288 @@
+'''
+Local stand-in for Cirrus CI service
+
+Implements the subset of GraphQL API used by cirrus-run and the log download
+endpoint. Builds follow scriptable timelines, latency and errors may be
+injected, logs of any size are generated on the fly without keeping them in
+memory. Server counts requests and bytes transferred
+'''
+
+import gzip
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic as time, sleep
+
+
+class TaskScript:
+    '''Expected behavior of a single task'''
+
+    def __init__(self, name='main', timeline=((0, 'EXECUTING'), (0.2, 'COMPLETED')),
+                 commands=('main',), log_size=None, log_line='build output line\n'):
+        self.name = name
+        self.timeline = timeline  # list of (seconds since build creation, status)
+        self.commands = commands
+        self.log_size = log_size  # bytes per command log, None for a short log
+        self.log_line = log_line
+
+
+class BuildScript:
+    '''Expected behavior of a build: a list of tasks'''
+
+    def __init__(self, tasks=None):
+        self.tasks = tasks or [TaskScript()]
+
+
+class FakeCirrusServer:
+    '''
+    Fake Cirrus API on a random local port
+
+    scenario: function that receives build config text and returns BuildScript
+    latency: seconds to wait before answering each request
+    errors: function that receives request number and HTTP method and returns
+            status code to fail the request with (or None to process it normally)
+    '''
+
+    FINAL = {'COMPLETED', 'FAILED', 'ABORTED', 'SKIPPED'}
+
+    def __init__(self, scenario=None, latency=0, errors=None):
+        self.scenario = scenario or (lambda config: BuildScript())
+        self.latency = latency
+        self.errors = errors
+        self.builds = {}
+        self.tasks = {}
+        self.lock = Lock()
+        self.requests = 0
+        self.operations = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        handler = type('Handler', (_Handler,), dict(cirrus=self))
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/graphql'.format(self.httpd.server_port)
+
+    def __enter__(self):
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *a, **ka):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        '''Request count and traffic since server start'''
+        return dict(requests=self.requests, operations=dict(self.operations),
+                    bytes_received=self.bytes_received, bytes_sent=self.bytes_sent)
+
+    def record(self, received=0, sent=0, operation=None):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+            if operation:
+                self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def next_request(self):
+        with self.lock:
+            self.requests += 1
+            return self.requests
+
+    # Build state
+
+    def create_build(self, config):
+        with self.lock:
+            build_id = str(1000 + len(self.builds))
+            script = self.scenario(config)
+            task_ids = []
+            for index, task in enumerate(script.tasks):
+                task_id = '{}{:03d}'.format(build_id, index)
+                self.tasks[task_id] = dict(script=task, build=build_id, started=time(), aborted=False)
+                task_ids.append(task_id)
+            self.builds[build_id] = dict(config=config, tasks=task_ids, started=time())
+        return build_id
+
+    def task_status(self, task_id):
+        task = self.tasks[task_id]
+        if task['aborted']:
+            return 'ABORTED'
+        elapsed = time() - task['started']
+        status = 'CREATED'
+        for start, value in task['script'].timeline:
+            if elapsed >= start:
+                status = value
+        return status
+
+    def build_status(self, build_id):
+        statuses = [self.task_status(task_id) for task_id in self.builds[build_id]['tasks']]
+        if not all(status in self.FINAL for status in statuses):
+            return 'EXECUTING'
+        if any(status in {'FAILED', 'ABORTED'} for status in statuses):
+            return 'FAILED'
+        return 'COMPLETED'
+
+    def task_info(self, task_id, statuses=False):
+        script = self.tasks[task_id]['script']
+        status = self.task_status(task_id)
+        info = dict(id=task_id, name=script.name, commands=[dict(name=name) for name in script.commands])
+        if statuses:
+            info['status'] = status
+            for command in info['commands']:
+                command['status'] = {
+                    'COMPLETED': 'SUCCESS',
+                    'FAILED': 'FAILURE',
+                    'ABORTED': 'ABORTED',
+                }.get(status, 'EXECUTING' if status == 'EXECUTING' else 'UNDEFINED')
+        return info
+
+    def log_body(self, task_id):
+        '''Yield log contents in chunks'''
+        script = self.tasks[task_id]['script']
+        if script.log_size is None:
+            yield 'log of task {} ({})\n'.format(script.name, task_id).encode()
+            return
+        line = script.log_line.encode()
+        block = line * max(1, 65536 // len(line))
+        remaining = script.log_size
+        while remaining > 0:
+            chunk = block[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+
+    # GraphQL operations
+
+    def GetRepo(self, owner, repo):
+        return {'ownerRepository': {'id': '1', 'name': repo}}
+
+    def ScheduleCustomBuild(self, config, repo, branch, mutation_id):
+        build_id = self.create_build(config)
+        return {'createBuild': {'build': {'id': build_id, 'status': 'CREATED'}}}
+
+    def GetBuild(self, build):
+        return {'build': {'status': self.build_status(build)}}
+
+    def GetBuilds(self, **builds):
+        return {alias: {'status': self.build_status(build)} for alias, build in builds.items()}
+
+    def GetBuildsTasks(self, **builds):
+        return {alias: {'status': self.build_status(build),
+                        'tasks': [self.task_info(task_id, True) for task_id in self.builds[build]['tasks']]}
+                for alias, build in builds.items()}
+
+    def GetBuildLog(self, build):
+        return {'build': {'tasks': [self.task_info(task_id) for task_id in self.builds[build]['tasks']]}}
+
+    def GetBuildLogStatus(self, build):
+        return {'build': {'tasks': [self.task_info(task_id, True) for task_id in self.builds[build]['tasks']]}}
+
+    GetBuildTasks = GetBuildLogStatus
+
+    def GetTasks(self, **tasks):
+        return {alias: {'status': self.task_status(task_id)} for alias, task_id in tasks.items()}
+
+    def GetTasksLog(self, **tasks):
+        return {alias: self.task_info(task_id, True) for alias, task_id in tasks.items()}
+
+    def AbortTasks(self, tasks, mutation_id):
+        for task_id in tasks:
+            self.tasks[task_id]['aborted'] = True
+        return {'batchAbort': {'clientMutationId': mutation_id}}
+
+    def GetRecentBuilds(self, repo, branch, count):
+        return {'repository': {'builds': {'edges': []}}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    cirrus = None  # FakeCirrusServer instance
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        operation = None
+        if not self.inject():
+            payload = json.loads(body)
+            operation = re.match(r'\s*(?:query|mutation)\s+(\w+)', payload['query']).group(1)
+            try:
+                reply = {'data': getattr(self.cirrus, operation)(**payload['variables'])}
+            except (AttributeError, KeyError, TypeError) as exc:
+                reply = {'errors': [{'message': '{}: {}'.format(exc.__class__.__name__, exc)}]}
+            self.reply(200, 'application/json', [json.dumps(reply).encode()])
+        self.cirrus.record(received=len(body), operation=operation)
+
+    def do_GET(self):
+        if self.inject():
+            return
+        match = re.match(r'/v1/task/(\w+)/logs/(.+)\.log$', self.path)
+        if not match or match.group(1) not in self.cirrus.tasks:
+            self.reply(404, 'text/plain', [b'not found'])
+            return
+        self.reply(200, 'text/plain; charset=utf-8', self.cirrus.log_body(match.group(1)))
+
+    def inject(self):
+        '''Apply configured latency and errors, return True if request has been answered'''
+        number = self.cirrus.next_request()
+        if self.cirrus.latency:
+            sleep(self.cirrus.latency)
+        status = self.cirrus.errors(number, self.command) if self.cirrus.errors else None
+        if status is None:
+            return False
+        self.reply(status, 'text/plain', [b'injected error'])
+        return True
+
+    def reply(self, status, content_type, chunks):
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        compressor = _GzipStream() if compress else None
+        for chunk in chunks:
+            if compressor:
+                chunk = compressor.write(chunk)
+            self.write_chunk(chunk)
+        if compressor:
+            self.write_chunk(compressor.close())
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        if data:
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+            self.cirrus.record(sent=len(data))
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+class _GzipStream:
+    '''Incremental gzip compression'''
+
+    def __init__(self):
+        self.buffer = _Buffer()
+        self.file = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+
+    def write(self, data):
+        self.file.write(data)
+        return self.buffer.take()
+
+    def close(self):
+        self.file.close()
+        return self.buffer.take()
+
+
+class _Buffer:
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.data = b''.join(self.data), []
+        return data
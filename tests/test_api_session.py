@@ -0,0 +1,78 @@
+'''
+Connection pooling and timeouts of API session
+'''
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep, monotonic as time
+
+import pytest
+import requests
+
+from cirrus_run.api import CirrusAPI
+
+
+class KeepAliveServer(BaseHTTPRequestHandler):
+    '''Count TCP connections, optionally respond slowly'''
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    delay = 0
+
+    def setup(self):
+        super().setup()
+        KeepAliveServer.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        sleep(self.delay)
+        body = json.dumps({'data': {'hello': 'world'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(KeepAliveServer, 'connections', 0)
+    monkeypatch.setattr(KeepAliveServer, 'delay', 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveServer)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/graphql'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_keep_alive(server):
+    '''Consecutive API calls reuse the same connection'''
+    api = CirrusAPI('faketoken', url=server)
+    for _ in range(5):
+        assert api('fake query text') == {'hello': 'world'}
+    assert KeepAliveServer.connections == 1
+
+
+def test_read_timeout(server, monkeypatch):
+    '''Requests do not hang forever when server does not respond'''
+    monkeypatch.setattr(KeepAliveServer, 'delay', 2)
+    monkeypatch.setattr(CirrusAPI, 'READ_TIMEOUT', 0.2)
+    api = CirrusAPI('faketoken', url=server)
+    time_start = time()
+    with pytest.raises(requests.exceptions.Timeout):
+        api('fake query text', retries=0)
+    assert time() - time_start < 1
+
+
+def test_pool_configuration():
+    '''Pool size and transport level retries are configured explicitly'''
+    api = CirrusAPI('faketoken', pool_size=7)
+    adapter = api._requests.get_adapter(api.DEFAULT_URL)
+    assert adapter._pool_maxsize == 7
+    assert adapter.max_retries.connect == CirrusAPI.CONNECT_RETRIES
+    assert adapter.max_retries.read == 0
@@ -0,0 +1,225 @@
+'''
+Async equivalents of test_api_retries.py and test_api_long_delay.py
+'''
+
+import asyncio
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic as time
+from types import SimpleNamespace
+
+import pytest
+
+from cirrus_run import aio
+from cirrus_run.api import CirrusAPIError, CirrusHTTPError
+from cirrus_run.queries import LogChunk
+
+
+INTERNAL_ERROR = {'errors': [{'locations': [], 'message': 'Internal Server Error(s) while executing query'}]}
+TRY_AGAIN = 'The server encountered a temporary error and could not complete your request. Please try again in 30 seconds.'
+
+
+class ScriptedAPI(aio.AsyncCirrusAPI):
+    '''Fake API instance that replays predefined server responses'''
+
+    RETRY_DELAY = 0.1
+    RETRY_LONG_DELAY = 1
+
+    def __init__(self, *replies):
+        super().__init__('faketoken')
+        self.replies = list(replies)
+        self.calls = 0
+
+    async def _post(self, **ka):
+        self.calls += 1
+        if len(self.replies) > 1:
+            status, body = self.replies.pop(0)
+        else:
+            status, body = self.replies[0]
+        if status != 200:
+            raise CirrusHTTPError(SimpleNamespace(status_code=status, text=body, url=self._url))
+        return body
+
+
+def call(api, *a, **ka):
+    return asyncio.run(api(*a, **ka))
+
+
+def long_delay_messages(caplog):
+    return sum('API server asked for longer retry delay' in record.message for record in caplog.records)
+
+
+def test_unrecoverable_http_error():
+    '''Check handling of unrecoverable HTTP errors'''
+    api = ScriptedAPI((502, ''))
+    with pytest.raises(CirrusHTTPError):
+        call(api, 'fake query text', delay=0)
+    assert api.calls == 1 + 3
+
+
+def test_recoverable_http_error():
+    '''Check handling of interminent HTTP errors'''
+    api = ScriptedAPI((502, ''), (502, ''), (200, {'data': {'hello': 'world'}}))
+    assert call(api, 'fake query text', delay=0) == {'hello': 'world'}
+    assert api.calls == 3
+
+
+def test_unrecoverable_api_error():
+    '''Check handling of unrecoverable API errors'''
+    api = ScriptedAPI((200, {'errors': ['fake error message']}))
+    with pytest.raises(CirrusAPIError):
+        call(api, 'fake query text', delay=0)
+    assert api.calls == 1 + 3
+
+
+def test_recoverable_api_error():
+    '''Check handling of interminent api errors'''
+    api = ScriptedAPI(
+        (200, {'errors': ['fake error message']}),
+        (200, {'errors': ['fake error message']}),
+        (200, {'data': {'hello': 'world'}}),
+    )
+    assert call(api, 'fake query text', delay=0) == {'hello': 'world'}
+    assert api.calls == 3
+
+
+def test_long_retry_delay_required(caplog):
+    '''Wait out intermittent API server errors'''
+    caplog.set_level(logging.DEBUG, logger='cirrus_run')
+    api = ScriptedAPI((502, TRY_AGAIN))
+
+    time_start = time()
+    with pytest.raises(CirrusHTTPError):
+        call(api, 'fake query text')
+    elapsed = time() - time_start
+
+    assert elapsed > api.RETRY_LONG_DELAY + api.RETRY_DELAY * 2
+    assert elapsed < api.RETRY_LONG_DELAY * 3
+    assert long_delay_messages(caplog) == 1
+    assert api.calls == 1 + 3
+
+
+def test_long_retry_not_required(caplog):
+    '''Some 502 errors do not require a long delay'''
+    caplog.set_level(logging.DEBUG, logger='cirrus_run')
+    api = ScriptedAPI((502, ''))
+
+    time_start = time()
+    with pytest.raises(CirrusHTTPError):
+        call(api, 'fake query text')
+    elapsed = time() - time_start
+
+    assert elapsed > api.RETRY_DELAY * 3
+    assert elapsed < api.RETRY_LONG_DELAY + api.RETRY_DELAY * 2
+    assert long_delay_messages(caplog) == 0
+    assert api.calls == 1 + 3
+
+
+def test_long_retry_internal_server_error_recoverable(caplog):
+    '''Retry GraphQL internal server error - with recovery'''
+    caplog.set_level(logging.DEBUG, logger='cirrus_run')
+    api = ScriptedAPI((200, INTERNAL_ERROR), (200, INTERNAL_ERROR), (200, {'data': {'hello': 'world'}}))
+
+    time_start = time()
+    assert call(api, 'fake query text', delay=0) == {'hello': 'world'}
+    elapsed = time() - time_start
+
+    assert api.calls == 3
+    assert elapsed > api.RETRY_DELAY * 2
+    assert elapsed < api.RETRY_LONG_DELAY * 2
+    assert long_delay_messages(caplog) == 1
+
+
+def test_long_retry_internal_server_error_unrecoverable(caplog):
+    '''Retry GraphQL internal server error - unrecoverable'''
+    caplog.set_level(logging.DEBUG, logger='cirrus_run')
+    api = ScriptedAPI((200, INTERNAL_ERROR))
+
+    time_start = time()
+    with pytest.raises(CirrusAPIError):
+        call(api, 'fake query text', delay=0)
+    elapsed = time() - time_start
+
+    assert api.calls == 1 + 3
+    assert elapsed > api.RETRY_DELAY * 3
+    assert elapsed < api.RETRY_LONG_DELAY * 2 + api.RETRY_DELAY
+    assert long_delay_messages(caplog) == 1
+
+
+class FakeCirrusServer(BaseHTTPRequestHandler):
+    '''Build with two tasks that completes on second status check'''
+
+    checks = 0
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if 'GetBuilds' in payload['query']:
+            FakeCirrusServer.checks += 1
+            status = 'COMPLETED' if self.checks > 1 else 'EXECUTING'
+            data = {alias: {'status': status} for alias in payload['variables']}
+        else:
+            data = {'build': {'tasks': [
+                {'id': str(task), 'name': 'task{}'.format(task), 'commands': [{'name': 'a'}, {'name': 'b'}]}
+                for task in range(2)
+            ]}}
+        self.reply('application/json', json.dumps({'data': data}).encode())
+
+    def do_GET(self):
+        self.reply('text/plain; charset=utf-8', 'log of {} ✓\n'.format(self.path).encode())
+
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    pytest.importorskip('aiohttp')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCirrusServer)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/graphql'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('concurrency', [1, 3])
+def test_wait_and_log(server_url, concurrency):
+    '''Wait for build and fetch its log over real HTTP'''
+    async def main():
+        async with aio.AsyncCirrusAPI('faketoken', url=server_url) as api:
+            assert await aio.wait_build(api, 'fakebuild', delay=0.01)
+            return [chunk async for chunk in aio.build_log(api, 'fakebuild', concurrency=concurrency)]
+    chunks = asyncio.run(main())
+    log = ''.join(chunks)
+    assert log.count('## Task: ') == 2
+    assert log.count('## Task instruction: ') == 4
+    assert log.index('/v1/task/0/logs/b.log ✓') < log.index('/v1/task/1/logs/a.log ✓')
+    assert all(isinstance(chunk, LogChunk) for chunk in chunks)
+    assert {(chunk.task_id, chunk.command) for chunk in chunks if not chunk.markup} == {
+        (task, command) for task in '01' for command in 'ab'}
+
+
+def test_log_early_exit(server_url, monkeypatch):
+    '''Spooled logs are discarded when the consumer stops reading build log early'''
+    spools = []
+    spool_class = aio.SpooledTemporaryFile
+    monkeypatch.setattr(aio, 'SpooledTemporaryFile', lambda *a, **ka: spools.append(spool_class(*a, **ka)) or spools[-1])
+
+    async def main():
+        async with aio.AsyncCirrusAPI('faketoken', url=server_url) as api:
+            log = aio.build_log(api, 'fakebuild', concurrency=3)
+            async for chunk in log:
+                if not chunk.markup:
+                    break
+            await log.aclose()
+    asyncio.run(main())
+    assert spools
+    assert all(spool.closed for spool in spools)
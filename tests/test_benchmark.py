@@ -0,0 +1,136 @@
+'''
+End-to-end performance of cirrus-run against a local fake Cirrus server
+
+Each scenario runs the command line interface and checks wall time, number
+of requests, bytes transferred and peak memory against a budget
+'''
+
+import time
+import tracemalloc
+
+import pytest
+
+from cirrus_run import cli, queries
+from cirrus_run.api import CirrusAPI
+
+from fake_cirrus import BuildScript, FakeCirrusServer, TaskScript
+
+
+TIME_SCALE = 0.01  # client sleeps are shortened, server timelines are in real seconds
+CONFIG = '''
+task:
+  name: build {}
+  container:
+    image: debian:stable-slim
+  test_script: make test
+'''
+
+
+@pytest.fixture
+def environment(monkeypatch, tmp_path):
+    monkeypatch.setattr(queries, 'sleep', lambda seconds: time.sleep(seconds * TIME_SCALE))
+    monkeypatch.setattr(CirrusAPI, 'RETRY_DELAY', 0)
+    monkeypatch.setenv(cli.ENVIRONMENT['cache_dir'], str(tmp_path / 'cache'))
+    yield tmp_path
+
+
+def configs(directory, count):
+    paths = []
+    for index in range(count):
+        path = directory / 'build{}.yml'.format(index)
+        path.write_text(CONFIG.format(index))
+        paths.append(str(path))
+    return paths
+
+
+class CountingStream:
+    '''Stand-in for stdout that counts the text instead of keeping it in memory'''
+
+    def __init__(self):
+        self.chars = 0
+        self.lines = 0
+
+    def write(self, text):
+        self.chars += len(text)
+        self.lines += text.count('\n')
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def measure(server, monkeypatch, *args):
+    '''Run cirrus-run against fake server, return exit code and performance figures'''
+    monkeypatch.setattr(CirrusAPI, 'DEFAULT_URL', server.url)
+    tracemalloc.start()
+    time_start = time.monotonic()
+    try:
+        with pytest.raises(SystemExit) as exit:
+            cli.main(['--token', 'faketoken', '--github', 'owner/repo'] + list(args))
+        elapsed = time.monotonic() - time_start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = dict(server.stats(), rc=exit.value.code, seconds=elapsed, peak_memory=peak)
+    print('\n{}'.format(result))
+    return result
+
+
+def test_single_build(environment, monkeypatch, capsys):
+    '''Baseline: one short build'''
+    with FakeCirrusServer() as server:
+        result = measure(server, monkeypatch, *configs(environment, 1))
+    assert result['rc'] == 0
+    assert result['seconds'] < 2
+    assert result['requests'] <= 3 + 0.2 / (3 * TIME_SCALE) + 2
+
+
+def test_many_builds(environment, monkeypatch, capsys):
+    '''Status of many builds is checked with a few batched requests'''
+    with FakeCirrusServer() as server:
+        result = measure(server, monkeypatch, *configs(environment, 20))
+    assert result['rc'] == 0
+    assert result['operations']['ScheduleCustomBuild'] == 20
+    assert result['operations']['GetBuilds'] <= 0.2 / (3 * TIME_SCALE) + 3
+    assert result['seconds'] < 5
+
+
+def test_large_failed_log(environment, monkeypatch):
+    '''Large log of a failed build is streamed with bounded memory'''
+    size = 16 * 1024 * 1024
+    scenario = lambda config: BuildScript([
+        TaskScript('big', timeline=[(0, 'EXECUTING'), (0.1, 'FAILED')], commands=['a', 'b'], log_size=size),
+    ])
+    stdout = CountingStream()
+    with FakeCirrusServer(scenario) as server:
+        with monkeypatch.context() as patch:
+            patch.setattr('sys.stdout', stdout)
+            result = measure(server, monkeypatch, '--log-concurrency', '2', *configs(environment, 1))
+    print('\n{}'.format(result))
+    assert stdout.chars > 2 * size
+    assert result['rc'] == 1
+    assert result['peak_memory'] < 8 * 1024 * 1024
+    assert result['bytes_sent'] < size / 10  # compressed
+    assert result['seconds'] < 30
+
+
+def test_fail_fast_matrix(environment, monkeypatch, capsys):
+    '''Failing matrix returns in the time of the fastest failing task'''
+    scenario = lambda config: BuildScript(
+        [TaskScript('fail', timeline=[(0, 'EXECUTING'), (0.1, 'FAILED')])]
+        + [TaskScript('slow{}'.format(i), timeline=[(0, 'EXECUTING'), (60, 'COMPLETED')]) for i in range(10)]
+    )
+    with FakeCirrusServer(scenario) as server:
+        result = measure(server, monkeypatch, '--cancel-on-failure', *configs(environment, 1))
+        assert all(task['aborted'] for task in server.tasks.values() if task['script'].name != 'fail')
+    assert result['rc'] == 1
+    assert result['seconds'] < 5
+
+
+def test_unreliable_server(environment, monkeypatch, capsys):
+    '''Latency and intermittent API errors slow the run down but do not break it'''
+    errors = lambda number, method: 502 if method == 'POST' and number % 4 == 0 else None
+    with FakeCirrusServer(latency=0.01, errors=errors) as server:
+        result = measure(server, monkeypatch, *configs(environment, 3))
+    assert result['rc'] == 0
+    assert result['seconds'] < 5
@@ -0,0 +1,61 @@
+import pytest
+import responses
+from time import sleep, monotonic as time
+
+from cirrus_run.api import CirrusAPI
+from cirrus_run.queries import build_log
+
+
+LOG_URL = 'https://api.cirrus-ci.com/v1/task/{task}/logs/{command}.log'
+LOG_DELAY = 0.2  # seconds
+TASKS = 3
+COMMANDS = 4
+
+
+@pytest.fixture
+def api():
+    '''Fake API with a build that has several tasks and commands'''
+    api = CirrusAPI('faketoken')
+    tasks = []
+    for task in range(TASKS):
+        commands = [{'name': 'cmd{}'.format(command)} for command in range(COMMANDS)]
+        tasks.append({'id': str(task), 'name': 'task{}'.format(task), 'commands': commands})
+    responses.add(responses.Response(
+        method='POST',
+        url=api._url,
+        json={'data': {'build': {'tasks': tasks}}},
+    ))
+    for task in tasks:
+        for command in task['commands']:
+            url = LOG_URL.format(task=task['id'], command=command['name'])
+            responses.add_callback('GET', url, callback=slow_log)
+    yield api
+
+
+def slow_log(request):
+    '''Log endpoint that takes a while to respond'''
+    sleep(LOG_DELAY)
+    return (200, {}, 'log of {}'.format(request.url))
+
+
+def fetch(api, concurrency):
+    time_start = time()
+    chunks = list(build_log(api, 'fakebuild', concurrency=concurrency))
+    return chunks, time() - time_start
+
+
+@responses.activate
+def test_sequential_log(api):
+    '''Sequential download fetches logs one after another'''
+    chunks, elapsed = fetch(api, concurrency=1)
+    assert len(chunks) == TASKS + TASKS * COMMANDS * 3
+    assert elapsed > LOG_DELAY * TASKS * COMMANDS
+
+
+@responses.activate
+def test_concurrent_log(api):
+    '''Concurrent download is faster and preserves chunk order'''
+    expected, _ = fetch(api, concurrency=1)
+    chunks, elapsed = fetch(api, concurrency=TASKS * COMMANDS)
+    assert chunks == expected
+    assert elapsed < LOG_DELAY * 3
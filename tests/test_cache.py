@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from cirrus_run.cache import FileCache
+
+
+def test_cache(tmp_path):
+    '''Values survive between cache instances'''
+    FileCache(str(tmp_path)).set(['some', 'key'], {'hello': 'world'})
+    cache = FileCache(str(tmp_path))
+    assert cache.get(['some', 'key']) == {'hello': 'world'}
+    assert cache.get(['other', 'key']) is None
+    cache.delete(['some', 'key'])
+    assert cache.get(['some', 'key']) is None
+
+
+def test_cache_expiration(tmp_path):
+    '''Expired values are not returned'''
+    cache = FileCache(str(tmp_path), ttl=-1)
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+    assert cache.get('key', ttl=60) == 'value'
+
+
+def test_cache_unwritable(tmp_path):
+    '''Cache errors are not fatal'''
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    cache = FileCache(str(blocker / 'cache'))
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+
+
+def test_cache_concurrent_access(tmp_path):
+    '''Readers never see partially written values'''
+    cache = FileCache(str(tmp_path))
+    value = 'x' * 100000
+    cache.set('key', value)
+    def access(index):
+        if index % 2:
+            cache.set('key', value)
+        else:
+            assert cache.get('key') == value
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(access, range(200)))
+    assert [path.name for path in tmp_path.iterdir() if path.suffix == '.tmp'] == []
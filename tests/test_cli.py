@@ -0,0 +1,548 @@
+import json
+
+import pytest
+import responses
+
+from cirrus_run import cli
+from cirrus_run import queries
+from cirrus_run.api import CirrusAPI
+from cirrus_run.queries import BuildStatusTracker
+
+
+class FakeCirrus:
+    '''
+    Mocked Cirrus API
+
+    Builds finish after a few status checks. Each line of config becomes a
+    separate task which fails if it contains the word "fail" or "flaky".
+    Re-executed tasks pass unless they contain the word "fail". Tasks that
+    contain the word "slow" never finish unless aborted, tasks that contain
+    the word "late" finish after a few task or build status checks. Configs that contain
+    the word "reject" are not accepted
+    '''
+
+    def __init__(self, mock):
+        self.mock = mock
+        self.url = CirrusAPI.DEFAULT_URL
+        self.builds = {}
+        self.tasks = {}
+        self.calls = []
+        self.rerun_allowed = True
+        mock.add_callback('POST', self.url, callback=self.graphql)
+
+    def graphql(self, request):
+        payload = json.loads(request.body)
+        query, params = payload['query'], payload['variables']
+        operation = query.split()[1].split('(')[0]
+        self.calls.append(operation)
+        handler = getattr(self, operation)
+        try:
+            return (200, {}, json.dumps({'data': handler(**params)}))
+        except KeyError as exc:
+            return (200, {}, json.dumps({'errors': ['not found: {}'.format(exc)]}))
+
+    def GetRepo(self, owner, repo):
+        return {'ownerRepository': {'id': '1', 'name': repo}}
+
+    def ScheduleCustomBuild(self, config, repo, branch, mutation_id):
+        if repo != '1' or 'reject' in config:
+            raise KeyError(repo)
+        build_id = str(100 + len(self.builds))
+        self.builds[build_id] = dict(config=config, checks=0, tasks=[])
+        for index, line in enumerate(config.splitlines()):
+            task_id = build_id if index == 0 else '{}-{}'.format(build_id, index)
+            self.add_task(build_id, task_id, line, failed='fail' in line or 'flaky' in line,
+                          checks=-3 if 'late' in line else 3)
+        return {'createBuild': {'build': {'id': build_id, 'status': 'CREATED'}}}
+
+    def add_task(self, build_id, task_id, text, failed, checks=3):
+        self.builds[build_id]['tasks'].append(task_id)
+        self.tasks[task_id] = dict(name='task' + task_id, text=text, failed=failed, checks=checks, aborted=False)
+        self.mock.add('GET', CirrusAPI().log_url(task_id, 'main'), body='{}\n\n'.format(text))
+
+    def GetBuilds(self, **builds):
+        return {alias: {'status': self.status(build)} for alias, build in builds.items()}
+
+    def GetBuildLog(self, build):
+        return {'build': {'tasks': [
+            {'id': task_id, 'name': self.tasks[task_id]['name'], 'commands': [{'name': 'main'}]}
+            for task_id in self.builds[build]['tasks']
+        ]}}
+
+    def GetBuildLogStatus(self, build):
+        return {'build': {'tasks': [
+            {'id': task_id, 'name': self.tasks[task_id]['name'], 'status': self.task_status(task_id),
+             'commands': [{'name': 'main', 'status': 'FAILURE' if self.tasks[task_id]['failed'] else 'SUCCESS'}]}
+            for task_id in self.builds[build]['tasks']
+        ]}}
+
+    def GetBuildTasks(self, build):
+        return {'build': {'tasks': [
+            {'id': task_id, 'name': self.tasks[task_id]['name'], 'status': self.task_status(task_id)}
+            for task_id in self.builds[build]['tasks']
+        ]}}
+
+    def RerunTasks(self, tasks, mutation_id):
+        if not self.rerun_allowed:
+            raise KeyError(mutation_id)
+        new_tasks = []
+        for task_id in tasks:
+            build_id = next(build for build, value in self.builds.items() if task_id in value['tasks'])
+            text = 'rerun of ' + self.tasks[task_id]['text']
+            new_tasks.append(task_id + 'r')
+            self.add_task(build_id, new_tasks[-1], text, failed='fail' in text, checks=0)
+        return {'batchReRun': {'newTasks': [{'id': task_id} for task_id in new_tasks]}}
+
+    def GetBuildsTasks(self, **builds):
+        return {alias: {'status': self.status(build), 'tasks': self.GetBuildTasks(build)['build']['tasks']}
+                for alias, build in builds.items()}
+
+    def AbortTasks(self, tasks, mutation_id):
+        for task_id in tasks:
+            self.tasks[task_id]['aborted'] = True
+        return {'batchAbort': {'clientMutationId': mutation_id}}
+
+    def GetTasks(self, **tasks):
+        for task_id in tasks.values():
+            self.tasks[task_id]['checks'] += 1
+        return {alias: {'status': self.task_status(task_id)} for alias, task_id in tasks.items()}
+
+    def GetTasksLog(self, **tasks):
+        return {alias: {'id': task_id, 'name': self.tasks[task_id]['name'], 'commands': [{'name': 'main'}]}
+                for alias, task_id in tasks.items()}
+
+    def status(self, build_id):
+        build = self.builds[build_id]
+        build['checks'] += 1
+        for task_id in build['tasks']:
+            if 'late' in self.tasks[task_id]['text']:
+                self.tasks[task_id]['checks'] += 1
+        if build['checks'] < 3 or 'EXECUTING' in map(self.task_status, build['tasks']):
+            return 'EXECUTING'
+        if any(self.tasks[task_id]['failed'] for task_id in build['tasks']):
+            return 'FAILED'
+        return 'COMPLETED'
+
+    def task_status(self, task_id):
+        task = self.tasks[task_id]
+        if task['aborted']:
+            return 'ABORTED'
+        if task['checks'] < 3 or 'slow' in task['text']:
+            return 'EXECUTING'
+        return 'FAILED' if task['failed'] else 'COMPLETED'
+
+
+@pytest.fixture
+def cirrus(monkeypatch, tmp_path):
+    monkeypatch.setattr(queries, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(CirrusAPI, 'RETRY_DELAY', 0)
+    monkeypatch.setenv(cli.ENVIRONMENT['cache_dir'], str(tmp_path / 'cache'))
+    monkeypatch.setenv(cli.ENVIRONMENT['skip_validation'], 'yes')  # FakeCirrus configs are not real Cirrus configs
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as mock:
+        yield FakeCirrus(mock)
+
+
+@pytest.fixture
+def configs(tmp_path):
+    paths = {}
+    for name in ['a', 'b', 'c']:
+        path = tmp_path / '{}.yml'.format(name)
+        path.write_text('task: {}\n'.format('fail' if name == 'b' else 'pass'))
+        paths[name] = str(path)
+    yield paths
+
+
+def run(*args):
+    with pytest.raises(SystemExit) as exit:
+        cli.main(['--token', 'faketoken', '--github', 'owner/repo'] + list(args))
+    return exit.value.code
+
+
+def test_single_build(cirrus, configs, capsys):
+    '''Successful build'''
+    assert run(configs['a']) == 0
+    output = capsys.readouterr().out
+    assert 'Build created: https://cirrus-ci.com/build/100\n' in output
+    assert 'Build successful: https://cirrus-ci.com/build/100\n' in output
+    assert 'see log below' not in output
+
+
+def test_multiple_builds(cirrus, configs, capsys):
+    '''Several builds share API session and return aggregated exit code'''
+    assert run(configs['a'], configs['b'], configs['c']) == 1
+    output = capsys.readouterr().out
+    assert len(cirrus.builds) == 3
+    assert cirrus.calls.count('GetRepo') == 1
+    assert cirrus.calls.count('GetBuilds') == 2 + BuildStatusTracker.ERROR_CONFIRM_TIMES
+    failed = [build_id for build_id, build in cirrus.builds.items() if 'fail' in build['config']]
+    assert 'Build failed: https://cirrus-ci.com/build/{} ({})'.format(failed[0], configs['b']) in output
+    assert '[{}] task: fail\n'.format(configs['b']) in output
+    assert 'task: pass' not in output
+
+
+def test_multiple_builds_streamed(cirrus, tmp_path, capsys):
+    '''Result of each build is shown as soon as that build finishes'''
+    slow, fast = tmp_path / 'slow.yml', tmp_path / 'fast.yml'
+    slow.write_text('task: late pass\n')
+    fast.write_text('task: fail\n')
+    assert run(str(slow), str(fast), '--show-build-log', 'always') == 1
+    output = capsys.readouterr().out
+    build_ids = {build['config']: build_id for build_id, build in cirrus.builds.items()}
+    failed = output.index('Build failed: https://cirrus-ci.com/build/{} ({})'.format(build_ids['task: fail\n'], fast))
+    assert output.index('[{}] task: fail\n'.format(fast)) < failed
+    assert failed < output.index('[{}] task: late pass\n'.format(slow))
+    assert failed < output.index('Build successful: https://cirrus-ci.com/build/{} ({})'.format(
+                                 build_ids['task: late pass\n'], slow))
+
+
+def test_repo_id_cache(cirrus, configs):
+    '''Repo ID is resolved only once across invocations'''
+    assert run(configs['a']) == 0
+    assert run(configs['c']) == 0
+    assert cirrus.calls.count('GetRepo') == 1
+
+
+def test_repo_id_cache_invalidation(cirrus, configs):
+    '''Stale cached repo ID is resolved again'''
+    cache = cli.open_cache()
+    cache.set(['repo', 'github', 'owner', 'repo', cirrus.url], '999')
+    assert run(configs['a']) == 0
+    assert cirrus.calls.count('GetRepo') == 1
+    assert run(configs['c']) == 0
+    assert cirrus.calls.count('GetRepo') == 1
+
+
+def test_repo_id_argument(cirrus, configs):
+    '''Repo ID resolution may be skipped entirely'''
+    with pytest.raises(SystemExit) as exit:
+        cli.main(['--token', 'faketoken', '--repo-id', '1', configs['a']])
+    assert exit.value.code == 0
+    assert 'GetRepo' not in cirrus.calls
+
+
+def test_dedup(cirrus, configs, capsys):
+    '''Identical successful builds are not executed twice'''
+    assert run('--dedup', configs['a']) == 0
+    assert 'Build created: ' in capsys.readouterr().out
+    assert run('--dedup', configs['c']) == 0  # same content, different file
+    assert 'Build reused: https://cirrus-ci.com/build/100\n' in capsys.readouterr().out
+    assert run('--no-dedup', configs['a']) == 0
+    assert cirrus.calls.count('ScheduleCustomBuild') == 2
+
+
+def test_dedup_failed(cirrus, configs, monkeypatch):
+    '''Failed builds are not reused'''
+    monkeypatch.setenv(cli.ENVIRONMENT['dedup'], 'yes')
+    assert run(configs['b']) == 1
+    assert run(configs['b']) == 1
+    assert cirrus.calls.count('ScheduleCustomBuild') == 2
+
+
+def test_dedup_attach(cirrus, configs, capsys):
+    '''Identical build that is still running is waited on instead of creating a new one'''
+    cache = cli.open_cache()
+    index = cli.BuildIndex(cache)
+    config = cli.read_config(configs['a'])
+    build_id = cirrus.ScheduleCustomBuild(config, '1', 'master', '')['createBuild']['build']['id']
+    index.record(index.fingerprint(cirrus.url, '1', 'master', config), build_id, index.PENDING)
+    assert run('--dedup', configs['a']) == 0
+    assert 'Build attached: https://cirrus-ci.com/build/{}\n'.format(build_id) in capsys.readouterr().out
+    assert 'ScheduleCustomBuild' not in cirrus.calls
+
+
+def test_attach(cirrus, configs, capsys):
+    '''Existing build may be waited on'''
+    build_id = cirrus.ScheduleCustomBuild('fail', '1', 'master', '')['createBuild']['build']['id']
+    assert run('--attach', build_id, 'no-such-file.yml') == 1
+    output = capsys.readouterr().out
+    assert 'Build attached: https://cirrus-ci.com/build/{}\n'.format(build_id) in output
+    assert 'ScheduleCustomBuild' not in cirrus.calls
+
+
+def test_resume_file(cirrus, configs, tmp_path, monkeypatch, capsys):
+    '''Progress is saved to resume file'''
+    monkeypatch.setattr(cli.ResumeFile, 'remove', lambda self: None)
+    resume_file = str(tmp_path / 'resume.json')
+    assert run('--resume-file', resume_file, '--show-build-log', 'always', configs['a']) == 0
+    saved = cli.ResumeFile(resume_file).get(configs['a'])
+    assert saved == {'build_id': '100', 'offsets': [['100', 'main', len('task: pass\n\n')]]}
+
+
+def test_resume(cirrus, configs, tmp_path, capsys):
+    '''Restarted process continues waiting and prints only remaining log'''
+    build_id = cirrus.ScheduleCustomBuild('printed\nremaining', '1', 'master', '')['createBuild']['build']['id']
+    resume_file = cli.ResumeFile(str(tmp_path / 'resume.json'))
+    resume_file.update(configs['a'], build_id, [[build_id, 'main', len('printed\n')]])
+    resume_file.save()
+    assert run('--resume-file', resume_file.path, '--show-build-log', 'always', configs['a']) == 0
+    output = capsys.readouterr().out
+    assert 'Build attached: https://cirrus-ci.com/build/{}\n'.format(build_id) in output
+    assert 'remaining' in output
+    assert 'printed' not in output
+    assert not (tmp_path / 'resume.json').exists()
+    assert 'ScheduleCustomBuild' not in cirrus.calls
+
+
+def test_config_directory(cirrus, configs, tmp_path, capsys):
+    '''Directories are expanded to config files'''
+    (tmp_path / 'README').write_text('not a config')
+    assert run(str(tmp_path), '--show-build-log', 'always') == 1
+    output = capsys.readouterr().out
+    assert len(cirrus.builds) == 3
+    assert '[{}] task: pass\n'.format(configs['c']) in output
+
+
+def test_line_prefixer():
+    '''Prefix is added to every line regardless of chunk boundaries'''
+    add_prefix = cli.line_prefixer('> ')
+    chunks = ['one\ntw', 'o\n', '', 'three', '\n']
+    assert ''.join(add_prefix(chunk) for chunk in chunks) == '> one\n> two\n> three\n'
+
+
+def test_batched_status(cirrus):
+    '''Status lookups are batched into a limited number of requests'''
+    api = CirrusAPI('faketoken')
+    build_ids = [cirrus.ScheduleCustomBuild('', '1', '', '')['createBuild']['build']['id'] for _ in range(5)]
+    statuses = queries.build_statuses(api, build_ids, batch_size=2)
+    assert statuses == {build_id: 'EXECUTING' for build_id in build_ids}
+    assert cirrus.calls == ['GetBuilds'] * 3
+
+
+@pytest.fixture
+def markers(tmp_path):
+    path = tmp_path / 'markers'
+    path.write_text('flaky\n')
+    yield str(path)
+
+
+def test_flaky_tasks(cirrus, tmp_path, markers, capsys):
+    '''Only the tasks that have flaked are executed again'''
+    config = tmp_path / 'flaky.yml'
+    config.write_text('task: pass\ntask: flaky\ntask: pass\n')
+    assert run('--flaky-markers', markers, str(config)) == 0
+    output = capsys.readouterr().out
+    assert len(cirrus.builds) == 1
+    assert cirrus.calls.count('RerunTasks') == 1
+    assert [task_id for task_id in cirrus.tasks if task_id.endswith('r')] == ['100-1r']
+    assert 'Flaky build detected: "flaky", re-running 1 failed task(s)...' in output
+    assert 'rerun of task: flaky' not in output
+    assert output.endswith('Build successful: https://cirrus-ci.com/build/100\n')
+
+
+def test_flaky_tasks_retries(cirrus, tmp_path, markers, capsys):
+    '''Flaky tasks are retried no more than requested number of times'''
+    config = tmp_path / 'flaky.yml'
+    config.write_text('task: flaky fail\n')
+    assert run('--flaky-markers', markers, '--flaky-retries', '3', str(config)) == 1
+    output = capsys.readouterr().out
+    assert cirrus.calls.count('RerunTasks') == 3
+    assert 'rerun of rerun of rerun of task: flaky fail' in output
+    assert output.endswith('Build failed: https://cirrus-ci.com/build/100\n')
+
+
+def test_flaky_tasks_with_other_failures(cirrus, tmp_path, markers):
+    '''Nothing is retried when some failures do not look flaky'''
+    config = tmp_path / 'flaky.yml'
+    config.write_text('task: flaky\ntask: fail\n')
+    assert run('--flaky-markers', markers, str(config)) == 1
+    assert 'RerunTasks' not in cirrus.calls
+    assert len(cirrus.builds) == 1
+
+
+@pytest.mark.parametrize('task, rc', [('late pass', 0), ('late fail', 1)])
+def test_flaky_tasks_fail_fast(cirrus, tmp_path, markers, capsys, task, rc):
+    '''Tasks that were still running when the build has failed fast are waited for'''
+    config = tmp_path / 'flaky.yml'
+    config.write_text('task: flaky\ntask: {}\n'.format(task))
+    assert run('--fail-fast', '--flaky-markers', markers, str(config)) == rc
+    assert cirrus.calls.count('RerunTasks') == 1
+    assert cirrus.task_status('100-1') != 'EXECUTING'
+    assert capsys.readouterr().out.endswith('Build {}: https://cirrus-ci.com/build/100\n'.format(
+                                            'successful' if rc == 0 else 'failed'))
+
+
+def test_flaky_rebuild(cirrus, tmp_path, markers, capsys):
+    '''Whole build is retried when tasks can not be re-run'''
+    cirrus.rerun_allowed = False
+    config = tmp_path / 'flaky.yml'
+    config.write_text('task: pass\ntask: flaky\n')
+    assert run('--flaky-markers', markers, str(config)) == 1
+    output = capsys.readouterr().out
+    assert len(cirrus.builds) == 2
+    assert 'Flaky build detected: "flaky", retrying...' in output
+
+
+def test_fail_fast(cirrus, tmp_path, capsys):
+    '''Build failure is reported as soon as any task fails'''
+    config = tmp_path / 'matrix.yml'
+    config.write_text('task: pass\ntask: fail\ntask: slow\n')
+    assert run('--cancel-on-failure', str(config)) == 1
+    output = capsys.readouterr().out
+    assert cirrus.calls.count('GetBuildsTasks') == 1
+    assert 'GetBuilds' not in cirrus.calls
+    assert cirrus.calls.count('AbortTasks') == 1
+    assert cirrus.tasks['100-2']['aborted']
+    assert not cirrus.tasks['100']['aborted']
+    assert 'Build failed: https://cirrus-ci.com/build/100\n' in output
+
+
+def test_task_events(cirrus):
+    '''Task status changes are reported to the caller'''
+    build_id = cirrus.ScheduleCustomBuild('task: pass\ntask: fail\n', '1', 'master', '')['createBuild']['build']['id']
+    events = []
+    finished = list(queries.wait_builds(CirrusAPI(), [build_id], on_task=events.append))
+    assert finished[0][0] == build_id
+    assert isinstance(finished[0][1], queries.CirrusBuildError)
+    assert [(event.task_id, event.status, event.previous) for event in events] == [
+        ('100', 'COMPLETED', None),
+        ('100-1', 'FAILED', None),
+    ]
+    assert cirrus.calls.count('GetBuildsTasks') == 2 + BuildStatusTracker.ERROR_CONFIRM_TIMES
+
+
+def test_watch_build(cirrus):
+    '''Build and task status transitions are reported once each'''
+    build_id = cirrus.ScheduleCustomBuild('task: pass\ntask: fail\n', '1', 'master', '')['createBuild']['build']['id']
+    events = list(queries.watch_build(CirrusAPI(), build_id))
+    assert [(type(event).__name__, event.status) for event in events] == [
+        ('TaskEvent', 'COMPLETED'),
+        ('TaskEvent', 'FAILED'),
+        ('BuildEvent', 'EXECUTING'),
+        ('BuildEvent', 'FAILED'),
+        ('BuildFinished', 'FAILED'),
+    ]
+    assert events[3].previous == 'EXECUTING'
+    assert isinstance(events[-1].error, queries.CirrusBuildError)
+    assert all(earlier.timestamp <= later.timestamp for earlier, later in zip(events, events[1:]))
+
+
+@pytest.mark.parametrize('format', ['json', 'prometheus'])
+def test_metrics_file(cirrus, configs, tmp_path, format):
+    '''API usage metrics are saved on exit'''
+    path = tmp_path / 'metrics'
+    assert run('--metrics-file', str(path), '--metrics-format', format, configs['b']) == 1
+    if format == 'prometheus':
+        text = path.read_text()
+        assert 'cirrus_run_graphql_requests_total{operation="GetBuilds"} 5\n' in text
+        assert 'cirrus_run_build_log_seconds_count 1\n' in text
+    else:
+        summary = json.loads(path.read_text())
+        counters = {(c['name'], c['labels'].get('operation')): c['value'] for c in summary['counters']}
+        assert counters[('graphql_requests_total', 'GetBuilds')] == 2 + BuildStatusTracker.ERROR_CONFIRM_TIMES
+        assert counters[('log_bytes_total', None)] == len('task: fail\n\n')
+
+
+def test_jsonl_output(cirrus, configs, capsys):
+    '''Machine readable output: one JSON record per event'''
+    assert run('--format', 'jsonl', configs['a'], configs['b']) == 1
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    events = {}
+    for record in records:
+        events.setdefault((record['config'], record['event']), []).append(record)
+    assert events[(configs['a'], 'build')][0]['action'] == 'created'
+    assert [r['status'] for r in events[(configs['b'], 'status')]] == ['EXECUTING', 'FAILED']
+    assert [r['status'] for r in events[(configs['b'], 'task_status')]] == ['FAILED']
+    log, = events[(configs['b'], 'log')]
+    assert log['text'] == 'task: fail\n\n'
+    assert log['task_id'] == log['build_id'] and log['command'] == 'main'
+    assert (configs['a'], 'log') not in events
+    result = events[(configs['b'], 'result')][0]
+    assert result['status'] == 'failed' and result['rc'] == 1
+    assert result['duration'] >= 0
+    assert records[-1]['event'] == 'result'
+
+
+def test_log_dir(cirrus, tmp_path, capsys):
+    '''Command logs are saved to files, only failures are printed'''
+    config = tmp_path / 'matrix.yml'
+    config.write_text('task: pass\ntask: fail\n')
+    log_dir = tmp_path / 'logs'
+    assert run('--log-dir', str(log_dir), '--log-concurrency', '2', str(config)) == 1
+    output = capsys.readouterr().out
+    assert (log_dir / '100' / 'task100-100' / 'main.log').read_text() == 'task: pass\n\n'
+    assert (log_dir / '100' / 'task100-1-100-1' / 'main.log').read_text() == 'task: fail\n\n'
+    assert 'Build failed, log saved to {}\n'.format(log_dir / '100') in output
+    assert '  task100: COMPLETED\n  task100-1: FAILED\n' in output
+    assert '## Task: task100-1, last 2 lines of' in output
+    assert 'task: fail\n' in output
+    assert 'task: pass' not in output
+
+
+def test_validate_only(tmp_path, capsys):
+    '''Configs are checked without API token and without submitting builds'''
+    valid = tmp_path / 'valid.yml'
+    valid.write_text('task:\n  container:\n    image: debian\n  test_script: true\n')
+    invalid = tmp_path / 'invalid.yml'
+    invalid.write_text('task:\n  - test_script: true\n')
+    with pytest.raises(SystemExit) as exit:
+        cli.main(['--validate-only', str(valid)])
+    assert exit.value.code == 0
+    assert 'Config is valid' in capsys.readouterr().out
+    with pytest.raises(SystemExit) as exit:
+        cli.main(['--validate-only', str(valid), str(invalid)])
+    assert exit.value.code == 2
+    assert '{}:2:3: error: task must be a mapping'.format(invalid) in capsys.readouterr().out
+    incomplete = tmp_path / 'incomplete.yml'
+    incomplete.write_text('task:\n  container:\n    cpu: 2\n  test_script: true\n')
+    with pytest.raises(SystemExit) as exit:
+        cli.main(['--validate-only', str(incomplete)])
+    assert exit.value.code == 0  # schema warnings do not block submission
+    assert 'warning: task.container requires image or dockerfile' in capsys.readouterr().out
+
+
+def test_invalid_config(cirrus, tmp_path, monkeypatch, capsys):
+    '''No builds are created if any config is invalid'''
+    monkeypatch.delenv(cli.ENVIRONMENT['skip_validation'])
+    config = tmp_path / 'invalid.yml'
+    config.write_text('task: pass\n')
+    assert run(str(config)) == 2
+    assert 'ScheduleCustomBuild' not in cirrus.calls
+    assert 'task must be a mapping' in capsys.readouterr().out
+
+
+def test_config_read_error(cirrus, tmp_path, monkeypatch, capsys):
+    '''Configs that can not be rendered are reported as invalid'''
+    monkeypatch.delenv(cli.ENVIRONMENT['skip_validation'])
+    config = tmp_path / 'broken.yml.j2'
+    config.write_text('task:\n  name: {{ unclosed\n')
+    assert run(str(config)) == 2
+    assert 'ScheduleCustomBuild' not in cirrus.calls
+    output = capsys.readouterr().out
+    assert '{}:1:1: error: TemplateSyntaxError'.format(config) in output
+    assert 'Config is invalid' in output
+
+
+def test_minify_config(cirrus, tmp_path, capsys):
+    '''Minified config is submitted'''
+    config = tmp_path / 'config.yml'
+    config.write_text('# comment\ntask:\n  name: pass\n')
+    assert run('--minify-config', str(config)) == 0
+    assert [build['config'] for build in cirrus.builds.values()] == ['{task: {name: pass}}\n']
+
+
+def test_create_build_error(cirrus, configs, tmp_path, capsys):
+    '''Builds created for other configs are still waited for if one can not be created'''
+    rejected = tmp_path / 'rejected.yml'
+    rejected.write_text('task: reject\n')
+    assert run(configs['a'], str(rejected)) == 2
+    output = capsys.readouterr().out
+    assert 'Build successful: https://cirrus-ci.com/build/100 ({})'.format(configs['a']) in output
+    assert 'Build error: not created ({})'.format(rejected) in output
+    assert 'CirrusAPIError' in output
+
+
+def test_resume_checkpoints(cirrus, tmp_path, monkeypatch):
+    '''Progress is saved after each printed command log, not only after the whole build log'''
+    config = tmp_path / 'config.yml'
+    config.write_text('task: first\ntask: crash\n')
+    resume_path = str(tmp_path / 'resume.json')
+
+    def log(self, job, chunk, flush=False):
+        if 'crash' in chunk:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(cli.TextOutput, 'log', log)
+    with pytest.raises(KeyboardInterrupt):
+        cli.main(['--token', 'faketoken', '--github', 'owner/repo', '--resume-file', resume_path,
+                  '--show-build-log', 'always', str(config)])
+    saved = cli.ResumeFile(resume_path).get(str(config))
+    assert saved['offsets'] == [[saved['build_id'], 'main', len('task: first\n\n')]]
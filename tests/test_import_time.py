@@ -0,0 +1,63 @@
+'''
+Command line startup must not pay for the imports it does not need
+'''
+
+import subprocess
+import sys
+
+
+IMPORT_BUDGET = 0.1  # seconds, measured with `python -X importtime`
+HEAVY_MODULES = {'requests', 'urllib3', 'jinja2', 'pprint', 'yaml'}
+
+
+def import_times(code):
+    '''Return cumulative import time (seconds) of each top-level module imported by code'''
+    subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, check=True)  # warm up bytecode cache
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        try:
+            times[name.strip()] = int(cumulative) / 1000000
+        except ValueError:
+            continue  # header
+    return times
+
+
+def test_cli_import_time():
+    '''Importing the CLI does not load HTTP client or template engine'''
+    times = import_times('import cirrus_run.cli')
+    print('\ncirrus_run.cli import time: {:.3f}s'.format(times['cirrus_run.cli']))
+    assert not HEAVY_MODULES & {name.split('.')[0] for name in times}
+    assert times['cirrus_run.cli'] < IMPORT_BUDGET
+
+
+def test_help_import():
+    '''--help does not need heavy modules either'''
+    times = import_times(
+        'from cirrus_run.cli import parse_args\n'
+        'try:\n'
+        '    parse_args(["--help"])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+    )
+    assert not HEAVY_MODULES & {name.split('.')[0] for name in times}
+
+
+def test_deferred_imports():
+    '''Heavy modules are loaded on first use'''
+    times = import_times(
+        'from cirrus_run import CirrusAPI\n'
+        'from cirrus_run.cli import template_environment\n'
+        'CirrusAPI("token")\n'
+        'template_environment(".")\n'
+    )
+    assert {'requests', 'jinja2'} <= set(times)
@@ -0,0 +1,73 @@
+'''
+Check that build log is streamed instead of being loaded into memory
+'''
+
+import json
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from cirrus_run.api import CirrusAPI
+from cirrus_run.queries import build_log
+
+
+LOG_SIZE = 64 * 1024 * 1024  # bytes
+LOG_LINE = b'Lorem ipsum dolor sit amet, consectetur adipiscing elit\n'
+MEMORY_LIMIT = 8 * 1024 * 1024  # bytes
+
+
+class FakeLogServer(BaseHTTPRequestHandler):
+    '''Serve a single task with a huge log generated on the fly'''
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'data': {'build': {'tasks': [
+            {'id': '1', 'name': 'huge', 'commands': [{'name': 'main'}]},
+        ]}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        lines = LOG_SIZE // len(LOG_LINE)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(lines * len(LOG_LINE)))
+        self.end_headers()
+        block = LOG_LINE * 1024
+        for _ in range(lines // 1024):
+            self.wfile.write(block)
+        self.wfile.write(LOG_LINE * (lines % 1024))
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+@pytest.fixture
+def api():
+    '''API instance talking to local fake server'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLogServer)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield CirrusAPI('faketoken', url='http://127.0.0.1:{}/graphql'.format(server.server_port))
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_log_memory_usage(api, concurrency):
+    '''Peak memory usage does not depend on log size'''
+    received = 0
+    tracemalloc.start()
+    try:
+        for chunk in build_log(api, 'fakebuild', concurrency=concurrency):
+            received += len(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert received > LOG_SIZE * 0.99
+    assert peak < MEMORY_LIMIT
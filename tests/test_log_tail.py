@@ -0,0 +1,93 @@
+import json
+
+import pytest
+import responses
+
+from cirrus_run.api import CirrusAPI
+from cirrus_run.queries import LogTail
+
+
+class GrowingBuild:
+    '''Fake build with a single command that produces output over time'''
+
+    def __init__(self, api, honor_range=True):
+        self.api = api
+        self.honor_range = honor_range
+        self.output = b''
+        self.status = 'UNDEFINED'
+        self.ranges = []
+        responses.add_callback('POST', api._url, callback=self.graphql)
+        responses.add_callback('GET', api.log_url('42', 'main'), callback=self.log)
+
+    def graphql(self, request):
+        tasks = [{'id': '42', 'name': 'test', 'commands': [{'name': 'main', 'status': self.status}]}]
+        return (200, {}, json.dumps({'data': {'build': {'tasks': tasks}}}))
+
+    def log(self, request):
+        header = request.headers.get('Range')
+        self.ranges.append(header)
+        if header and self.honor_range:
+            offset = int(header[len('bytes='):-1])
+            if offset >= len(self.output):
+                return (416, {}, b'')
+            return (206, {}, self.output[offset:])
+        return (200, {}, self.output)
+
+    def append(self, text, status='EXECUTING'):
+        self.output += text.encode('utf-8')
+        self.status = status
+
+
+def output(tail):
+    return ''.join(chunk for chunk in tail.poll() if not chunk.startswith('\n## '))
+
+
+@pytest.mark.parametrize('honor_range', [True, False])
+@responses.activate
+def test_log_tail(honor_range):
+    '''Only new output is yielded on each poll'''
+    api = CirrusAPI('faketoken')
+    build = GrowingBuild(api, honor_range=honor_range)
+    tail = LogTail(api, 'fakebuild')
+
+    assert output(tail) == ''
+    assert build.ranges == []
+
+    build.append('hello\n')
+    assert output(tail) == 'hello\n'
+
+    build.append('wor')
+    assert output(tail) == 'wor'
+    assert output(tail) == ''
+
+    build.append('ld: ✓\n', status='SUCCESS')
+    assert output(tail) == 'ld: ✓\n'
+    assert output(tail) == ''
+
+    assert build.ranges == [None, 'bytes=6-', 'bytes=9-', 'bytes=9-']
+
+
+@responses.activate
+def test_log_tail_split_character():
+    '''Multibyte characters split between polls are decoded correctly'''
+    api = CirrusAPI('faketoken')
+    build = GrowingBuild(api)
+    tail = LogTail(api, 'fakebuild')
+    encoded = '✓'.encode('utf-8')
+    build.output = encoded[:1]
+    build.status = 'EXECUTING'
+    assert output(tail) == ''
+    build.output = encoded
+    assert output(tail) == '✓'
+
+
+@responses.activate
+def test_log_tail_headers():
+    '''Task and command headers are printed once per stretch of output'''
+    api = CirrusAPI('faketoken')
+    build = GrowingBuild(api)
+    tail = LogTail(api, 'fakebuild')
+    build.append('one\n')
+    assert list(tail.poll()) == ['\n## Task: test\n', '\n## Task instruction: main\n', 'one\n']
+    build.append('two\n')
+    assert list(tail.poll()) == ['two\n']
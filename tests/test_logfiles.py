@@ -0,0 +1,39 @@
+import pytest
+
+from cirrus_run.logfiles import safe_filename, tail_lines
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 8192])
+def test_tail_lines(tmp_path, block_size):
+    '''Last lines are read from the end of file'''
+    path = tmp_path / 'test.log'
+    path.write_text(''.join('line {} ✓\n'.format(i) for i in range(1000)))
+    assert tail_lines(str(path), 3, block_size) == ['line 997 ✓', 'line 998 ✓', 'line 999 ✓']
+    assert tail_lines(str(path), 0, block_size) == []
+    assert len(tail_lines(str(path), 5000, block_size)) == 1000
+
+
+def test_tail_lines_large_file(tmp_path, monkeypatch):
+    '''Only the end of a large file is read'''
+    path = tmp_path / 'large.log'
+    with open(str(path), 'w') as f:
+        for i in range(200000):
+            f.write('some build output {}\n'.format(i))
+    reads = []
+    original = open
+
+    def tracking_open(*a, **ka):
+        handle = original(*a, **ka)
+        read = handle.read
+        handle.read = lambda size=-1: reads.append(size) or read(size)
+        return handle
+
+    monkeypatch.setattr('builtins.open', tracking_open)
+    assert tail_lines(str(path), 2) == ['some build output 199998', 'some build output 199999']
+    assert sum(reads) <= 8192
+
+
+def test_safe_filename():
+    '''Task and command names are turned into portable file names'''
+    assert safe_filename('Linux / py3.9 (arm64)') == 'Linux_py3.9_arm64'
+    assert safe_filename('..') == '_'
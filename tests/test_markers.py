@@ -0,0 +1,97 @@
+import random
+import string
+from time import monotonic as time
+
+import pytest
+
+from cirrus_run.cli import parse_args
+from cirrus_run.markers import MarkerScanner
+
+
+def test_literal_markers():
+    '''Plain text markers are found and reported'''
+    scanner = MarkerScanner(['connection reset', 'connection refused', 'no space left'])
+    assert scanner.feed('all good here\n') is None
+    assert scanner.feed('curl: connection refused\n') == 'connection refused'
+
+
+def test_prefix_markers():
+    '''Markers that are prefixes of each other are both detected'''
+    scanner = MarkerScanner(['timeout', 'timeout exceeded'])
+    assert scanner.feed('operation timeout') == 'timeout'
+    scanner = MarkerScanner(['timeout', 'timeout exceeded'])
+    assert scanner.feed('timeout exceeded') in {'timeout', 'timeout exceeded'}
+
+
+def test_regex_markers():
+    '''Markers prefixed with "re:" are regular expressions'''
+    scanner = MarkerScanner(['re:exit (code|status) 1[0-9]{2}', 'segfault'])
+    assert scanner.feed('process exited with exit code 1') is None
+    assert scanner.feed('process exited with exit status 137') == 're:exit (code|status) 1[0-9]{2}'
+
+
+def test_regex_flags_and_backreferences():
+    '''Each regular expression is compiled on its own'''
+    scanner = MarkerScanner(['re:(?i)connection reset', r're:(a)\1', 'timeout'])
+    assert scanner.feed('CONNECTION RESET by peer\n') == 're:(?i)connection reset'
+    assert scanner.copy().feed('xaax\n') == r're:(a)\1'
+    assert scanner.copy().feed('xax timeout\n') == 'timeout'
+
+
+def test_invalid_regex_marker(tmp_path, capsys):
+    '''Invalid markers are reported when command line is parsed'''
+    with pytest.raises(ValueError, match='invalid flaky marker'):
+        MarkerScanner(['re:(unbalanced'])
+    path = tmp_path / 'markers'
+    path.write_text('re:(unbalanced\n')
+    with pytest.raises(SystemExit) as exit:
+        parse_args(['--token', 'x', '--github', 'owner/repo', '--flaky-markers', str(path), __file__])
+    assert exit.value.code == 2
+    assert 'invalid flaky marker' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('markers', [
+    ['connection reset by peer'],
+    ['re:connection re[a-z]+ by peer'],
+])
+def test_marker_across_chunks(markers):
+    '''Markers that straddle chunk boundaries are not missed'''
+    scanner = MarkerScanner(markers)
+    assert scanner.feed('error: connection re') is None
+    assert scanner.feed('set by') is None
+    assert scanner.feed(' peer\n') == markers[0]
+
+
+def test_markers_file(tmp_path):
+    '''Markers file ignores comments and blank lines'''
+    markers = tmp_path / 'markers'
+    markers.write_text('# comment\n\nrandom failure\nre:flak[ey]\n')
+    scanner = MarkerScanner.from_file(str(markers))
+    assert scanner.feed('# comment') is None
+    assert scanner.feed('a random fail') is None
+    assert scanner.feed('ure happened') == 'random failure'
+
+
+def test_many_markers_performance():
+    '''Scanning for many markers is faster than checking them one by one'''
+    rng = random.Random(42)
+    alphabet = string.ascii_lowercase + ' \n'
+    markers = [
+        ''.join(rng.choice(alphabet) for _ in range(rng.randint(10, 40)))
+        for _ in range(5000)
+    ]
+    chunk = ''.join(rng.choice(alphabet) for _ in range(64 * 1024))
+    chunks = 16
+
+    scanner = MarkerScanner(markers)
+    time_start = time()
+    for _ in range(chunks):
+        assert scanner.feed(chunk) is None
+    scanner_time = time() - time_start
+
+    time_start = time()
+    for _ in range(chunks):
+        assert not any(marker in chunk for marker in markers)
+    naive_time = time() - time_start
+
+    assert scanner_time < naive_time
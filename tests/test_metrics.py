@@ -0,0 +1,74 @@
+from time import monotonic as time
+
+import pytest
+import responses
+
+from cirrus_run import metrics
+from cirrus_run.api import CirrusAPI
+
+
+@pytest.fixture
+def registry():
+    registry = metrics.enable()
+    yield registry
+    metrics.disable()
+
+
+def test_counters_and_histograms(registry):
+    '''Metrics are aggregated by name and labels'''
+    metrics.count('requests_total', operation='A')
+    metrics.count('requests_total', operation='A')
+    metrics.count('requests_total', operation='B')
+    for value in [0.02, 0.3, 100]:
+        metrics.observe('request_seconds', value, operation='A')
+    summary = registry.summary()
+    assert summary['counters'] == [
+        dict(name='requests_total', labels={'operation': 'A'}, value=2),
+        dict(name='requests_total', labels={'operation': 'B'}, value=1),
+    ]
+    histogram, = summary['histograms']
+    assert histogram['count'] == 3
+    assert histogram['buckets']['0.01'] == 0
+    assert histogram['buckets']['0.05'] == 1
+    assert histogram['buckets']['0.5'] == 2
+    assert histogram['buckets']['60'] == 2
+    assert histogram['buckets']['+Inf'] == 3
+
+
+def test_prometheus_format(registry):
+    '''Metrics may be exported in Prometheus text format'''
+    metrics.count('requests_total', operation='GetBuilds')
+    metrics.observe('request_seconds', 0.2)
+    text = registry.prometheus()
+    assert '# TYPE cirrus_run_requests_total counter\n' in text
+    assert 'cirrus_run_requests_total{operation="GetBuilds"} 1\n' in text
+    assert '# TYPE cirrus_run_request_seconds histogram\n' in text
+    assert 'cirrus_run_request_seconds_bucket{le="0.25"} 1\n' in text
+    assert 'cirrus_run_request_seconds_count 1\n' in text
+
+
+@responses.activate
+def test_api_retries(registry):
+    '''API client reports requests, errors and retries by operation name'''
+    api = CirrusAPI('faketoken')
+    responses.add(responses.Response(method='POST', url=api._url, status=502))
+    responses.add(responses.Response(method='POST', url=api._url, json={'data': {'hello': 'world'}}))
+    assert api('query Hello { hello }', delay=0) == {'hello': 'world'}
+    counters = {(c['name'], c['labels'].get('operation')): c['value'] for c in registry.summary()['counters']}
+    assert counters[('graphql_requests_total', 'Hello')] == 2
+    assert counters[('graphql_errors_total', 'Hello')] == 1
+    assert counters[('api_retries_total', 'Hello')] == 1
+    histogram, = registry.summary()['histograms']
+    assert histogram['name'] == 'graphql_request_seconds'
+    assert histogram['count'] == 2
+
+
+def test_disabled_overhead():
+    '''Instrumentation calls are cheap when metrics are not collected'''
+    metrics.disable()
+    time_start = time()
+    for _ in range(100000):
+        metrics.count('requests_total', operation='A')
+        with metrics.timer('request_seconds', operation='A'):
+            pass
+    assert time() - time_start < 1
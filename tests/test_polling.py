@@ -0,0 +1,125 @@
+'''
+Compare polling policies against a simulated build timeline
+'''
+
+import pytest
+
+from cirrus_run import queries
+from cirrus_run.polling import PollingPolicy, AdaptivePolling
+
+
+class SimulatedBuild:
+    '''Fake API and clock for a build with predefined status timeline'''
+
+    def __init__(self, timeline):
+        self.timeline = timeline  # list of (seconds since start, status)
+        self.now = 0
+        self.calls = 0
+
+    def __call__(self, query, params=None):
+        self.calls += 1
+        status = None
+        for start, value in self.timeline:
+            if self.now >= start:
+                status = value
+        return {'b0': {'status': status}}
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+TIMELINE = [
+    (0, 'CREATED'),
+    (20, 'TRIGGERED'),
+    (60, 'EXECUTING'),
+    (40 * 60, 'COMPLETED'),
+]
+
+
+@pytest.fixture
+def build(monkeypatch):
+    build = SimulatedBuild(TIMELINE)
+    monkeypatch.setattr(queries, 'time', build.time)
+    monkeypatch.setattr(queries, 'sleep', build.sleep)
+    yield build
+
+
+def wait(build, policy):
+    assert queries.wait_build(build, 'fakebuild', abort=2*60*60, policy=policy)
+    return build.calls, build.now - TIMELINE[-1][0]
+
+
+def test_fixed_polling(build):
+    '''Default policy polls every few seconds'''
+    calls, latency = wait(build, PollingPolicy(3))
+    assert calls > 40 * 60 / 3
+    assert latency <= 3
+
+
+def test_adaptive_polling(build):
+    '''Adaptive policy makes an order of magnitude fewer requests'''
+    calls, latency = wait(build, AdaptivePolling(3, max_delay=60, seed=1))
+    assert calls < 40 * 60 / 3 / 10
+    assert latency <= 60 * 1.2
+
+
+def test_adaptive_polling_expected_duration(build):
+    '''Known build duration allows to skip most of the status checks'''
+    calls, latency = wait(build, AdaptivePolling(3, max_delay=60, expected_duration=40*60, seed=1))
+    assert calls < 30
+    assert latency <= 60 * 1.2
+
+
+def test_adaptive_polling_expected_delay_limit():
+    '''Sleeps based on expected build duration are limited, early failures are noticed'''
+    policy = AdaptivePolling(expected_duration=40*60, max_expected_delay=300, seed=1)
+    delays = [policy.next_delay('EXECUTING', False, elapsed) for elapsed in [60, 360, 31*60]]
+    assert delays[:2] == [300, 300]
+    assert delays[2] <= 60 * 1.2
+    assert policy.next_delay('CREATED', False, 0) <= 60 * 1.2
+
+
+def test_adaptive_polling_reset():
+    '''Delay is reset on status change'''
+    policy = AdaptivePolling(2, factor=2, max_delay=10, jitter=0)
+    delays = [policy.next_delay('EXECUTING', changed, 0) for changed in [True, False, False, False, True]]
+    assert delays == [2, 4, 8, 10, 2]
+
+
+def test_adaptive_polling_jitter():
+    '''Jitter stays within requested bounds'''
+    policy = AdaptivePolling(10, factor=1, jitter=0.1)
+    delays = [policy.next_delay('EXECUTING', False, 0) for _ in range(100)]
+    assert all(9 <= delay <= 11 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+class RecordingPolicy(PollingPolicy):
+
+    def __init__(self):
+        super().__init__(3)
+        self.changes = []
+
+    def next_delay(self, status, changed, elapsed):
+        self.changes.append(changed)
+        return super().next_delay(status, changed, elapsed)
+
+
+def test_task_change_resets_backoff(build):
+    '''Task transitions count as changes even while build status stays EXECUTING'''
+    def api(query, params=None):
+        build.calls += 1
+        task_status = 'COMPLETED' if build.now >= 12 else 'EXECUTING'
+        status = 'COMPLETED' if build.now >= 30 else 'EXECUTING'
+        return {'b0': {'status': status, 'tasks': [
+            {'id': 't1', 'name': 'first', 'status': task_status},
+            {'id': 't2', 'name': 'second', 'status': 'EXECUTING'},
+        ]}}
+
+    policy = RecordingPolicy()
+    list(queries.watch_builds(api, ['fakebuild'], policy=policy))
+    # t=0 first observation, t=12 first task completes, otherwise no changes
+    assert policy.changes == [True, False, False, False, True, False, False, False, False, False]
@@ -0,0 +1,104 @@
+'''
+Starlark configs are evaluated locally and cached
+'''
+
+import os
+
+import pytest
+import yaml
+
+from cirrus_run import cli
+from cirrus_run import star
+from cirrus_run.cache import FileCache
+from cirrus_run.validation import validate_config
+
+
+@pytest.fixture
+def starlark():
+    return pytest.importorskip('starlark')
+
+
+@pytest.fixture
+def scripts(tmp_path):
+    (tmp_path / 'lib.star').write_text('IMAGE = "debian:stable-slim"\n')
+    (tmp_path / '.cirrus.star').write_text(
+        'load("lib.star", "IMAGE")\n'
+        '\n'
+        'def main(ctx):\n'
+        '    return [{"name": n, "container": {"image": IMAGE}, "script": "make " + n} for n in ["lint", "test"]]\n'
+    )
+    yield tmp_path
+
+
+def test_sample_config(starlark):
+    path = os.path.join(os.path.dirname(__file__), 'sample_build_config.star')
+    config = cli.read_config(path)
+    assert validate_config(config) == []
+    assert yaml.safe_load(config) == {'task': {'container': {'image': 'debian:stable-slim'},
+                                               'script': 'echo Hello World'}}
+
+
+def test_evaluation_cache(starlark, scripts, monkeypatch):
+    '''Script is evaluated again only if it or any of loaded modules has changed'''
+    cache = FileCache(str(scripts / 'cache'))
+    path = str(scripts / '.cirrus.star')
+    config = star.evaluate_config(path, cache)
+    assert config.count('task:') == 2
+    assert 'image: debian:stable-slim' in config
+
+    evaluations = []
+    evaluate = star.evaluate
+    monkeypatch.setattr(star, 'evaluate', lambda *a: evaluations.append(a) or evaluate(*a))
+    assert star.evaluate_config(path, cache) == config
+    assert not evaluations
+
+    (scripts / 'lib.star').write_text('IMAGE = "debian:testing"\n')
+    assert 'image: debian:testing' in star.evaluate_config(path, cache)
+    assert len(evaluations) == 1
+
+
+def test_evaluation_error(starlark, tmp_path):
+    path = tmp_path / 'broken.star'
+    path.write_text('load("github.com/cirrus-modules/helpers", "task")\n')
+    with pytest.raises(star.StarlarkConfigError, match='only local modules and "cirrus" are supported'):
+        star.evaluate_config(str(path))
+
+
+def test_cirrus_module(starlark, tmp_path, monkeypatch):
+    '''Environment variables are provided by the builtin cirrus module, cache depends on them'''
+    cache = FileCache(str(tmp_path / 'cache'))
+    path = tmp_path / '.cirrus.star'
+    path.write_text(
+        'load("cirrus", "env")\n'
+        '\n'
+        'def main():\n'
+        '    return [{"container": {"image": env.get("IMAGE", "debian")}, "script": "true"}]\n'
+    )
+    monkeypatch.setenv('IMAGE', 'alpine')
+    assert 'image: alpine' in star.evaluate_config(str(path), cache)
+    monkeypatch.setenv('IMAGE', 'fedora')
+    assert 'image: fedora' in star.evaluate_config(str(path), cache)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ([{'script': 'a'}, {'script': 'b'}], 'task:\n  script: a\ntask:\n  script: b\n'),
+    ({'container': {'image': 'debian'}}, 'container:\n  image: debian\n'),
+    ('task:\n  script: a\n', 'task:\n  script: a\n'),
+])
+def test_to_yaml(value, expected):
+    assert star.to_yaml(value) == expected
+
+
+def test_fallback_config_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.cirrus.star').write_text('def main():\n    return []\n')
+    assert cli.fallback_config_path() == '.cirrus.star'
+    assert cli.config_directory(str(tmp_path)) == [str(tmp_path / '.cirrus.star')]
+
+
+def test_config_directory_modules(scripts):
+    '''Loaded modules, included templates and scripts without main() are not configs'''
+    (scripts / 'helpers.star').write_text('def task(name):\n    return {"name": name}\n')
+    (scripts / 'base.yml.j2').write_text('container:\n  image: debian\n')
+    (scripts / 'tasks.yml.j2').write_text('task:\n  {% include "base.yml.j2" %}\n  script: true\n')
+    assert cli.config_directory(str(scripts)) == [str(scripts / '.cirrus.star'), str(scripts / 'tasks.yml.j2')]
@@ -0,0 +1,69 @@
+from time import monotonic as time
+
+import pytest
+
+from cirrus_run import cli
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    '''Template directory with includes and macros'''
+    monkeypatch.setenv(cli.ENVIRONMENT['cache_dir'], str(tmp_path / 'cache'))
+    monkeypatch.setenv('TEST_IMAGE', 'debian:stable-slim')
+    cli.template_environment.cache_clear()
+    directory = tmp_path / 'templates'
+    directory.mkdir()
+    (directory / 'macros.j2').write_text(
+        '{% macro task(name) %}{{ name }}_task:\n'
+        '  container:\n'
+        '    image: {{ TEST_IMAGE }}\n'
+        '{% endmacro %}'
+    )
+    (directory / 'common.yml').write_text('env:\n  CI: "true"\n')
+    (directory / '.cirrus.yml.j2').write_text(
+        '{% import "macros.j2" as m with context %}'
+        '{% include "common.yml" %}\n'
+        '{{ m.task("test") }}'
+    )
+    yield directory
+
+
+def test_includes(templates):
+    '''Templates may include and import files relative to themselves'''
+    config = cli.read_config(str(templates / '.cirrus.yml.j2'))
+    assert config == (
+        'env:\n  CI: "true"\n'
+        'test_task:\n  container:\n    image: debian:stable-slim\n'
+    )
+
+
+def test_template_reuse(templates):
+    '''Compiled templates are reused between renders'''
+    path = str(templates / '.cirrus.yml.j2')
+    cli.read_config(path)
+    environment = cli.template_environment.cache_info()
+    cli.read_config(path)
+    assert cli.template_environment.cache_info().hits == environment.hits + 1
+    assert any((templates.parent / 'cache' / 'jinja2').iterdir())
+
+
+def test_bytecode_cache(templates, monkeypatch):
+    '''Warm rendering (with bytecode cache) is faster than cold one'''
+    macros = ''.join(
+        '{{% macro m{i}(x) %}}{{% for y in range(x) %}}{{{{ y }}}}-{i}{{% endfor %}}{{% endmacro %}}\n'.format(i=i)
+        for i in range(500)
+    )
+    (templates / 'big.yml.j2').write_text(macros + '{{ m499(3) }}\n')
+    path = str(templates / 'big.yml.j2')
+
+    time_start = time()
+    cold = cli.read_config(path)
+    cold_time = time() - time_start
+
+    cli.template_environment.cache_clear()  # imitate new process
+    time_start = time()
+    warm = cli.read_config(path)
+    warm_time = time() - time_start
+
+    assert cold == warm
+    assert warm_time < cold_time
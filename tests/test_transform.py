@@ -0,0 +1,110 @@
+'''
+Config minification must not change what Cirrus CI sees
+'''
+
+import yaml
+
+from cirrus_run.transform import minify_config
+
+
+SAMPLE = '''
+# Shared settings
+env:
+  CI: "true"
+  RETRIES: 3
+
+defaults: &defaults
+  container:
+    image: python:3.9-slim-bullseye
+    cpu: 2
+    memory: 4G
+
+lint_task:
+  <<: *defaults
+  lint_script: make lint    # fast checks first
+
+test_task:
+  <<: *defaults
+  depends_on: lint
+  matrix:
+    - env: {PY: "3.8"}
+    - env: {PY: "3.9"}
+  test_script: |
+    pip install -r requirements.txt
+    make test
+
+task:
+  name: duplicate keys are kept
+  container:
+    matrix:
+      image: debian:10
+      image: debian:11
+  enabled_script: yes
+task:
+  name: 'quoted: value'
+  empty_script: ""
+  unicode_script: echo "привет"
+'''
+
+
+def node_tree(text):
+    '''Nested tuples that describe YAML node tree with aliases expanded'''
+    def describe(node):
+        if isinstance(node, yaml.ScalarNode):
+            return (node.tag, node.value)
+        if isinstance(node, yaml.SequenceNode):
+            return (node.tag, tuple(describe(item) for item in node.value))
+        return (node.tag, tuple((describe(key), describe(value)) for key, value in node.value))
+    return describe(yaml.compose(text, Loader=yaml.SafeLoader))
+
+
+def generated_matrix(tasks=200):
+    '''Large config of the kind produced by templates'''
+    lines = []
+    for index in range(tasks):
+        lines.extend([
+            '# generated task {}'.format(index),
+            'build{}_task:'.format(index),
+            '  name: build {}'.format(index),
+            '  container:',
+            '    image: gcr.io/example/builder:2024.01',
+            '    cpu: 4',
+            '    memory: 8G',
+            '  env:',
+            '    TARGET: target{}'.format(index % 5),
+            '    CCACHE_DIR: /tmp/ccache',
+            '  ccache_cache:',
+            '    folder: /tmp/ccache',
+            '    fingerprint_script: cat toolchain.version',
+            '  build_script:',
+            '    - ./configure --enable-everything --with-lots-of-options',
+            '    - make -j8 all',
+            '  always:',
+            '    logs_artifacts:',
+            '      path: build/**/*.log',
+            '',
+        ])
+    return '\n'.join(lines)
+
+
+def test_round_trip():
+    '''Parsed structure is unchanged, including duplicate keys and merge keys'''
+    minified = minify_config(SAMPLE)
+    assert '#' not in minified
+    assert len(minified) < len(SAMPLE)
+    assert node_tree(minified) == node_tree(SAMPLE)
+    assert yaml.safe_load(minified) == yaml.safe_load(SAMPLE)
+
+
+def test_repeated_blocks():
+    '''Repeated blocks are written once and referenced with aliases'''
+    config = generated_matrix()
+    minified = minify_config(config)
+    print('\nconfig size: {} -> {} bytes'.format(len(config), len(minified)))
+    assert minified.count('gcr.io/example/builder') == 1
+    assert len(minified) < len(config) / 3
+    assert node_tree(minified) == node_tree(config)
+
+
+def test_empty_config():
+    assert minify_config('# nothing here\n') == '# nothing here\n'
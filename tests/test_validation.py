@@ -0,0 +1,110 @@
+'''
+Local validation of Cirrus CI configuration
+'''
+
+import os
+from time import monotonic as time
+
+import pytest
+
+from cirrus_run.validation import validate_config
+
+
+def issues(text):
+    return [str(issue) for issue in validate_config(text)]
+
+
+def test_sample_config():
+    path = os.path.join(os.path.dirname(__file__), 'sample_build_config.yml')
+    with open(path) as f:
+        assert issues(f.read()) == []
+
+
+def test_valid_config():
+    '''Anchors, matrices, dependencies and instructions of all kinds are accepted'''
+    config = '''
+        env:
+          CI: "true"
+          TOKEN: ENCRYPTED[abcdef]
+        defaults: &defaults
+          container:
+            image: python:3
+            cpu: 2
+        lint_task:
+          <<: *defaults
+          lint_script: make lint
+        test_task:
+          <<: *defaults
+          depends_on: lint
+          timeout_in: 30m
+          env:
+            matrix:
+              - PY: 3.8
+              - PY: 3.9
+          pip_cache:
+            folder: ~/.cache/pip
+            fingerprint_script: cat requirements.txt
+          test_script:
+            - pip install -r requirements.txt
+            - make test
+          always:
+            junit_artifacts:
+              path: report.xml
+        deploy_task:
+          depends_on: [lint, test]
+          trigger_type: manual
+          container:
+            matrix:
+              image: debian:10
+              image: debian:11
+          deploy_script: make deploy
+    '''
+    assert issues(config) == ['5:9: warning: unknown key in config: defaults']
+
+
+@pytest.mark.parametrize('config, expected', [
+    ('task: pass\n', ['1:7: error: task must be a mapping']),
+    ('task:\n  container: {cpu: 2}\n  test_script: true\n',
+     ['2:14: warning: task.container requires image or dockerfile']),
+    ('task:\n  container: {image: debian}\n',
+     ['2:3: warning: task has no scripts or other instructions to execute']),
+    ('task:\n  depends_on: build\n  test_script: true\n',
+     ['2:15: warning: dependency on unknown task: build']),
+    ('task:\n  timeout_in: 2 hours\n  test_script: true\n',
+     ['2:15: warning: task.timeout_in must be a duration like 30m or 2h: 2 hours']),
+    ('task:\n  env:\n    A: [1, 2]\n  test_script: true\n',
+     ['3:8: warning: environment variable A must be a single value']),
+    ('task:\n  matrix: yes\n  test_script: true\n',
+     ['2:11: warning: task.matrix must be a list of mappings']),
+    ('task:\n  test_script: [1\n',
+     ["3:1: error: invalid YAML: while parsing a flow sequence did not find expected ',' or ']'"]),
+    ('env:\n  A: b\n', ['1:1: error: no tasks defined']),
+    ('', ['1:1: error: config is empty']),
+])
+def test_invalid_config(config, expected):
+    assert issues(config) == expected
+
+
+def test_alias_dependency():
+    '''Tasks may depend on an alias of another task'''
+    config = '''
+        build_task:
+          alias: builder
+          build_script: make
+        test_task:
+          depends_on: builder
+          test_script: make test
+    '''
+    assert issues(config) == []
+
+
+def test_speed():
+    '''Large config is checked in a few milliseconds'''
+    config = ''.join(
+        'task{0}_task:\n  container:\n    image: debian\n  env:\n    N: {0}\n  test_script: make test{0}\n'.format(i)
+        for i in range(500)
+    )
+    validate_config(config)
+    time_start = time()
+    assert issues(config) == []
+    assert time() - time_start < 0.5
@@ -0,0 +1,244 @@
+'''
+Measure bytes on the wire for a typical build with a local recording stub
+'''
+
+import gzip
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from textwrap import dedent
+from threading import Thread
+
+import pytest
+
+from cirrus_run import api as api_module
+from cirrus_run import metrics
+from cirrus_run import queries
+from cirrus_run.api import CirrusAPI, CirrusAPIError, query_hash
+
+
+LOG = ''.join('step {:05d}: compiling src/module_{}.c\n'.format(i, i % 50) for i in range(20000))
+
+
+class RecordingServer(BaseHTTPRequestHandler):
+    '''Cirrus API stub that supports gzip and persisted queries and counts payload bytes'''
+
+    protocol_version = 'HTTP/1.1'
+    sent = 0
+    received = 0
+    checks = 0
+    persisted = {}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        RecordingServer.received += len(body)
+        payload = json.loads(body)
+        query = payload.get('query')
+        persisted = payload.get('extensions', {}).get('persistedQuery')
+        if persisted:
+            if query is None:
+                query = self.persisted.get(persisted['sha256Hash'])
+            elif query_hash(query) == persisted['sha256Hash']:
+                self.persisted[persisted['sha256Hash']] = query
+        if query is None:
+            data = {'errors': [{'message': 'PersistedQueryNotFound'}]}
+        elif 'GetBuilds' in query:
+            RecordingServer.checks += 1
+            status = 'COMPLETED' if self.checks > 5 else 'EXECUTING'
+            data = {'data': {alias: {'status': status} for alias in payload['variables']}}
+        else:
+            data = {'data': {'build': {'tasks': [
+                {'id': '1', 'name': 'test', 'commands': [{'name': 'main'}]},
+            ]}}}
+        self.reply('application/json', json.dumps(data).encode())
+
+    def do_GET(self):
+        self.reply('text/plain; charset=utf-8', LOG.encode())
+
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        RecordingServer.sent += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(queries, 'sleep', lambda seconds: None)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingServer)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/graphql'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def wire_bytes(api, builds=20):
+    '''Wait for builds and download a build log, return (bytes sent to server, bytes received)'''
+    RecordingServer.sent = RecordingServer.received = RecordingServer.checks = 0
+    RecordingServer.persisted = {}
+    build_ids = ['fakebuild{}'.format(index) for index in range(builds)]
+    for build_id, error in queries.wait_builds(api, build_ids, delay=0):
+        assert error is None
+    assert ''.join(queries.build_log(api, 'fakebuild')).count('compiling') == LOG.count('compiling')
+    return RecordingServer.received, RecordingServer.sent
+
+
+def test_wire_size(server, monkeypatch):
+    '''Compressed responses and minified or persisted queries make traffic smaller'''
+    with monkeypatch.context() as patch:
+        patch.setattr(api_module, 'minify_query', dedent)
+        before = CirrusAPI('faketoken', url=server)
+        before._requests.headers['Accept-Encoding'] = 'identity'
+        before_up, before_down = wire_bytes(before)
+
+    minified_up, minified_down = wire_bytes(CirrusAPI('faketoken', url=server))
+    persisted_up, persisted_down = wire_bytes(CirrusAPI('faketoken', url=server, persisted_queries=True))
+
+    print('bytes up/down: before {}/{}, minified {}/{}, persisted {}/{}'.format(
+          before_up, before_down, minified_up, minified_down, persisted_up, persisted_down))
+    assert minified_down < before_down / 10
+    assert minified_up < before_up * 0.8
+    assert persisted_up < minified_up * 0.8
+
+
+def test_response_bytes_metric(server):
+    '''Response size is measured on the wire, not after decompression'''
+    registry = metrics.enable()
+    try:
+        api = CirrusAPI('faketoken', url=server)
+        RecordingServer.sent = RecordingServer.checks = 0
+        api(queries.GET_BUILD_TASKS, dict(build='fakebuild'))
+    finally:
+        metrics.disable()
+    counters = {counter['name']: counter['value'] for counter in registry.summary()['counters']}
+    assert counters['graphql_response_bytes_total'] == RecordingServer.sent
+
+
+def test_log_bytes_metric(server):
+    '''Log size is measured on the wire too'''
+    registry = metrics.enable()
+    try:
+        api = CirrusAPI('faketoken', url=server)
+        RecordingServer.sent = 0
+        assert ''.join(queries.stream_log(api, api.log_url('1', 'main'))) == LOG
+    finally:
+        metrics.disable()
+    counters = {counter['name']: counter['value'] for counter in registry.summary()['counters']}
+    assert counters['log_bytes_total'] == RecordingServer.sent < len(LOG) / 10
+
+
+def test_minify_query():
+    '''Whitespace and comments are removed, string literals are kept intact'''
+    query = '''
+        query Example($id: ID!, $text: String!) {  # comment
+            build(id: $id) {
+                status
+                note(text: "a,  b # c")
+            }
+        }
+    '''
+    assert api_module.minify_query(query) == (
+        'query Example($id:ID!$text:String!){build(id:$id){status note(text:"a,  b # c")}}'
+    )
+
+
+class PlainServer(BaseHTTPRequestHandler):
+    '''Cirrus API stub without persisted queries support'''
+
+    protocol_version = 'HTTP/1.1'
+    requests = 0
+    status = 200
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        PlainServer.requests += 1
+        status = 200
+        if 'query' not in payload:
+            status = self.status
+            data = {'errors': [{'message': 'PersistedQueryNotSupported'}]}
+        elif payload['variables'].get('build') == 'unknown':
+            data = {'errors': [{'message': 'Build not found'}]}
+        else:
+            data = {'data': {'build': {'status': 'COMPLETED'}}}
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a, **ka):
+        pass
+
+
+@pytest.mark.parametrize('status', [200, 400])
+def test_persisted_queries_unsupported(status, monkeypatch):
+    '''Persisted queries are disabled after the first rejected attempt'''
+    monkeypatch.setattr(PlainServer, 'status', status)
+    monkeypatch.setattr(PlainServer, 'requests', 0)
+    monkeypatch.setattr(CirrusAPI, 'RETRY_DELAY', 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PlainServer)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        api = CirrusAPI('faketoken', url='http://127.0.0.1:{}/graphql'.format(server.server_port),
+                        persisted_queries=True)
+        for _ in range(3):
+            assert api(queries.GET_BUILD_TASKS, dict(build='1')) == {'build': {'status': 'COMPLETED'}}
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not api.persisted_queries
+    assert PlainServer.requests == 4
+
+
+class PersistedServer(PlainServer):
+    '''Cirrus API stub that accepts any persisted query'''
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        PlainServer.requests += 1
+        status = 200
+        if PlainServer.status != 200:
+            status, data = PlainServer.status, {'errors': [{'message': 'Try again later'}]}
+            PlainServer.status = 200
+        elif payload['variables'].get('build') == 'unknown':
+            data = {'errors': [{'message': 'Build not found'}]}
+        else:
+            data = {'data': {'build': {'status': 'COMPLETED'}}}
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.mark.parametrize('status', [200, 503])
+def test_persisted_queries_errors(status, monkeypatch):
+    '''Query errors and transient failures are not mistaken for lack of persisted queries support'''
+    monkeypatch.setattr(PlainServer, 'status', status)
+    monkeypatch.setattr(PlainServer, 'requests', 0)
+    monkeypatch.setattr(CirrusAPI, 'RETRY_DELAY', 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PersistedServer)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        api = CirrusAPI('faketoken', url='http://127.0.0.1:{}/graphql'.format(server.server_port),
+                        persisted_queries=True)
+        with pytest.raises(CirrusAPIError, match='Build not found'):
+            api(queries.GET_BUILD_TASKS, dict(build='unknown'), retries=0 if status == 200 else 1)
+        assert api(queries.GET_BUILD_TASKS, dict(build='1')) == {'build': {'status': 'COMPLETED'}}
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert api.persisted_queries
+    assert PlainServer.requests == (2 if status == 200 else 3)